@@ -1,42 +1,210 @@
-from pdf_reader import extract_text
+from pdf_reader import extract_book
+from audiobook import AUDIOBOOK_NAME, assemble_audiobook
+from batch import find_pdfs, run_batch, throughput_report
+from book_cache import BookCache
+from book_store import Book
+from journal import JOURNAL_NAME, Journal
 from transform import *
 from speaker import speak_file
-from preprocessor import preprocess_file
+from preprocessor import preprocess_file, preprocessed_path
+from pipeline import Stage, run_pipeline
+from precleaner import find_repeated_lines
+from pack_store import collect_garbage, parse_size
+from work_queue import LEASE_SECONDS, WorkQueue, process_chunks, run_worker
+import backends
+from llm_cache import ResponseCache
+import metrics
+import os
 from argparse import ArgumentParser
+from functools import partial
 
 from typing import Optional
 
 
-def main(path: str, max_length: int = -1) -> None:
+def main(path: str, max_length: int = -1, workers: int = 1, preprocess_workers: int = 2, speak_workers: int = 4, queue_size: int = 2, window_size: int = 0, window_workers: int = 4, skip_llm: bool = False, resume: bool = False, distributed: bool = False, lease_seconds: float = LEASE_SECONDS) -> None:
     """
     Main function to process a PDF file, extract its text, transform it, and save the result.
     
     Args:
         path (str): The path to the PDF file.
+        max_length (int): A book without a table of contents of at most this many characters is a single chunk, longer ones are split into chunks of similar size.
+        workers (int): The number of processes extracting the pages of the PDF file.
+        preprocess_workers (int): The maximum number of chunks preprocessed at the same time.
+        speak_workers (int): The maximum number of chunks spoken at the same time.
+        queue_size (int): The maximum number of chunks waiting in front of each stage.
+        window_size (int): If positive, chunks longer than this are preprocessed in overlapping windows of this many characters.
+        window_workers (int): The maximum number of windows of a chunk preprocessed at the same time.
+        skip_llm (bool): Only clean the chunks locally, without the language model.
+        resume (bool): Continue where the last run of the book stopped, according to its journal. Otherwise the journal starts empty.
+        distributed (bool): Preprocess and speak the chunks through the work queue in the cache directory,
+            so workers on other processes and hosts can help, see work_queue.py.
+        lease_seconds (float): Distributed: how long a task of a crashed worker stays leased before another worker reclaims it.
     
     Returns:
         None
     """
-    text = extract_text(path)
-    list_of_files = transform(text, max_length_book_as_single_file=max_length)
+    with metrics.stage("extract", path=path) as event:
+        book, page_offsets, outline = extract_book(path, workers=workers)
+        event["bytes_in"] = os.path.getsize(path)
+        event["bytes_out"] = book.byte_length
+
+    process_book(path, book, page_offsets, outline, max_length, preprocess_workers, speak_workers, queue_size, window_size, window_workers, skip_llm, resume, distributed, lease_seconds)
+
+    print(metrics.summary())
+    print(f"LLM response cache: {backends.get_response_cache().stats()}")
+
+
+def process_book(path: str, book: Book, page_offsets: list[int], outline: Optional[list[dict]], max_length: int = -1, preprocess_workers: int = 2, speak_workers: int = 4, queue_size: int = 2, window_size: int = 0, window_workers: int = 4, skip_llm: bool = False, resume: bool = False, distributed: bool = False, lease_seconds: float = LEASE_SECONDS) -> list[str]:
+    """
+    Process an extracted book: split it into chunks, preprocess and speak them,
+    and join the audio into an audiobook with chapter markers in the cache directory of the book.
+    The arguments are the ones of main, plus what pdf_reader.extract_book returns for the PDF file.
+
+    Returns:
+        list[str]: The paths of the mp3 files of the chunks, in the order of the book.
+    """
+    cache = BookCache(book)
+
+    # Another run of the same book, e.g. of an identical PDF file in the same batch, keeps its files from being compacted
+    with cache.in_use():
+        # Every completed unit of work is journaled, so a run with resume continues exactly where this one stops
+        journal = Journal(cache.path(JOURNAL_NAME))
+        if not resume:
+            journal.reset()
+
+        list_of_files = transform(book, max_length_book_as_single_file=max_length, page_offsets=page_offsets, outline=outline, journal=journal, identity=os.path.basename(path))
+
+        # The preprocessed chunks of an earlier run are in the pack store, see BookCache.compact
+        cache.restore()
+
+        # Running headers and footers can only be detected with the pages of the book
+        repeated_lines = find_repeated_lines(book[start:end] for start, end in zip(page_offsets, page_offsets[1:]))
     
-    for file in list_of_files: 
-        preprocessed_file = preprocess_file(file)
-        speak_file(preprocessed_file)
+        if distributed:
+            # The done tasks of the queue take the place of the journal
+            spoken_files = process_chunks(WorkQueue(lease_seconds=lease_seconds), list_of_files, {
+                "window_size": window_size, "window_workers": window_workers, "repeated_lines": sorted(repeated_lines), "skip_llm": skip_llm,
+            })
+        else:
+            # Preprocessing and speaking overlap, chunk by chunk
+            spoken_files = run_pipeline(list_of_files, [
+                Stage("preprocess", partial(preprocess_file, window_size=window_size, max_windows_in_flight=window_workers, repeated_lines=repeated_lines, skip_llm=skip_llm, journal=journal), preprocess_workers),
+                Stage("speak", partial(speak_file, journal=journal), speak_workers),
+            ], queue_size=queue_size)
+
+        # The chapter names are the names of the chunks from the table of contents
+        title = os.path.splitext(os.path.basename(path))[0]
+        manifest = cache.get_manifest()
+        if manifest is not None and [chunk["path"] for chunk in manifest] == list_of_files:
+            names = [chunk["name"] for chunk in manifest]
+        else:
+            names = [title] * len(spoken_files)
+        assemble_audiobook(title, list(zip(names, spoken_files)), cache.path(AUDIOBOOK_NAME))
+
+    # Only the audio is needed from now on, the preprocessed text only if the book is processed again
+    cache.compact(preprocessed_path(path) for path in list_of_files)
+
+    return spoken_files
+
+
+def main_batch(patterns: list[str], workers: int = 2, books_in_flight: int = 2, **arguments) -> dict:
+    """
+    Process all PDF files given by paths, directories and glob patterns, see batch.run_batch.
+
+    Args:
+        patterns (list[str]): The paths, directories and glob patterns.
+        workers (int): The number of processes extracting PDF files.
+        books_in_flight (int): The maximum number of books processed at the same time after extraction.
+        **arguments: Passed on to process_book, e.g. speak_workers.
+
+    Returns:
+        dict: The throughput of the run.
+    """
+    paths = find_pdfs(patterns)
+    metrics.log(f"Processing {len(paths)} books.")
+
+    throughput = run_batch(paths, partial(process_book, **arguments), extract_workers=workers, books_in_flight=books_in_flight)
+
+    print(metrics.summary())
+    print(f"LLM response cache: {backends.get_response_cache().stats()}")
+    print(throughput_report(throughput))
+    return throughput
 
 
 if __name__ == "__main__":
     """
     Args: 
-        path (str): The path to the PDF file.
-        max_length (int): The maximum length of the text to process. Only relevant if the Table of Contents can not be extracted.
+        paths (list[str]): The PDF files, directories or glob patterns. More than one book is processed in batch mode.
+        max_length (int): A book without a table of contents of at most this many characters is a single chunk, longer ones are split into chunks of similar size.
+        workers (int): The number of processes extracting the pages of the PDF file.
+        preprocess_workers (int): The maximum number of chunks preprocessed at the same time.
+        speak_workers (int): The maximum number of chunks spoken at the same time.
+        queue_size (int): The maximum number of chunks waiting in front of each stage.
+        window_size (int): If positive, chunks longer than this are preprocessed in overlapping windows of this many characters.
+        window_workers (int): The maximum number of windows of a chunk preprocessed at the same time.
+        skip_llm (bool): Only clean the chunks locally, without the language model.
+        event_log (str): The JSON lines file every measured event is appended to.
+        quiet (bool): Only print the summary at the end of the run.
+        verbose (bool): Also print debug output, e.g. the parts of the book searched for chapters.
+        backend (str): "openai" for the real models, "fake" for offline stand-ins, see backends.py.
+        llm_cache_mb (int): The maximum size of the response cache of the language model in megabytes.
+        books_in_flight (int): Batch mode: the maximum number of books processed at the same time.
+        llm_concurrency (int): The maximum number of language model calls in flight, across all books. 0 is unlimited.
+        tts_concurrency (int): The maximum number of speech requests in flight, across all books. 0 is unlimited.
+        resume (bool): Continue where the last run stopped, according to the journal of every book.
+        distributed (bool): Preprocess and speak the chunks through the work queue in the cache directory.
+        worker (bool): Only work on the tasks of the work queue, for books run with distributed by other processes or hosts.
+        worker_idle_seconds (float): Worker mode: stop after this long without a task. 0 waits for tasks forever.
+        lease_seconds (float): How long a task of a crashed worker stays leased before another worker reclaims it.
+        gc (str): Evict the least recently used finished books until the cache fits into this size, e.g. 5G. Runs after the books, if any.
     Returns:
         None 
     """
     parser = ArgumentParser(description="Process a PDF file and extract its text.")
-    parser.add_argument("path", required=True, type=str, help="The path to the PDF file.")
-    parser.add_argument("--max_length", type=int, default=-1, help="The maximum length of the text to process. Only relevant if the Table of Contents can not be extracted.")
+    parser.add_argument("paths", type=str, nargs="*", help="The PDF files, directories or glob patterns. More than one book is processed in batch mode.")
+    parser.add_argument("--max_length", type=int, default=-1, help="A book without a table of contents of at most this many characters is a single chunk, longer ones are split into chunks of similar size.")
+    parser.add_argument("--workers", type=int, default=1, help="The number of processes extracting the pages of the PDF file. In batch mode, the number of processes extracting PDF files.")
+    parser.add_argument("--preprocess_workers", type=int, default=2, help="The maximum number of chunks preprocessed at the same time.")
+    parser.add_argument("--speak_workers", type=int, default=4, help="The maximum number of chunks spoken at the same time.")
+    parser.add_argument("--queue_size", type=int, default=2, help="The maximum number of chunks waiting in front of each stage.")
+    parser.add_argument("--window_size", type=int, default=0, help="If positive, chunks longer than this are preprocessed in overlapping windows of this many characters.")
+    parser.add_argument("--window_workers", type=int, default=4, help="The maximum number of windows of a chunk preprocessed at the same time.")
+    parser.add_argument("--event_log", type=str, default="cache/events.jsonl", help="The JSON lines file every measured event is appended to.")
+    parser.add_argument("--quiet", action="store_true", help="Only print the summary at the end of the run.")
+    parser.add_argument("--verbose", action="store_true", help="Also print debug output, e.g. the parts of the book searched for chapters.")
+    parser.add_argument("--backend", choices=["openai", "fake"], default="fake" if backends.use_fake_backends() else "openai", help="The language model and text to speech backends. fake runs offline.")
+    parser.add_argument("--llm_cache_mb", type=int, default=256, help="The maximum size of the response cache of the language model in megabytes.")
+    parser.add_argument("--skip_llm", action="store_true", help="Only clean the chunks locally, without the language model. For PDFs with already clean text.")
+    parser.add_argument("--books_in_flight", type=int, default=2, help="Batch mode: the maximum number of books processed at the same time.")
+    parser.add_argument("--llm_concurrency", type=int, default=backends.DEFAULT_LLM_CONCURRENCY, help="The maximum number of language model calls in flight, across all books. 0 is unlimited.")
+    parser.add_argument("--tts_concurrency", type=int, default=backends.DEFAULT_TTS_CONCURRENCY, help="The maximum number of speech requests in flight, across all books. 0 is unlimited.")
+    parser.add_argument("--resume", action="store_true", help="Continue where the last run stopped, according to the journal of every book.")
+    parser.add_argument("--distributed", action="store_true", help="Preprocess and speak the chunks through the work queue in the cache directory, so --worker processes can help.")
+    parser.add_argument("--worker", action="store_true", help="Only work on the tasks of the work queue in the cache directory. Run from the same directory on every host.")
+    parser.add_argument("--worker_idle_seconds", type=float, default=0, help="Worker mode: stop after this long without a task. 0 waits for tasks forever.")
+    parser.add_argument("--gc", type=str, default=None, metavar="BUDGET", help="Evict the least recently used finished books until the cache fits into this size, e.g. 5G. Runs after the books, if any.")
+    parser.add_argument("--lease_seconds", type=float, default=LEASE_SECONDS, help="How long a task of a crashed worker stays leased before another worker reclaims it.")
 
     args = parser.parse_args()
-    
-    main(args.path, args.max_length)
+    metrics.configure(event_log=args.event_log, quiet=args.quiet, verbose=args.verbose)
+    backends.set_response_cache(ResponseCache(max_bytes=args.llm_cache_mb * 1024 * 1024))
+    if args.backend == "fake":
+        backends.set_llm(backends.FakeLLMBackend())
+        backends.set_tts(backends.FakeTTSBackend())
+    backends.set_concurrency(llm=args.llm_concurrency, tts=args.tts_concurrency)
+
+    if args.worker:
+        tasks = run_worker(WorkQueue(lease_seconds=args.lease_seconds), idle_seconds=args.worker_idle_seconds or None)
+        print(f"{tasks} tasks done.")
+        print(metrics.summary())
+    elif not args.paths:
+        if args.gc is None:
+            parser.error("the paths are required, except with --worker or --gc")
+    elif len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+        main(args.paths[0], args.max_length, args.workers, args.preprocess_workers, args.speak_workers, args.queue_size, args.window_size, args.window_workers, args.skip_llm, args.resume, args.distributed, args.lease_seconds)
+    else:
+        main_batch(args.paths, args.workers, args.books_in_flight, max_length=args.max_length, preprocess_workers=args.preprocess_workers, speak_workers=args.speak_workers,
+                   queue_size=args.queue_size, window_size=args.window_size, window_workers=args.window_workers, skip_llm=args.skip_llm, resume=args.resume, distributed=args.distributed, lease_seconds=args.lease_seconds)
+
+    if args.gc is not None:
+        print(f"Garbage collection: {collect_garbage(parse_size(args.gc))}")
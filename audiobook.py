@@ -0,0 +1,182 @@
+import os
+import struct
+import tempfile
+from typing import Optional
+
+import mp3
+from metrics import log, record, stage
+
+AUDIOBOOK_NAME = "audiobook.mp3"
+
+# A table of contents frame can only list 255 entries
+MAX_CTOC_ENTRIES = 255
+
+
+def syncsafe(size: int) -> bytes:
+    """
+    A size as 4 bytes of 7 bits each, like in the ID3v2 header.
+    """
+    return bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+def id3_frame(frame_id: str, data: bytes) -> bytes:
+    """
+    An ID3v2.3 frame: its id, the size of its data, no flags and the data.
+    """
+    return frame_id.encode("latin-1") + struct.pack(">IH", len(data), 0) + data
+
+
+def text_frame(frame_id: str, text: str) -> bytes:
+    """
+    An ID3v2.3 text frame, e.g. TIT2 for a title, in UTF-16 so any name can be stored.
+    """
+    return id3_frame(frame_id, b"\x01" + text.encode("utf-16") + b"\x00\x00")
+
+
+def chapter_frame(element_id: str, title: str, start_ms: int, end_ms: int) -> bytes:
+    """
+    A CHAP frame: a chapter from start_ms to end_ms with its title. The byte offsets are left unset.
+    """
+    return id3_frame("CHAP", element_id.encode("latin-1") + b"\x00" + struct.pack(">IIII", start_ms, end_ms, 0xFFFFFFFF, 0xFFFFFFFF) + text_frame("TIT2", title))
+
+
+def table_of_contents_frame(element_id: str, children: list[str], top_level: bool, title: Optional[str] = None) -> bytes:
+    """
+    A CTOC frame listing the element ids of chapters or of other tables of contents, in order.
+    """
+    flags = (0x02 if top_level else 0x00) | 0x01  # ordered
+    data = element_id.encode("latin-1") + b"\x00" + bytes([flags, len(children)])
+    data += b"".join(child.encode("latin-1") + b"\x00" for child in children)
+    if title is not None:
+        data += text_frame("TIT2", title)
+    return id3_frame("CTOC", data)
+
+
+def chapter_tag(title: str, chapters: list[tuple[str, int, int]]) -> bytes:
+    """
+    An ID3v2.3 tag with the title of the book and a chapter marker for every chapter.
+    More than MAX_CTOC_ENTRIES chapters are grouped into nested tables of contents.
+
+    Args:
+        title (str): The title of the audiobook.
+        chapters (list[tuple[str, int, int]]): The title, start and end in milliseconds of every chapter.
+    """
+    frames = [text_frame("TIT2", title)]
+
+    chapter_ids = [f"chp{index}" for index in range(len(chapters))]
+    for element_id, (chapter_title, start_ms, end_ms) in zip(chapter_ids, chapters):
+        frames.append(chapter_frame(element_id, chapter_title, start_ms, end_ms))
+
+    if len(chapter_ids) <= MAX_CTOC_ENTRIES:
+        frames.append(table_of_contents_frame("toc", chapter_ids, top_level=True, title=title))
+    else:
+        groups = [chapter_ids[i:i + MAX_CTOC_ENTRIES] for i in range(0, len(chapter_ids), MAX_CTOC_ENTRIES)]
+        group_ids = [f"toc{index}" for index in range(len(groups))]
+        frames.append(table_of_contents_frame("toc", group_ids[:MAX_CTOC_ENTRIES], top_level=True, title=title))
+        for group_id, group in zip(group_ids, groups):
+            frames.append(table_of_contents_frame(group_id, group, top_level=False))
+
+    body = b"".join(frames)
+    return b"ID3\x03\x00\x00" + syncsafe(len(body)) + body
+
+
+def assemble_audiobook(title: str, chapters: list[tuple[str, str]], output: str, cache: bool = True) -> str:
+    """
+    Join the audio of all chapters into one mp3 file with chapter markers (ID3v2.3 CHAP and CTOC frames).
+    The audio frames are copied, nothing is decoded or re-encoded.
+    Two passes over the input: the first sums up the durations for the chapter markers, which have to be
+    in the tag at the start of the file, the second copies the frames. Only one frame is in memory at a time,
+    regardless of the length of the book.
+    If cached, the audiobook is skipped if it is newer than all chapter files.
+
+    Args:
+        title (str): The title of the audiobook.
+        chapters (list[tuple[str, str]]): The name and mp3 file of every chapter, in the order of the book.
+        output (str): The path of the audiobook. Written atomically.
+        cache (bool): Skip the audiobook if it is up to date.
+
+    Returns:
+        str: The path of the audiobook.
+    """
+    if cache and os.path.exists(output) and all(os.path.getmtime(output) >= os.path.getmtime(path) for _, path in chapters):
+        log(f"Audiobook already exists: {output}")
+        record("audiobook", cache_hits=1, path=output)
+        return output
+
+    with stage("audiobook", cache_misses=1, path=output) as event:
+        markers = []
+        position = 0.0
+        for name, path in chapters:
+            seconds = mp3.duration(path)
+            markers.append((name, round(position * 1000), round((position + seconds) * 1000)))
+            position += seconds
+
+        # A temporary file of its own, an identical book may be assembled into the same output at the same time
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(output) or ".", prefix=f".{os.path.basename(output)}.", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as out:
+                out.write(chapter_tag(title, markers))
+                for _, path in chapters:
+                    with open(path, 'rb') as file:
+                        for frame, _, _ in mp3.iter_frames(file):
+                            out.write(frame)
+            os.replace(temporary_path, output)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        event["bytes_in"] = sum(os.path.getsize(path) for _, path in chapters)
+        event["bytes_out"] = os.path.getsize(output)
+        event["audio_seconds"] = round(position, 3)
+
+    log(f"Audiobook with {len(chapters)} chapters written to: {output}")
+    return output
+
+
+def read_chapters(path: str) -> list[tuple[str, int, int]]:
+    """
+    Read the chapter markers of an mp3 file written by assemble_audiobook.
+
+    Returns:
+        list[tuple[str, int, int]]: The title, start and end in milliseconds of every chapter.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(10)
+        tag = file.read(mp3.id3v2_size(header) - 10)
+
+    def frames(data: bytes):
+        while len(data) >= 10 and data[:4] != bytes(4):
+            frame_id = data[:4].decode("latin-1")
+            size = struct.unpack(">I", data[4:8])[0]
+            yield frame_id, data[10:10 + size]
+            data = data[10 + size:]
+
+    chapters = []
+    for frame_id, data in frames(tag):
+        if frame_id == "CHAP":
+            end_of_id = data.index(b"\x00")
+            start_ms, end_ms = struct.unpack(">II", data[end_of_id + 1:end_of_id + 9])
+            title = ""
+            for sub_id, sub_data in frames(data[end_of_id + 17:]):
+                if sub_id == "TIT2":
+                    title = sub_data[1:].decode("utf-16").rstrip("\x00")
+            chapters.append((title, start_ms, end_ms))
+
+    return chapters
+
+
+if __name__ == "__main__":
+    # Example usage: three chapters of silence, one with a name that is not latin-1
+    from book_cache import write_atomic
+
+    with tempfile.TemporaryDirectory() as directory:
+        chapters = []
+        for index, (name, frames) in enumerate([("Vorwort", 10), ("Kapitel 1: Größe", 40), ("Kapitel 2: 終わり", 25)]):
+            path = os.path.join(directory, f"{index}.mp3")
+            write_atomic(path, mp3.SILENT_FRAME * frames)
+            chapters.append((name, path))
+
+        output = assemble_audiobook("Ein Buch", chapters, os.path.join(directory, AUDIOBOOK_NAME))
+        print(read_chapters(output), f"{mp3.duration(output):.3f}s")
+        assert [name for name, _, _ in read_chapters(output)] == [name for name, _ in chapters]
@@ -0,0 +1,471 @@
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import mp3
+from llm_cache import ResponseCache
+from metrics import record
+from precleaner import estimate_tokens
+from rate_limiter import call_with_rate_limit, get_rate_limiter
+
+TOC_LINE = re.compile(r"^\s*(\S.*?)\s*(?:\.{2,}|\s)\s*(\d+)\s*$", re.MULTILINE)
+CHAPTER_NAME_IN_CONTEXT = re.compile(r"is called '(.+?)'\.")
+
+# The concurrency budget unless set_concurrency sets another one, well below the limits of a usual API account
+DEFAULT_LLM_CONCURRENCY = 8
+DEFAULT_TTS_CONCURRENCY = 8
+
+
+class Parameter(NamedTuple):
+    """
+    The type and name of an input or output of a language model function.
+    """
+    type: Any
+    name: str
+
+
+class FakeBackendError(Exception):
+    """
+    A failure simulated by a fake backend.
+    """
+
+
+class LLMBackend(ABC):
+    """
+    Creates language model functions. The arguments are the ones of gptLang.Funktion.
+    """
+
+    # Whether the calls count against the rate limits of the API, see rate_limiter.py
+    rate_limited = True
+
+    @abstractmethod
+    def function(self, returnType: Parameter, context: str, inputPromptFormatString: str, model: str,
+                 inputType: Optional[Parameter] = None, gpt_params: Optional[dict] = None,
+                 can_throw: bool = False, returnValidator: Optional[Callable[[Any], Optional[str]]] = None) -> Callable[..., Any]:
+        """
+        Create a function that sends the formatted prompt with the context to the model and returns its answer.
+        If returnValidator returns an error message for an answer, the model is asked again.
+        """
+
+
+class TTSBackend(ABC):
+    """
+    Turns text into speech.
+    """
+
+    # Whether the requests count against the rate limits of the API, see rate_limiter.py
+    rate_limited = True
+
+    @abstractmethod
+    def synthesize(self, text: str, path: str) -> None:
+        """
+        Speak text and write the mp3 audio to path.
+        """
+
+
+class CachedLLMBackend(LLMBackend):
+    """
+    Puts a ResponseCache in front of another backend.
+    A cached answer is only used if the validator of the function accepts it.
+    """
+
+    def __init__(self, backend: LLMBackend, cache: ResponseCache):
+        self.backend = backend
+        self.cache = cache
+
+    def function(self, returnType, context, inputPromptFormatString, model, inputType=None, gpt_params=None, can_throw=False, returnValidator=None):
+        uncached_function = self.backend.function(
+            returnType=returnType,
+            context=context,
+            inputPromptFormatString=inputPromptFormatString,
+            model=model,
+            inputType=inputType,
+            gpt_params=gpt_params,
+            can_throw=can_throw,
+            returnValidator=returnValidator,
+        )
+
+        def call(**kwargs):
+            prompt = inputPromptFormatString.format(**kwargs) if inputType is not None else inputPromptFormatString
+            key = ResponseCache.key(model, context, prompt, (returnType.type, returnType.name))
+
+            found, answer = self.cache.get(key)
+            if found and (returnValidator is None or returnValidator(answer) is None):
+                record("llm_cache", cache_hits=1, model=model)
+                return answer
+
+            record("llm_cache", cache_misses=1, model=model)
+            answer = uncached_function(**kwargs)
+            self.cache.put(key, answer)
+            return answer
+
+        return call
+
+
+class LimitedLLMBackend(LLMBackend):
+    """
+    Lets at most as many calls into another backend at the same time as the semaphore allows.
+    The semaphore is shared by all stages and books, so it is a global concurrency budget.
+    """
+
+    def __init__(self, backend: LLMBackend, slots: threading.Semaphore):
+        self.backend = backend
+        self.slots = slots
+
+    def function(self, returnType, context, inputPromptFormatString, model, inputType=None, gpt_params=None, can_throw=False, returnValidator=None):
+        limited_function = self.backend.function(
+            returnType=returnType,
+            context=context,
+            inputPromptFormatString=inputPromptFormatString,
+            model=model,
+            inputType=inputType,
+            gpt_params=gpt_params,
+            can_throw=can_throw,
+            returnValidator=returnValidator,
+        )
+
+        def call(**kwargs):
+            with self.slots:
+                return limited_function(**kwargs)
+
+        return call
+
+
+class LimitedTTSBackend(TTSBackend):
+    """
+    Lets at most as many requests into another backend at the same time as the semaphore allows.
+    """
+
+    def __init__(self, backend: TTSBackend, slots: threading.Semaphore):
+        self.backend = backend
+        self.slots = slots
+
+    def synthesize(self, text, path):
+        with self.slots:
+            self.backend.synthesize(text, path)
+
+
+class RateLimitedLLMBackend(LLMBackend):
+    """
+    Sends the calls of another backend through the shared rate limiter of their model.
+    Every request is charged: the first one of a call, and every further one when an answer is rejected by
+    the validator and the model is asked again. Throttled calls are retried with backoff, see rate_limiter.call_with_rate_limit.
+    """
+
+    def __init__(self, backend: LLMBackend):
+        self.backend = backend
+
+    def function(self, returnType, context, inputPromptFormatString, model, inputType=None, gpt_params=None, can_throw=False, returnValidator=None):
+        current_call = threading.local()
+
+        charged_validator = None
+        if returnValidator is not None:
+            def charged_validator(answer):
+                error = returnValidator(answer)
+                # The model is asked again. After the last interaction this charges one request too many.
+                if error is not None:
+                    waited = current_call.limiter.acquire(current_call.tokens)
+                    if waited > 0:
+                        record("rate_limit", waited, model=model)
+                return error
+
+        limited_function = self.backend.function(
+            returnType=returnType,
+            context=context,
+            inputPromptFormatString=inputPromptFormatString,
+            model=model,
+            inputType=inputType,
+            gpt_params=gpt_params,
+            can_throw=can_throw,
+            returnValidator=charged_validator,
+        )
+
+        def call(**kwargs):
+            prompt = inputPromptFormatString.format(**kwargs) if inputType is not None else inputPromptFormatString
+            # The answer is about as long as the prompt for most of our functions
+            current_call.tokens = estimate_tokens(context) + 2 * estimate_tokens(prompt)
+            current_call.limiter = get_rate_limiter(model)
+            return call_with_rate_limit(lambda: limited_function(**kwargs), current_call.limiter, current_call.tokens, name=model)
+
+        return call
+
+
+class RateLimitedTTSBackend(TTSBackend):
+    """
+    Sends the requests of another backend through the shared rate limiter of its model.
+    """
+
+    def __init__(self, backend: TTSBackend):
+        self.backend = backend
+
+    def synthesize(self, text, path):
+        model = getattr(self.backend, "model", "tts")
+        call_with_rate_limit(lambda: self.backend.synthesize(text, path), get_rate_limiter(model), estimate_tokens(text), name=model)
+
+
+class GptLangBackend(LLMBackend):
+    """
+    The OpenAI models through gptLang.
+    """
+
+    def function(self, returnType, context, inputPromptFormatString, model, inputType=None, gpt_params=None, can_throw=False, returnValidator=None):
+        import gptLang
+
+        arguments = dict(
+            returnType=gptLang.Parameter(type=returnType.type, name=returnType.name),
+            gpt_params=gpt_params or {},
+            context=context,
+            inputPromptFormatString=inputPromptFormatString,
+            model=model,
+            can_throw=can_throw,
+        )
+        if inputType is not None:
+            arguments["inputType"] = gptLang.Parameter(type=inputType.type, name=inputType.name)
+        if returnValidator is not None:
+            arguments["returnValidator"] = returnValidator
+
+        return gptLang.Funktion(**arguments)
+
+
+class OpenAITTSBackend(TTSBackend):
+    """
+    The speech API of OpenAI.
+    The endpoint can be changed with the OPENAI_BASE_URL environment variable, e.g. to a local fake speech server.
+    """
+
+    def __init__(self, model: str = "gpt-4o-mini-tts", voice: str = "ash",
+                 instructions: str = "You are reading an audiobook. Read it in standard german. Please read it in a natural and very calming way. Mumble a bit."):
+        self.model = model
+        self.voice = voice
+        self.instructions = instructions
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        """
+        The OpenAI client, created on first use.
+        """
+        from openai import OpenAI
+
+        with self._lock:
+            if self._client is None:
+                # Throttled requests are retried by the shared rate limiter, not by the client
+                self._client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL"), max_retries=0)
+            return self._client
+
+    def synthesize(self, text, path):
+        with self.client().audio.speech.with_streaming_response.create(
+            model=self.model,
+            voice=self.voice,
+            input=text,
+            instructions=self.instructions,
+        ) as response:
+            response.stream_to_file(path)
+
+
+class FakeLLMBackend(LLMBackend):
+    """
+    An offline stand-in for the language model, for tests and benchmarks.
+    Answers are derived from the prompt and are deterministic for the same prompt, context and seed:
+    - table_of_contents (str): the lines of the prompt that look like "Name ..... 12", or "" if there are none.
+    - table_of_contents (list): those lines as [{"name": ..., "page": ...}].
+    - starting_string: the text of the prompt starting at the chapter name from the context.
+    - anything else: the prompt with normalized whitespace, scaled by output_size.
+    """
+
+    rate_limited = False
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, output_size: float = 1.0, seed: int = 0):
+        """
+        Args:
+            latency (float): The seconds every model call takes.
+            error_rate (float): The probability that a model call raises FakeBackendError.
+            output_size (float): The length of free text answers relative to the prompt.
+            seed (int): Changes which calls fail.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.output_size = output_size
+        self.seed = seed
+
+    def _answer(self, returnType: Parameter, context: str, prompt: str, attempt: int) -> Any:
+        if returnType.name == "table_of_contents":
+            entries = [(name.strip(" ."), int(page)) for name, page in TOC_LINE.findall(prompt)]
+            if returnType.type is str:
+                return "\n".join(f"{name} {page}" for name, page in entries) if len(entries) >= 2 else ""
+            return [{"name": name, "page": page} for name, page in entries]
+
+        if returnType.name == "starting_string":
+            name = CHAPTER_NAME_IN_CONTEXT.search(context)
+            position = prompt.lower().find(name.group(1).lower()) if name else -1
+            # A later attempt starts a bit later, like a model trying another candidate
+            position = max(position, 0) + attempt
+            return prompt[position:position + 120]
+
+        text = " ".join(prompt.split())
+        length = int(len(text) * self.output_size)
+        return (text * (length // max(len(text), 1) + 1))[:length]
+
+    def function(self, returnType, context, inputPromptFormatString, model, inputType=None, gpt_params=None, can_throw=False, returnValidator=None):
+        max_interactions = (gpt_params or {}).get("max_interactions", 10)
+
+        def call(**kwargs):
+            prompt = inputPromptFormatString.format(**kwargs) if inputType is not None else inputPromptFormatString
+            digest = hashlib.md5(f"{self.seed}:{model}:{context}:{prompt}".encode()).hexdigest()
+
+            answer = None
+            for attempt in range(max_interactions):
+                time.sleep(self.latency)
+                if random.Random(f"{digest}:{attempt}").random() < self.error_rate:
+                    raise FakeBackendError(f"Simulated failure of {model}")
+
+                answer = self._answer(returnType, context, prompt, attempt)
+                if returnValidator is None or returnValidator(answer) is None:
+                    return answer
+
+            if can_throw:
+                raise FakeBackendError(f"No valid answer from {model} after {max_interactions} interactions")
+            return answer
+
+        return call
+
+
+class FakeTTSBackend(TTSBackend):
+    """
+    An offline stand-in for the speech API, for tests and benchmarks.
+    Writes silent mp3 frames, one per 20 characters scaled by output_size.
+    """
+
+    rate_limited = False
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, output_size: float = 1.0, seed: int = 0):
+        """
+        Args:
+            latency (float): The seconds every request takes.
+            error_rate (float): The probability that a request raises FakeBackendError.
+            output_size (float): The amount of audio relative to the default.
+            seed (int): Changes which requests fail.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.output_size = output_size
+        self.seed = seed
+
+    def synthesize(self, text, path):
+        time.sleep(self.latency)
+        if random.Random(f"{self.seed}:{hashlib.md5(text.encode()).hexdigest()}").random() < self.error_rate:
+            raise FakeBackendError("Simulated failure of the speech API")
+
+        frames = max(1, int(len(text) / 20 * self.output_size))
+        with open(path, 'wb') as file:
+            file.write(mp3.SILENT_FRAME * frames)
+
+
+_lock = threading.Lock()
+_llm: Optional[LLMBackend] = None
+_tts: Optional[TTSBackend] = None
+_response_cache: Optional[ResponseCache] = None
+_llm_slots: Optional[threading.Semaphore] = threading.BoundedSemaphore(DEFAULT_LLM_CONCURRENCY)
+_tts_slots: Optional[threading.Semaphore] = threading.BoundedSemaphore(DEFAULT_TTS_CONCURRENCY)
+
+
+def use_fake_backends() -> bool:
+    """
+    Whether the fake backends are the default, set with the environment variable VIBEPDF_BACKEND=fake.
+    """
+    return os.getenv("VIBEPDF_BACKEND", "openai") == "fake"
+
+
+def get_llm(cached: bool = True) -> LLMBackend:
+    """
+    The language model backend used by all stages.
+
+    Args:
+        cached (bool): Answer from the shared response cache where possible, see get_response_cache.
+    """
+    global _llm
+
+    with _lock:
+        if _llm is None:
+            _llm = FakeLLMBackend() if use_fake_backends() else GptLangBackend()
+        backend = _llm
+        if _llm_slots is not None:
+            backend = LimitedLLMBackend(backend, _llm_slots)
+        # Waiting for the rate limit does not take up a slot of the concurrency budget
+        if _llm.rate_limited:
+            backend = RateLimitedLLMBackend(backend)
+
+    # Cache hits do not count against the concurrency budget
+    return CachedLLMBackend(backend, get_response_cache()) if cached else backend
+
+
+def set_llm(backend: LLMBackend) -> None:
+    global _llm
+
+    with _lock:
+        _llm = backend
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    The response cache shared by all language model calls.
+    """
+    global _response_cache
+
+    with _lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+def set_response_cache(cache: ResponseCache) -> None:
+    global _response_cache
+
+    with _lock:
+        _response_cache = cache
+
+
+def get_tts() -> TTSBackend:
+    """
+    The text to speech backend used by all stages.
+    """
+    global _tts
+
+    with _lock:
+        if _tts is None:
+            _tts = FakeTTSBackend() if use_fake_backends() else OpenAITTSBackend()
+        backend = _tts
+        if _tts_slots is not None:
+            backend = LimitedTTSBackend(backend, _tts_slots)
+        if _tts.rate_limited:
+            backend = RateLimitedTTSBackend(backend)
+        return backend
+
+
+def set_tts(backend: TTSBackend) -> None:
+    global _tts
+
+    with _lock:
+        _tts = backend
+
+
+def set_concurrency(llm: Optional[int] = None, tts: Optional[int] = None) -> None:
+    """
+    Set the global concurrency budget: the maximum number of language model calls and speech requests
+    in flight at the same time, across all stages and books. None or 0 is unlimited.
+    Until it is called, DEFAULT_LLM_CONCURRENCY and DEFAULT_TTS_CONCURRENCY apply.
+    """
+    global _llm_slots, _tts_slots
+
+    with _lock:
+        _llm_slots = threading.BoundedSemaphore(llm) if llm else None
+        _tts_slots = threading.BoundedSemaphore(tts) if tts else None
@@ -0,0 +1,134 @@
+import os
+import glob
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from typing import Callable, Iterable, Optional
+
+import mp3
+from book_store import BookStore
+from metrics import log, record
+from pdf_reader import extract_book
+
+
+def find_pdfs(patterns: Iterable[str]) -> list[str]:
+    """
+    The PDF files given by paths, directories (searched recursively) and glob patterns, without duplicates.
+    """
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "**", "*.pdf"), recursive=True)
+        elif os.path.exists(pattern):
+            matches = [pattern]
+        else:
+            matches = glob.glob(pattern, recursive=True)
+
+        for path in sorted(matches):
+            if os.path.isfile(path) and os.path.abspath(path) not in seen:
+                seen.add(os.path.abspath(path))
+                paths.append(path)
+
+    return paths
+
+
+def audio_seconds(paths: Iterable[Optional[str]]) -> float:
+    """
+    The total duration of mp3 files in seconds. Missing files count as silence.
+    """
+    return sum(mp3.duration(path) for path in paths if path and os.path.exists(path))
+
+
+def timed_extract_book(path: str) -> tuple[float, tuple]:
+    """
+    pdf_reader.extract_book and the seconds it took, measured in the worker process.
+    """
+    start = time.perf_counter()
+    extracted = extract_book(path)
+    return time.perf_counter() - start, extracted
+
+
+def run_batch(paths: list[str], process_book: Callable[[str, BookStore, list[int], Optional[list[dict]]], list[str]],
+              extract_workers: int = 2, books_in_flight: int = 2) -> dict:
+    """
+    Process many books at once.
+    The PDF files are extracted by a pool of processes, smallest files first, so the first results land quickly.
+    Every extracted book is then processed by one of books_in_flight threads, in the order extraction finishes.
+    Files with the same text share their cache directory, so a book is only processed after the earlier ones with the same hash
+    and finds their chunks in the cache.
+    The language model and speech calls of all books share the concurrency budget of backends.set_concurrency.
+    A failing book is logged and counted, the other books go on.
+
+    Args:
+        paths (list[str]): The PDF files.
+        process_book (Callable): Called with the path, BookStore, page offsets and outline of a book, returns its mp3 files.
+        extract_workers (int): The number of processes extracting PDF files.
+        books_in_flight (int): The maximum number of books processed at the same time after extraction.
+
+    Returns:
+        dict: The throughput of the run: books, failed books, seconds, audio minutes, books/hour and audio-minutes/hour.
+    """
+    paths = sorted(paths, key=os.path.getsize)
+    start = time.perf_counter()
+    audio = []
+    failed = []
+
+    def process(path: str, extracted: tuple, after: Optional[Future] = None) -> None:
+        if after is not None:
+            wait([after])
+        book_start = time.perf_counter()
+        try:
+            mp3_files = process_book(path, *extracted)
+        except Exception as error:
+            log(f"Failed: {path}: {error!r}")
+            record("book", time.perf_counter() - book_start, path=path, error=repr(error))
+            failed.append(path)
+            return
+
+        seconds = audio_seconds(mp3_files)
+        audio.append(seconds)
+        record("book", time.perf_counter() - book_start, path=path, audio_seconds=round(seconds, 3))
+        log(f"[{len(audio) + len(failed)}/{len(paths)}] {path}: {seconds / 60:.1f} audio minutes")
+
+    with ProcessPoolExecutor(max_workers=max(1, extract_workers)) as extractors, ThreadPoolExecutor(max_workers=max(1, books_in_flight)) as processors:
+        extractions = {extractors.submit(timed_extract_book, path): path for path in paths}
+        processing = []
+        last_of_book = {}
+
+        for future in as_completed(extractions):
+            path = extractions[future]
+            try:
+                seconds, extracted = future.result()
+            except Exception as error:
+                log(f"Failed to extract {path}: {error!r}")
+                record("extract", path=path, error=repr(error))
+                failed.append(path)
+                continue
+
+            record("extract", seconds, path=path, bytes_in=os.path.getsize(path), bytes_out=extracted[0].byte_length)
+            book_hash = extracted[0].book_hash
+            last_of_book[book_hash] = processors.submit(process, path, extracted, last_of_book.get(book_hash))
+            processing.append(last_of_book[book_hash])
+
+        for future in processing:
+            future.result()
+
+    hours = (time.perf_counter() - start) / 3600
+    audio_minutes = sum(audio) / 60
+    return {
+        "books": len(audio),
+        "failed": len(failed),
+        "seconds": round(hours * 3600, 2),
+        "audio_minutes": round(audio_minutes, 2),
+        "books/hour": round(len(audio) / hours, 2) if hours else 0.0,
+        "audio-minutes/hour": round(audio_minutes / hours, 2) if hours else 0.0,
+    }
+
+
+def throughput_report(throughput: dict) -> str:
+    """
+    The throughput of run_batch as a human readable line.
+    """
+    return (f"{throughput['books']} books ({throughput['failed']} failed) in {throughput['seconds']:.0f}s, "
+            f"{throughput['audio_minutes']:.1f} audio minutes: "
+            f"{throughput['books/hour']:.1f} books/hour, {throughput['audio-minutes/hour']:.1f} audio-minutes/hour")
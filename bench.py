@@ -0,0 +1,167 @@
+import os
+import time
+import random
+import tempfile
+import importlib.util
+from argparse import ArgumentParser
+
+import backends
+import metrics
+from llm_cache import ResponseCache
+
+WORDS = (
+    "der die das und in zu den mit von sich des auf ist im dem nicht ein eine als auch es an er hat aus bei "
+    "nach sie wie um noch nur so wird zum war haus stadt nacht licht wasser wald abend morgen stimme weg "
+    "fenster herz zeit brief ferne garten himmel schatten fluss strasse tuer"
+).split()
+
+STAGES = ["extract", "toc_extract", "toc_json", "locate", "enrich", "preprocess", "speak"]
+
+
+def escape_pdf_text(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def synthetic_book(chapters: int, pages_per_chapter: int = 4, lines_per_page: int = 35, toc: bool = True, seed: int = 0) -> list[list[str]]:
+    """
+    Generate the lines of every page of a book with random sentences.
+    Every page has a running header and a page number, every chapter starts with its name.
+    With toc, the first page is a table of contents.
+    """
+    rng = random.Random(seed)
+
+    def sentence() -> str:
+        words = rng.choices(WORDS, k=rng.randint(6, 14))
+        return " ".join(words).capitalize() + rng.choice([".", ".", ".", "!", "?"])
+
+    toc_pages = 1 if toc else 0
+    pages = []
+    if toc:
+        pages.append(["Inhalt"] + [
+            f"Kapitel {chapter + 1}: {WORDS[chapter % len(WORDS)].capitalize()} ..... {toc_pages + chapter * pages_per_chapter + 1}"
+            for chapter in range(chapters)
+        ])
+
+    for chapter in range(chapters):
+        for page in range(pages_per_chapter):
+            lines = ["Ein synthetisches Buch"]
+            if page == 0:
+                lines += [f"Kapitel {chapter + 1}: {WORDS[chapter % len(WORDS)].capitalize()}", ""]
+            while len(lines) < lines_per_page:
+                lines.append(sentence())
+            lines.append(str(len(pages) + 1))
+            pages.append(lines)
+
+    return pages
+
+
+def write_pdf(path: str, pages: list[list[str]]) -> None:
+    """
+    Write a minimal PDF with one line of Helvetica text per entry of every page.
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # The page tree, written when the page objects are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+
+    page_ids = []
+    for lines in pages:
+        text = " T* ".join(f"({escape_pdf_text(line)}) Tj" for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 56 800 Td {text} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids))
+
+    with open(path, 'wb') as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(file.tell())
+            file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+        xref = file.tell()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            file.write(b"%010d 00000 n \n" % offset)
+        file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+def load_main():
+    """
+    Load main from __main__.py, which can not be imported by its name.
+    """
+    spec = importlib.util.spec_from_file_location("vibepdf_main", os.path.join(os.path.dirname(os.path.abspath(__file__)), "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.main
+
+
+def benchmark(sizes: list[int], llm_latency: float = 0.0, tts_latency: float = 0.0, toc: bool = True, **main_arguments) -> list[dict]:
+    """
+    Run main with the fake backends on synthetic books of increasing size, each in a fresh directory
+    with its own response cache, so no book is answered from the cache of a smaller one.
+
+    Args:
+        sizes (list[int]): The numbers of chapters of the books.
+        llm_latency (float): The seconds every fake language model call takes.
+        tts_latency (float): The seconds every fake speech request takes.
+        toc (bool): Whether the books start with a table of contents.
+        **main_arguments: Passed on to main, e.g. speak_workers.
+
+    Returns:
+        list[dict]: Per book the number of pages and characters, the seconds of every stage and in total.
+    """
+    main = load_main()
+    backends.set_llm(backends.FakeLLMBackend(latency=llm_latency))
+    backends.set_tts(backends.FakeTTSBackend(latency=tts_latency))
+    metrics.configure(quiet=True)
+
+    results = []
+    working_directory = os.getcwd()
+    for chapters in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            backends.set_response_cache(ResponseCache())
+            try:
+                pages = synthetic_book(chapters, toc=toc)
+                write_pdf("book.pdf", pages)
+
+                metrics.reset()
+                start = time.perf_counter()
+                main("book.pdf", **main_arguments)
+                total = time.perf_counter() - start
+            finally:
+                os.chdir(working_directory)
+
+        stage_totals = metrics.get_totals()
+        characters = stage_totals["extract"]["bytes_out"]
+        results.append({
+            "chapters": chapters,
+            "pages": len(pages),
+            "characters": characters,
+            **{name: stage_totals.get(name, {}).get("duration", 0.0) for name in STAGES},
+            "total": total,
+            "characters/s": characters / total,
+        })
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the pipeline offline on synthetic books.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 20, 80], help="The numbers of chapters of the books.")
+    parser.add_argument("--llm_latency", type=float, default=0.0, help="The seconds every fake language model call takes.")
+    parser.add_argument("--tts_latency", type=float, default=0.0, help="The seconds every fake speech request takes.")
+    parser.add_argument("--no_toc", action="store_true", help="Start the books without a table of contents, so they are processed as a single file.")
+    args = parser.parse_args()
+
+    results = benchmark(args.sizes, args.llm_latency, args.tts_latency, toc=not args.no_toc)
+
+    columns = list(results[0])
+    rows = [columns] + [[f"{row[column]:.2f}" if isinstance(row[column], float) else str(row[column]) for column in columns] for row in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
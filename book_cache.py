@@ -0,0 +1,322 @@
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterable, Optional, Union
+
+from pack_store import get_pack_store
+
+CACHE_DIRECTORY = "cache"
+BOOK_INDEX_NAME = "books.json"
+
+# Kept in the pack store instead of the directory of the book, see pack_store.py
+PACKED_NAMES = ("toc.txt", "toc.json", "toc_enriched.json", "chunks.json", "manifest.json")
+
+_book_index_lock = threading.Lock()
+
+# The books processed right now in this process, see BookCache.in_use, and the ones being compacted, see BookCache.compact
+_books_in_use = Counter()
+_books_compacting = set()
+_books_in_use_lock = threading.Condition()
+
+
+def write_atomic(path: str, data: Union[str, bytes, memoryview]) -> None:
+    """
+    Write a file atomically.
+    The data is written to a temporary file in the same directory which is then renamed to the final path,
+    so a crash never leaves a half written file behind.
+
+    Args:
+        path (str): The path of the file.
+        data (Union[str, bytes, memoryview]): The content. Strings are written as UTF-8.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """
+    Make destination a hard link to source, or an atomically written copy where links are not possible.
+    An existing destination is replaced.
+    """
+    # Renaming a link over another link of the same file does nothing, and would leave the temporary link behind
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    directory = os.path.dirname(destination) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    # A name of its own, the same file may be linked by another thread or process at the same time.
+    # os.link creates the file itself, so only the name is kept.
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(destination)}.", suffix=".tmp")
+    os.close(file_descriptor)
+    os.remove(temporary_path)
+
+    try:
+        try:
+            os.link(source, temporary_path)
+        except OSError:
+            shutil.copy2(source, temporary_path)
+        os.replace(temporary_path, destination)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+class BookCache:
+    """
+    The cache directory of a single book.
+    The directory is named with the hash of the book, which is computed once when the cache is created.
+    The small artifacts, the tables of contents and the manifests, are kept in the pack store of the cache directory,
+    see pack_store.py. So are the preprocessed chunks of a finished book, see compact.
+    """
+
+    def __init__(self, book, root: str = CACHE_DIRECTORY, book_hash: Optional[str] = None):
+        """
+        Args:
+            book (Union[str, book_store.BookStore]): The text of the book. A BookStore already knows its hash.
+            root (str): The directory containing the caches of all books.
+            book_hash (Optional[str]): The hash of the book, if it is already known. Then book is not used.
+        """
+        self.book_hash = book_hash or getattr(book, "book_hash", None) or hashlib.md5(book.encode()).hexdigest()
+        self.root = root
+        self.directory = os.path.join(root, self.book_hash)
+        self.store = get_pack_store(root)
+        self.store.touch(self.book_hash)
+
+    def _read_book_index(self) -> dict[str, str]:
+        path = os.path.join(self.root, BOOK_INDEX_NAME)
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, 'r', encoding="utf-8") as file:
+            return json.load(file)
+
+    def previous_version(self, identity: str) -> Optional["BookCache"]:
+        """
+        The cache of the last processed version of the same book, e.g. an earlier edition of the same PDF file.
+
+        Args:
+            identity (str): What identifies the book across versions, e.g. the name of the PDF file.
+
+        Returns:
+            Optional[BookCache]: The cache of the previous version, or None if there is none or it is this version.
+        """
+        with _book_index_lock:
+            book_hash = self._read_book_index().get(identity)
+
+        if book_hash is None or book_hash == self.book_hash or not os.path.isdir(os.path.join(self.root, book_hash)):
+            return None
+        return BookCache("", self.root, book_hash=book_hash)
+
+    def remember_as(self, identity: str) -> None:
+        """
+        Make this the last processed version of the book, see previous_version.
+        """
+        with _book_index_lock:
+            index = self._read_book_index()
+            index[identity] = self.book_hash
+            write_atomic(os.path.join(self.root, BOOK_INDEX_NAME), json.dumps(index, ensure_ascii=False, indent=1))
+
+    def read_book_start(self, characters: int) -> Optional[str]:
+        """
+        The first characters of book.txt, or None if the book was not written.
+        """
+        path = self.path("book.txt")
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r', encoding="utf-8") as file:
+            return file.read(characters)
+
+    def path(self, name: str) -> str:
+        """
+        The path of a file in the cache directory of the book.
+        """
+        return os.path.join(self.directory, name)
+
+    def _read_text(self, name: str) -> Optional[str]:
+        if name in PACKED_NAMES:
+            entry = self.store.get(self.book_hash, name)
+            if entry is not None:
+                return entry[0].decode("utf-8")
+
+        # Caches written before the pack store have loose files, see compact
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r', encoding="utf-8") as file:
+            return file.read()
+
+    def _write_text(self, name: str, text: str) -> None:
+        if name in PACKED_NAMES:
+            self.store.put(self.book_hash, name, text.encode("utf-8"))
+        else:
+            write_atomic(self.path(name), text)
+
+    def _read_json(self, name: str):
+        text = self._read_text(name)
+        if text is None:
+            return None
+
+        return json.loads(text)
+
+    def _write_json(self, name: str, value) -> None:
+        self._write_text(name, json.dumps(value, ensure_ascii=False))
+
+    def put_book(self, book) -> str:
+        """
+        Write the text of the book into book.txt and return its path.
+        A BookStore is already a file, usually this book.txt, so it is linked instead.
+        """
+        path = self.path("book.txt")
+        if isinstance(book, str):
+            write_atomic(path, book)
+        elif os.path.abspath(book.path) != os.path.abspath(path):
+            link_or_copy(book.path, path)
+        return path
+
+    def get_toc_txt(self) -> Optional[str]:
+        """
+        The extracted table of contents as raw text, or None if it is not cached.
+        """
+        return self._read_text("toc.txt")
+
+    def put_toc_txt(self, toc: str) -> None:
+        self._write_text("toc.txt", toc)
+
+    def get_toc_json(self) -> Optional[list[dict]]:
+        """
+        The table of contents as nested JSON, or None if it is not cached.
+        """
+        return self._read_json("toc.json")
+
+    def put_toc_json(self, toc: list[dict]) -> None:
+        self._write_json("toc.json", toc)
+
+    def get_toc_enriched(self) -> Optional[list[dict]]:
+        """
+        The flat table of contents with character positions, or None if it is not cached.
+        """
+        return self._read_json("toc_enriched.json")
+
+    def put_toc_enriched(self, toc: list[dict]) -> None:
+        self._write_json("toc_enriched.json", toc)
+
+    def get_chunks(self) -> Optional[list[str]]:
+        """
+        The paths of the txt files the book was split into, or None if they are not cached or some are missing.
+        """
+        chunks = self._read_json("chunks.json")
+        if chunks is None or not all(os.path.exists(path) for path in chunks):
+            return None
+
+        return chunks
+
+    def put_chunks(self, chunks: list[str]) -> None:
+        self._write_json("chunks.json", chunks)
+
+    def get_manifest(self) -> Optional[list[dict]]:
+        """
+        The name, offsets and content hash of every chunk, or None if the book was not split yet.
+        """
+        return self._read_json("manifest.json")
+
+    def put_manifest(self, manifest: list[dict]) -> None:
+        self._write_json("manifest.json", manifest)
+
+    @contextmanager
+    def in_use(self):
+        """
+        Mark the book as being processed in this process for the duration of the block.
+        compact leaves the files of a book in use alone, and restore should be called within the block.
+        Waits for a running compact of the same book to finish first.
+        """
+        with _books_in_use_lock:
+            _books_in_use_lock.wait_for(lambda: self.book_hash not in _books_compacting)
+            _books_in_use[self.book_hash] += 1
+        try:
+            yield self
+        finally:
+            with _books_in_use_lock:
+                _books_in_use[self.book_hash] -= 1
+                if _books_in_use[self.book_hash] <= 0:
+                    del _books_in_use[self.book_hash]
+
+    def compact(self, paths: Iterable[str] = ()) -> int:
+        """
+        Move small files of the book into the pack store: loose artifacts written before the pack store,
+        and paths, e.g. the preprocessed chunks once the audiobook is done. They are brought back with restore.
+        Nothing is moved while the book is in use, see in_use.
+
+        Args:
+            paths (Iterable[str]): Files in the directory of the book.
+
+        Returns:
+            int: The number of files moved.
+        """
+        moved = 0
+        # Only the check holds the lock, other books start and finish while the files are copied
+        with _books_in_use_lock:
+            if _books_in_use[self.book_hash] > 0 or self.book_hash in _books_compacting:
+                return moved
+            _books_compacting.add(self.book_hash)
+
+        try:
+            for path in [self.path(name) for name in PACKED_NAMES] + list(paths):
+                if not os.path.exists(path):
+                    continue
+
+                # A loose artifact is older than the one in the pack store, if there is one
+                name = os.path.relpath(path, self.directory)
+                if name not in PACKED_NAMES or self.store.get(self.book_hash, name) is None:
+                    with open(path, 'rb') as file:
+                        self.store.put(self.book_hash, name, file.read(), os.path.getmtime(path))
+                os.remove(path)
+                moved += 1
+        finally:
+            with _books_in_use_lock:
+                _books_compacting.discard(self.book_hash)
+                _books_in_use_lock.notify_all()
+        return moved
+
+    def restore(self) -> int:
+        """
+        Write the files moved into the pack store by compact back into the directory of the book,
+        with their modification times, so the caches that compare them, e.g. of speaker.speak_file, still hit.
+
+        Returns:
+            int: The number of files written.
+        """
+        restored = 0
+        for name in self.store.names(self.book_hash):
+            path = self.path(name)
+            if name in PACKED_NAMES or os.path.exists(path):
+                continue
+
+            data, mtime = self.store.get(self.book_hash, name)
+            write_atomic(path, data)
+            os.utime(path, (mtime, mtime))
+            restored += 1
+        return restored
@@ -0,0 +1,208 @@
+import os
+import json
+import mmap
+import hashlib
+import tempfile
+from typing import Iterable, Union
+
+from book_cache import CACHE_DIRECTORY, write_atomic
+
+SAMPLE_CHARACTERS = 4096
+BOOK_NAME = "book.txt"
+INDEX_NAME = "book_index.json"
+
+
+class BookStore:
+    """
+    The text of a book as a UTF-8 file on disk, read through a memory map instead of being held in memory.
+    It is sliced by characters like a str, e.g. store[start:stop], and only the slice is decoded.
+    An index next to the file has the byte offset of every SAMPLE_CHARACTERS-th character,
+    so a character is found by decoding at most SAMPLE_CHARACTERS characters.
+    The file is book.txt in the cache directory of the book, see book_cache.BookCache.
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a book written with BookStore.write.
+
+        Args:
+            path (str): The path of the text file.
+        """
+        self.path = path
+
+        with open(os.path.join(os.path.dirname(path), INDEX_NAME), 'r', encoding="utf-8") as file:
+            index = json.load(file)
+
+        self.book_hash = index["book_hash"]
+        self.length = index["length"]
+        self.byte_length = index["byte_length"]
+        self.page_offsets = index["page_offsets"]
+        self._samples = index["samples"]
+
+        self._file = open(path, 'rb')
+        # An empty file can not be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.byte_length else b""
+
+    @classmethod
+    def write(cls, pages: Iterable[str], root: str = CACHE_DIRECTORY) -> "BookStore":
+        """
+        Write the pages of a book into a BookStore, one page at a time.
+        The pages are streamed into a temporary file which is then moved into the cache directory of the book,
+        named by the md5 of the text like BookCache.
+
+        Args:
+            pages (Iterable[str]): The text of every page, e.g. from pdf_reader.iter_pages.
+            root (str): The directory containing the caches of all books.
+
+        Returns:
+            BookStore: The opened book.
+        """
+        os.makedirs(root, exist_ok=True)
+
+        digest = hashlib.md5()
+        page_offsets = [0]
+        samples = []
+        byte_length = 0
+
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=root, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                for page in pages:
+                    data = page.encode("utf-8")
+                    file.write(data)
+                    digest.update(data)
+
+                    # The samples within this page, each encoded from the one before, so the page is encoded once in total
+                    page_start = page_offsets[-1]
+                    position, byte_position = 0, byte_length
+                    for character in range(-(-page_start // SAMPLE_CHARACTERS) * SAMPLE_CHARACTERS, page_start + len(page), SAMPLE_CHARACTERS):
+                        offset = character - page_start
+                        byte_position += offset - position if len(data) == len(page) else len(page[position:offset].encode("utf-8"))
+                        position = offset
+                        samples.append(byte_position)
+
+                    byte_length += len(data)
+                    page_offsets.append(page_start + len(page))
+
+                file.flush()
+                os.fsync(file.fileno())
+
+            book_hash = digest.hexdigest()
+            directory = os.path.join(root, book_hash)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, BOOK_NAME)
+            os.replace(temporary_path, path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        write_atomic(os.path.join(directory, INDEX_NAME), json.dumps({
+            "book_hash": book_hash,
+            "length": page_offsets[-1],
+            "byte_length": byte_length,
+            "page_offsets": page_offsets,
+            "samples": samples,
+        }))
+        return cls(path)
+
+    @classmethod
+    def from_text(cls, text: str, root: str = CACHE_DIRECTORY) -> "BookStore":
+        """
+        Write a text that is already in memory into a BookStore.
+        """
+        return cls.write([text], root)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def byte_offset(self, character: int) -> int:
+        """
+        The byte offset in the file at which a character starts.
+        """
+        character = min(max(character, 0), self.length)
+        if self.byte_length == self.length:
+            return character
+        if character == self.length:
+            return self.byte_length
+
+        sample = character // SAMPLE_CHARACTERS
+        start = self._samples[sample]
+        remaining = character - sample * SAMPLE_CHARACTERS
+        if remaining == 0:
+            return start
+
+        # A character is at most 4 bytes, an incomplete character at the end is dropped
+        text = self._map[start:start + 4 * remaining].decode("utf-8", errors="ignore")[:remaining]
+        return start + len(text.encode("utf-8"))
+
+    def __getitem__(self, key: Union[int, slice]) -> str:
+        if isinstance(key, int):
+            if key < 0:
+                key += self.length
+            if not 0 <= key < self.length:
+                raise IndexError("book index out of range")
+            key = slice(key, key + 1)
+
+        start, stop, step = key.indices(self.length)
+        if step != 1:
+            raise ValueError("A book can only be sliced with step 1.")
+        if stop <= start:
+            return ""
+
+        return self._map[self.byte_offset(start):self.byte_offset(stop)].decode("utf-8")
+
+    def close(self) -> None:
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __getstate__(self) -> dict:
+        # Only the path is sent to other processes, they map the file themselves
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["path"])
+
+
+# A book is either its text or a BookStore, both are sliced by characters
+Book = Union[str, BookStore]
+
+
+def character_to_byte_offsets(book: Book, characters: list[int]) -> list[int]:
+    """
+    The byte offsets of the UTF-8 encoding of a book at which increasing character offsets start.
+    """
+    if isinstance(book, BookStore):
+        return [book.byte_offset(character) for character in characters]
+
+    if book.isascii():
+        return list(characters)
+
+    # One span at a time, so the book is encoded once in total
+    byte_offsets = []
+    previous_character, previous_byte = 0, 0
+    for character in characters:
+        previous_byte += len(book[previous_character:character].encode("utf-8"))
+        previous_character = character
+        byte_offsets.append(previous_byte)
+    return byte_offsets
+
+
+if __name__ == "__main__":
+    # Example usage
+    import random
+
+    pages = ["".join(random.choice("aäb €\n𝄞") for _ in range(random.randint(0, 9000))) for _ in range(20)]
+    text = "".join(pages)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = BookStore.write(pages, root=directory)
+        assert store.book_hash == hashlib.md5(text.encode()).hexdigest()
+        for _ in range(1000):
+            start = random.randint(0, len(text))
+            stop = random.randint(start, len(text))
+            assert store[start:stop] == text[start:stop]
+        assert character_to_byte_offsets(text, [0, 5000, len(text)]) == character_to_byte_offsets(store, [0, 5000, len(text)])
+        print(f"{len(store)} characters, {store.byte_length} bytes, slices identical to the str")
+        store.close()
@@ -0,0 +1,124 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mp3 import SILENT_FRAME
+
+
+def fake_audio(text: str) -> bytes:
+    """
+    Deterministic stand-in audio for a text: one silent mp3 frame per 20 characters.
+    """
+    return SILENT_FRAME * (len(text) // 20 + 1)
+
+
+def start_fake_speech_server(latency: float = 0.0, port: int = 0, requests_per_second: float = 0.0) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Start a local HTTP server that answers like the speech endpoint of the OpenAI API.
+    Every request waits latency seconds and is answered with fake_audio of its input.
+    Set OPENAI_BASE_URL to the returned url to use it with speaker.py.
+    With requests_per_second, requests above that rate are throttled like by the API:
+    answered with 429 and a Retry-After header. server.throttled counts them.
+    server.peak is the most requests that were answered at the same time.
+
+    Args:
+        latency (float): The time in seconds every request takes.
+        port (int): The port to listen on. 0 picks a free port.
+        requests_per_second (float): The rate above which requests are throttled. 0 never throttles.
+
+    Returns:
+        tuple[ThreadingHTTPServer, str]: The running server and its base url.
+    """
+    lock = threading.Lock()
+    bucket = {"tokens": requests_per_second, "time": time.monotonic()}
+
+    def throttle() -> bool:
+        if requests_per_second <= 0:
+            return False
+
+        with lock:
+            now = time.monotonic()
+            bucket["tokens"] = min(requests_per_second, bucket["tokens"] + (now - bucket["time"]) * requests_per_second)
+            bucket["time"] = now
+            if bucket["tokens"] < 1:
+                server.throttled += 1
+                return True
+            bucket["tokens"] -= 1
+            return False
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+
+            if not self.path.endswith("/audio/speech"):
+                self.send_error(404)
+                return
+
+            if throttle():
+                body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode()
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            with lock:
+                server.running += 1
+                server.peak = max(server.peak, server.running)
+            try:
+                time.sleep(latency)
+            finally:
+                with lock:
+                    server.running -= 1
+            body = fake_audio(request.get("input", ""))
+
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.throttled = 0
+    server.running = server.peak = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    # Speak a few chunks concurrently against the fake server
+    import os
+    import tempfile
+
+    server, base_url = start_fake_speech_server(latency=0.5)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+    from speaker import speak_files
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(8):
+            paths.append(os.path.join(directory, f"chunk_{i}_preprocessed.txt"))
+            with open(paths[-1], 'w', encoding="utf-8") as file:
+                file.write(f"Kapitel {i}. " * 50)
+
+        start = time.perf_counter()
+        spoken_files = speak_files(paths, max_in_flight=4)
+        print(f"{len(spoken_files)} chunks in {time.perf_counter() - start:.2f}s")
+
+        for path, spoken_file in zip(paths, spoken_files):
+            with open(path, 'r', encoding="utf-8") as file:
+                expected = fake_audio(file.read())
+            with open(spoken_file, 'rb') as file:
+                assert file.read() == expected, spoken_file
+
+    server.shutdown()
@@ -0,0 +1,86 @@
+import os
+import json
+import threading
+from typing import Any
+
+from book_cache import write_atomic
+
+JOURNAL_NAME = "journal.json"
+
+
+class Journal:
+    """
+    The journal of a book: every completed unit of work, e.g. every located table of contents entry,
+    every cleaned chunk and every written audio piece. A unit is only recorded after its result is on disk,
+    so after a crash the journal tells exactly which work can be kept.
+    The journal is a JSON file which is rewritten atomically after every unit.
+    Units are grouped by kind, e.g. "located", and identified by a key within their kind.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the journal file, usually in the cache directory of the book.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._units = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding="utf-8") as file:
+                    self._units = json.load(file)
+            except ValueError:
+                # Can only happen if the file was changed by hand, the journal is written atomically
+                self._units = {}
+
+    def get(self, kind: str, key: str, default: Any = None) -> Any:
+        """
+        The value recorded for a unit, or default if it is not done.
+        """
+        with self._lock:
+            return self._units.get(kind, {}).get(key, default)
+
+    def done(self, kind: str, key: str) -> bool:
+        """
+        Whether a unit was recorded.
+        """
+        with self._lock:
+            return key in self._units.get(kind, {})
+
+    def record(self, kind: str, key: str, value: Any = True) -> None:
+        """
+        Record a completed unit with a value, e.g. its result or the hash of its input.
+        """
+        with self._lock:
+            self._units.setdefault(kind, {})[key] = value
+            write_atomic(self.path, json.dumps(self._units, ensure_ascii=False))
+
+    def reset(self) -> None:
+        """
+        Forget all units, for a run that does not resume.
+        """
+        with self._lock:
+            self._units = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def count(self, kind: str) -> int:
+        """
+        The number of recorded units of a kind.
+        """
+        with self._lock:
+            return len(self._units.get(kind, {}))
+
+
+if __name__ == "__main__":
+    # Example usage
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        journal = Journal(os.path.join(directory, JOURNAL_NAME))
+        journal.record("located", "0:Kapitel 1", 169)
+        journal.record("pieces", "chunk.part000-abcdef12.mp3")
+
+        resumed = Journal(journal.path)
+        print(resumed.get("located", "0:Kapitel 1"), resumed.done("pieces", "chunk.part000-abcdef12.mp3"), resumed.count("located"))
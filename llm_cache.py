@@ -0,0 +1,135 @@
+import os
+import json
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from book_cache import CACHE_DIRECTORY, write_atomic
+
+# The response cache is a directory of the cache directory, next to the caches of the books
+LLM_CACHE_NAME = "llm"
+LLM_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, LLM_CACHE_NAME)
+MAX_LLM_CACHE_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    A cache for the answers of the language model, shared by all books.
+    Entries are keyed by the model, the context, the prompt and the expected return type,
+    and stored as zlib compressed JSON, one file per entry.
+    When the entries exceed max_bytes in total, the least recently used ones are evicted.
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = MAX_LLM_CACHE_BYTES, root: Optional[str] = None):
+        """
+        Args:
+            directory (Optional[str]): The directory of the entries. The llm directory of root by default.
+            max_bytes (int): The maximum size of all entries together.
+            root (Optional[str]): The directory containing the caches of all books. CACHE_DIRECTORY by default.
+        """
+        self.directory = os.path.abspath(directory or os.path.join(root or CACHE_DIRECTORY, LLM_CACHE_NAME))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        # key -> size, from least to most recently used. The modification time of an entry is its last use.
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+        found = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if name.endswith(".zjson"):
+                        status = os.stat(os.path.join(root, name))
+                        found.append((status.st_mtime, name[:-len(".zjson")], status.st_size))
+
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+
+    @staticmethod
+    def key(model: str, context: str, prompt: str, return_type: Any) -> str:
+        """
+        The key of an answer: a hash of everything that determines it.
+        """
+        digest = hashlib.sha256()
+        for part in (model, context, prompt, repr(return_type)):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.zjson")
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        Look up an answer.
+
+        Returns:
+            tuple[bool, Any]: Whether the answer was cached, and the answer.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = json.loads(zlib.decompress(file.read()))
+            os.utime(path)
+        except (FileNotFoundError, zlib.error, ValueError):
+            with self._lock:
+                self.misses += 1
+            return False, None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return True, value
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store an answer and evict the least recently used answers if the cache is too large.
+        """
+        data = zlib.compress(json.dumps(value, ensure_ascii=False).encode(), 9)
+        write_atomic(self._path(key), data)
+
+        with self._lock:
+            self._bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        """
+        The hits, misses, hit rate, number of entries and total size of the cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+if __name__ == "__main__":
+    # Example usage
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResponseCache(root=directory, max_bytes=2000)
+        for i in range(20):
+            cache.put(ResponseCache.key("model", "context", f"prompt {i}", str), "".join(hashlib.sha256(f"{i}:{j}".encode()).hexdigest() for j in range(4)))
+        print(cache.get(ResponseCache.key("model", "context", "prompt 19", str)))
+        print(cache.get(ResponseCache.key("model", "context", "prompt 0", str)))
+        print(cache.stats())
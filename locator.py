@@ -0,0 +1,165 @@
+import re
+from typing import Iterator, Optional
+
+from book_store import Book
+
+MAX_CANDIDATES_PER_NAME = 200
+PAGE_HINT_TOLERANCE = 5000
+CONFIDENT_SCORE = 2.0
+SCAN_WINDOW_CHARACTERS = 1 << 20
+SCAN_WINDOW_OVERLAP = 2000
+
+
+def _name_pattern(name: str) -> Optional[str]:
+    """
+    A regex for a heading: the words of the name, case-insensitive, with any whitespace or punctuation in between.
+    """
+    words = re.findall(r"\w+", name)
+    if not words:
+        return None
+    return r"\W+".join(re.escape(word) for word in words) + r"(?!\w)"
+
+
+def _iter_windows(book: Book) -> Iterator[tuple[int, str, int]]:
+    """
+    The book in overlapping windows, so a BookStore is never decoded as a whole.
+    Yields the character at which a window starts, its text, and the length of the part
+    a match has to start in, the rest is the overlap with the next window.
+    """
+    for window_start in range(0, max(len(book), 1), SCAN_WINDOW_CHARACTERS):
+        yield window_start, book[window_start:window_start + SCAN_WINDOW_CHARACTERS + SCAN_WINDOW_OVERLAP], SCAN_WINDOW_CHARACTERS
+
+
+def _score(text: str, start: int, end: int, position: int, book_length: int, page_hint: Optional[int]) -> float:
+    """
+    How much an occurrence of a name, text[start:end] at the character position of the book, looks like the heading of its section.
+    """
+    line_start = text.rfind("\n", 0, start) + 1
+    line_end = text.find("\n", end)
+    line_end = len(text) if line_end == -1 else line_end
+    before = text[line_start:start]
+    after = text[end:line_end]
+
+    score = 1.0
+    if not before.strip():
+        score += 1.0
+    if not after.strip():
+        score += 1.0
+
+    # A line of the table of contents: the name followed by dots and a page number
+    if re.fullmatch(r"[\s.·…_-]*\d+\s*", after):
+        score -= 3.0
+
+    if page_hint is not None and abs(position - page_hint) <= PAGE_HINT_TOLERANCE:
+        score += 2.0
+
+    # Prefer earlier occurrences, e.g. over a running header repeating the name later
+    return score - 0.001 * position / max(book_length, 1)
+
+
+def locate_headings(book: Book, names: list[str], page_hints: Optional[list[Optional[int]]] = None) -> list[Optional[int]]:
+    """
+    Find where the headings of the flattened table of contents start in the book, without a language model.
+    All names are searched at once in a single scan of the book, window by window. From all occurrences, one per name is chosen
+    such that the positions increase in table of contents order and the occurrences look like headings
+    (own line, no page number after it, close to the page from the table of contents).
+
+    Args:
+        book (Book): The text of the book, or its BookStore.
+        names (list[str]): The names of the entries of the flattened table of contents, in order.
+        page_hints (Optional[list[Optional[int]]]): Per entry, the character at which its page starts, if known.
+
+    Returns:
+        list[Optional[int]]: Per entry, the character at which its heading starts,
+            or None if it could not be placed confidently.
+    """
+    page_hints = page_hints or [None] * len(names)
+
+    # One alternative per distinct name, longer names first so they win over their prefixes
+    patterns = {}
+    for index, name in enumerate(names):
+        pattern = _name_pattern(name)
+        if pattern is not None:
+            patterns.setdefault(pattern, []).append(index)
+
+    ordered_patterns = sorted(patterns, key=len, reverse=True)
+    if not ordered_patterns:
+        return [None] * len(names)
+
+    scanner = re.compile("|".join(f"(?P<p{i}>{pattern})" for i, pattern in enumerate(ordered_patterns)), re.IGNORECASE)
+
+    # Candidates per entry: (position, score)
+    candidates = [[] for _ in names]
+    for window_start, text, window_length in _iter_windows(book):
+        for match in scanner.finditer(text):
+            if match.start() >= window_length:
+                break
+
+            indices = patterns[ordered_patterns[int(match.lastgroup[1:])]]
+            if len(candidates[indices[0]]) >= MAX_CANDIDATES_PER_NAME:
+                continue
+
+            for index in indices:
+                score = _score(text, match.start(), match.end(), window_start + match.start(), len(book), page_hints[index])
+                candidates[index].append((window_start + match.start(), score))
+
+    # Heaviest increasing chain, with a Fenwick tree over the positions for the best chain ending before a position
+    positions = sorted({position for entry in candidates for position, _ in entry})
+    rank = {position: i for i, position in enumerate(positions)}
+    tree = [(0.0, None)] * (len(positions) + 1)
+
+    def best_before(i: int) -> tuple[float, Optional[tuple[int, int]]]:
+        best = (0.0, None)
+        while i > 0:
+            if tree[i][0] > best[0]:
+                best = tree[i]
+            i -= i & -i
+        return best
+
+    def update(i: int, value: tuple[float, tuple[int, int]]) -> None:
+        i += 1
+        while i <= len(positions):
+            if value[0] > tree[i][0]:
+                tree[i] = value
+            i += i & -i
+
+    chain = {}
+    best = (0.0, None)
+    for index, entry in enumerate(candidates):
+        scored = []
+        for candidate, (position, score) in enumerate(entry):
+            if score <= 0:
+                continue
+            previous_score, previous = best_before(rank[position])
+            chain[(index, candidate)] = previous
+            scored.append((rank[position], (previous_score + score, (index, candidate))))
+
+        # Only update after scoring, so a chain uses at most one occurrence per entry
+        for position_rank, value in scored:
+            update(position_rank, value)
+            if value[0] > best[0]:
+                best = value
+
+    located = [None] * len(names)
+    node = best[1]
+    while node is not None:
+        index, candidate = node
+        position, score = candidates[index][candidate]
+        if score >= CONFIDENT_SCORE:
+            located[index] = position
+        node = chain[node]
+
+    return located
+
+
+if __name__ == "__main__":
+    # Example usage
+    book = (
+        "Inhalt\nEinleitung ..... 1\nKapitel 1: Das Haus ..... 2\nKapitel 2: Die Stadt ..... 3\n"
+        "Einleitung\nEs war einmal. Kapitel 2: Die Stadt wird später wichtig.\n"
+        "Kapitel 1: Das Haus\nDas Haus stand am Fluss.\n"
+        "Kapitel 2:  Die  Stadt\nDie Stadt war laut.\n"
+    )
+    names = ["Einleitung", "Kapitel 1: Das Haus", "Kapitel 2: Die Stadt", "Nachwort"]
+    for name, position in zip(names, locate_headings(book, names)):
+        print(name, position, repr(book[position:position + 30]) if position is not None else None)
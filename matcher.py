@@ -0,0 +1,136 @@
+from collections import Counter
+
+from fuzzywuzzy import fuzz
+
+ANCHOR_NGRAM_LENGTH = 4
+# A short needle with a single change may have no 4-gram left in common with the text, 2-grams survive far more changes
+MIN_ANCHOR_NGRAM_LENGTH = 2
+MAX_SCORED_CANDIDATES = 64
+
+
+def vote_offsets(main_string: str, sub_string: str, ngram_length: int) -> Counter:
+    """
+    Every n-gram of sub_string found in main_string votes for the offset at which sub_string would start.
+
+    Returns:
+        Counter: The number of votes of every offset.
+    """
+    length = len(sub_string)
+    last_offset = len(main_string) - length
+
+    # Remember at which positions of sub_string every n-gram occurs
+    ngram_positions = {}
+    for position in range(length - ngram_length + 1):
+        ngram_positions.setdefault(sub_string[position:position + ngram_length], []).append(position)
+
+    # Every exact hit of an n-gram votes for the offsets it implies
+    votes = Counter()
+    for ngram, positions in ngram_positions.items():
+        hit = main_string.find(ngram)
+        while hit != -1:
+            for position in positions:
+                offset = hit - position
+                if 0 <= offset <= last_offset:
+                    votes[offset] += 1
+            hit = main_string.find(ngram, hit + 1)
+    return votes
+
+
+def find_best_match(main_string: str, sub_string: str, tolerance: int = 70) -> tuple[bool, int, int]:
+    """
+    Find the position in main_string that matches sub_string best.
+    Instead of scoring every offset, the offsets are prefiltered with exact n-gram hits, see vote_offsets.
+    Only the offsets with the most votes are scored with fuzz.partial_ratio.
+    If none of them reaches the tolerance, the votes are repeated with shorter n-grams,
+    e.g. for a needle of a few characters where a single change breaks every 4-gram,
+    and the offsets next to the best one are scored as well.
+    Unlike the naive scan, an offset without any n-gram in common with sub_string is never scored,
+    so a match without a single 2-gram in common with sub_string, i.e. with about every other character changed, is not found.
+
+    Args:
+        main_string (str): The text to search in.
+        sub_string (str): The text to search for.
+        tolerance (int): The minimum similarity (0-100) for a match.
+
+    Returns:
+        tuple[bool, int, int]: Whether the best score reaches the tolerance, the offset of the best match
+            and its score. (False, -1, 0) if there is no candidate at all.
+    """
+    length = len(sub_string)
+    if length == 0 or len(main_string) < length:
+        return False, -1, 0
+
+    best_offset, best_score = -1, -1
+    scored = set()
+
+    def score(offset: int) -> None:
+        nonlocal best_offset, best_score
+        if offset in scored:
+            return
+        scored.add(offset)
+        similarity = fuzz.partial_ratio(main_string[offset:offset + length], sub_string)
+        if similarity > best_score or (similarity == best_score and offset < best_offset):
+            best_offset, best_score = offset, similarity
+
+    for ngram_length in sorted({min(ANCHOR_NGRAM_LENGTH, length), min(MIN_ANCHOR_NGRAM_LENGTH, length)}, reverse=True):
+        votes = vote_offsets(main_string, sub_string, ngram_length)
+        for offset, _ in sorted(votes.items(), key=lambda item: (-item[1], item[0]))[:MAX_SCORED_CANDIDATES]:
+            score(offset)
+        if best_score >= tolerance:
+            break
+
+    # partial_ratio aligns the window with sub_string itself, so its best score may lie a few characters beside the votes
+    if -1 < best_score < tolerance:
+        for offset in range(max(0, best_offset - ANCHOR_NGRAM_LENGTH), min(len(main_string) - length, best_offset + ANCHOR_NGRAM_LENGTH) + 1):
+            score(offset)
+
+    if best_offset == -1:
+        return False, -1, 0
+    return best_score >= tolerance, best_offset, best_score
+
+
+def find_substring_with_tolerance_naive(main_string: str, sub_string: str, tolerance: int = 70) -> tuple[bool, int, int]:
+    """
+    The original sliding window matcher. Scores every offset and returns the first one reaching the tolerance.
+    Kept as a reference for find_best_match.
+    """
+    for i in range(len(main_string) - len(sub_string) + 1):
+        substring = main_string[i:i + len(sub_string)]
+        similarity = fuzz.partial_ratio(substring, sub_string)
+        if similarity >= tolerance:
+            return True, i, similarity
+    return False, -1, 0
+
+
+if __name__ == "__main__":
+    # Compare against the original matcher on random texts with distorted needles
+    import random
+    import string
+    import time
+
+    random.seed(0)
+    words = ["".join(random.choices(string.ascii_lowercase, k=random.randint(2, 9))) for _ in range(300)]
+
+    fast_time = naive_time = 0.0
+    for i in range(20):
+        text = " ".join(random.choices(words, k=400))
+        start = random.randrange(len(text) - 120)
+        needle = list(text[start:start + random.randint(30, 120)])
+        for _ in range(len(needle) // 15):
+            needle[random.randrange(len(needle))] = random.choice(string.ascii_lowercase)
+        needle = "".join(needle)
+
+        t = time.perf_counter()
+        fast = find_best_match(text, needle, tolerance=80)
+        fast_time += time.perf_counter() - t
+
+        t = time.perf_counter()
+        naive = find_substring_with_tolerance_naive(text, needle, tolerance=80)
+        naive_time += time.perf_counter() - t
+
+        # The best match is found whenever the first match is, and it scores at least as high
+        assert fast[0] or not naive[0], (i, fast, naive)
+        assert fast[2] >= naive[2], (i, fast, naive)
+        print(f"round {i}: naive {naive}, fast {fast}, planted at {start}")
+
+    print(f"naive: {naive_time:.3f}s, fast: {fast_time:.3f}s")
@@ -0,0 +1,143 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+COUNTERS = ["bytes_in", "bytes_out", "tokens", "retries", "cache_hits", "cache_misses"]
+
+_lock = threading.Lock()
+_event_log = None
+_quiet = False
+_verbose = False
+_totals = {}
+
+
+def configure(event_log: Optional[str] = None, quiet: bool = False, verbose: bool = False) -> None:
+    """
+    Configure the instrumentation of the pipeline.
+
+    Args:
+        event_log (Optional[str]): The path of a JSON lines file every event is appended to. None writes no events.
+        quiet (bool): Suppress the progress messages of log.
+        verbose (bool): Also show the messages of debug, e.g. the parts of the book the LLM is searching in.
+    """
+    global _event_log, _quiet, _verbose
+
+    with _lock:
+        if _event_log is not None:
+            _event_log.close()
+            _event_log = None
+
+        if event_log is not None:
+            import os
+            os.makedirs(os.path.dirname(event_log) or ".", exist_ok=True)
+            _event_log = open(event_log, 'a', encoding="utf-8")
+
+        _quiet = quiet
+        _verbose = verbose and not quiet
+
+
+def log(*args) -> None:
+    """
+    Print a progress message, unless the run is quiet.
+    """
+    if not _quiet:
+        print(*args)
+
+
+def debug(*args) -> None:
+    """
+    Print a debug message, only if the run is verbose.
+    """
+    if _verbose:
+        print(*args)
+
+
+def record(stage: str, duration: float = 0.0, **fields) -> None:
+    """
+    Record an event of a stage: add it to the totals of the stage and write it to the event log.
+
+    Args:
+        stage (str): The name of the stage, e.g. "preprocess".
+        duration (float): The wall time in seconds.
+        **fields: The counters (see COUNTERS) and any further information, e.g. the path of a chunk.
+    """
+    event = {"time": time.time(), "stage": stage, "duration": round(duration, 6), **fields}
+
+    with _lock:
+        totals = _totals.setdefault(stage, dict.fromkeys(["events", "duration", *COUNTERS], 0))
+        totals["events"] += 1
+        totals["duration"] += duration
+        for counter in COUNTERS:
+            totals[counter] += fields.get(counter, 0) or 0
+
+        if _event_log is not None:
+            _event_log.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+            _event_log.flush()
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[dict]:
+    """
+    Measure the wall time of a block and record it as an event of a stage.
+    The block can add counters and information to the yielded dict, e.g. event["cache_hits"] = 1.
+    If the block raises, the event is recorded with the error.
+
+    Args:
+        name (str): The name of the stage.
+        **fields: Initial fields of the event.
+    """
+    event = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException as error:
+        event["error"] = repr(error)
+        raise
+    finally:
+        record(name, time.perf_counter() - start, **event)
+
+
+def summary() -> str:
+    """
+    A table with the totals of every stage recorded so far.
+    """
+    columns = ["stage", "events", "duration", *COUNTERS]
+    rows = [columns]
+    with _lock:
+        for name, totals in _totals.items():
+            rows.append([name, str(totals["events"]), f"{totals['duration']:.2f}s", *(str(totals[counter]) for counter in COUNTERS)])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows]
+    lines.insert(1, "  ".join("-" * width for width in widths))
+    return "\n".join(lines)
+
+
+def get_totals() -> dict[str, dict]:
+    """
+    A copy of the totals of every stage recorded so far.
+    """
+    with _lock:
+        return {name: dict(stage_totals) for name, stage_totals in _totals.items()}
+
+
+def reset() -> None:
+    """
+    Forget the totals of all stages.
+    """
+    with _lock:
+        _totals.clear()
+
+
+if __name__ == "__main__":
+    # Example usage
+    configure(event_log=None)
+    with stage("extract", path="book.pdf") as event:
+        time.sleep(0.1)
+        event["bytes_in"] = 1024
+        event["bytes_out"] = 512
+    record("preprocess", 0.5, tokens=300, cache_misses=1)
+    record("preprocess", 0.0, cache_hits=1)
+    print(summary())
@@ -0,0 +1,163 @@
+import os
+import tempfile
+from typing import BinaryIO, Iterator, Optional
+
+from book_cache import write_atomic
+
+# Bitrates in kbit/s by (MPEG-1?, layer), indexed by the bitrate bits of the frame header
+BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates in Hz by the version bits of the frame header
+SAMPLE_RATES = {
+    0b11: [44100, 48000, 32000],  # MPEG-1
+    0b10: [22050, 24000, 16000],  # MPEG-2
+    0b00: [11025, 12000, 8000],  # MPEG-2.5
+}
+
+# A silent MPEG-1 Layer III frame: 128 kbit/s, 44.1 kHz, 417 bytes
+SILENT_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+
+
+def parse_frame_header(header: bytes) -> Optional[tuple[int, int, int]]:
+    """
+    Parse the 4 byte header of an MPEG audio frame.
+
+    Args:
+        header (bytes): The first 4 bytes of the frame.
+
+    Returns:
+        Optional[tuple[int, int, int]]: The length of the frame in bytes, the number of samples in the frame
+            and the sample rate. None if the bytes are not a valid frame header.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+
+    version = (header[1] >> 3) & 0b11
+    layer = 4 - ((header[1] >> 1) & 0b11)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0b11
+    padding = (header[2] >> 1) & 0b1
+
+    if version == 0b01 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 0b11
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 2 or mpeg1:
+        return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+    return 72 * bitrate // sample_rate + padding, 576, sample_rate
+
+
+def id3v2_size(header: bytes) -> int:
+    """
+    The total size of an ID3v2 tag starting with header, or 0 if header does not start a tag.
+    """
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_frames(file: BinaryIO) -> Iterator[tuple[bytes, int, int]]:
+    """
+    Iterate over the audio frames of an mp3 stream without decoding them.
+    ID3 tags and the Xing/Info/VBRI header frame of encoders are skipped, garbage between frames is skipped.
+    Only one frame is held in memory at a time.
+
+    Args:
+        file (BinaryIO): The mp3 file opened in binary mode.
+
+    Yields:
+        tuple[bytes, int, int]: The frame, the number of samples in it and its sample rate.
+    """
+    header = file.read(10)
+    tag_size = id3v2_size(header)
+    if tag_size:
+        file.seek(tag_size - len(header), os.SEEK_CUR)
+        header = b""
+
+    buffer = header
+    first_frame = True
+
+    while True:
+        buffer += file.read(4 - len(buffer)) if len(buffer) < 4 else b""
+        if len(buffer) < 4 or buffer[:3] == b"TAG":
+            return
+
+        parsed = parse_frame_header(buffer[:4])
+        if parsed is None:
+            # Lost the sync, move on by one byte
+            buffer = buffer[1:]
+            continue
+
+        frame_length, samples, sample_rate = parsed
+        frame = buffer[:frame_length] + file.read(frame_length - len(buffer[:frame_length]))
+        buffer = buffer[frame_length:]
+        if len(frame) < frame_length:
+            return
+
+        if first_frame:
+            first_frame = False
+            if b"Xing" in frame[:64] or b"Info" in frame[:64] or b"VBRI" in frame[:64]:
+                continue
+
+        yield frame, samples, sample_rate
+
+
+def duration(path: str) -> float:
+    """
+    The duration of an mp3 file in seconds, from the frame headers.
+    """
+    with open(path, 'rb') as file:
+        return sum(samples / sample_rate for _, samples, sample_rate in iter_frames(file))
+
+
+def concatenate(paths: list[str], output: str) -> None:
+    """
+    Join mp3 files into one by copying their audio frames. Nothing is decoded or re-encoded.
+    Tags and encoder header frames of the inputs are dropped, so players see one continuous stream.
+    The output is written atomically.
+
+    Args:
+        paths (list[str]): The mp3 files in order.
+        output (str): The path of the joined mp3 file.
+    """
+    directory = os.path.dirname(output) or "."
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(output)}.", suffix=".tmp")
+
+    try:
+        with os.fdopen(file_descriptor, 'wb') as out:
+            for path in paths:
+                with open(path, 'rb') as file:
+                    for frame, _, _ in iter_frames(file):
+                        out.write(frame)
+        os.replace(temporary_path, output)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+if __name__ == "__main__":
+    # Example usage: join two generated streams and check the duration adds up
+    with tempfile.TemporaryDirectory() as directory:
+        first, second, joined = (os.path.join(directory, name) for name in ("a.mp3", "b.mp3", "ab.mp3"))
+        write_atomic(first, b"ID3\x03\x00\x00\x00\x00\x00\x05" + bytes(5) + SILENT_FRAME * 10)
+        write_atomic(second, SILENT_FRAME * 20 + b"TAG" + bytes(125))
+
+        concatenate([first, second], joined)
+        print(f"{duration(first):.3f}s + {duration(second):.3f}s = {duration(joined):.3f}s")
+        assert os.path.getsize(joined) == 30 * len(SILENT_FRAME)
@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import time
+import zlib
+import shutil
+import sqlite3
+import threading
+from typing import Optional
+
+from metrics import log, record
+
+PACK_NAME = "pack.sqlite"
+
+# Books used more recently than this are never evicted, they may be processed right now
+MIN_IDLE_SECONDS = 600
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+class PackStore:
+    """
+    The small artifacts of all books in a single SQLite file in the cache directory, instead of many small files:
+    the tables of contents, the manifests and the preprocessed chunks, see book_cache.BookCache,
+    and the extracted text of every PDF page, see pdf_reader.extract_book.
+    Artifacts are stored zlib compressed and identified by the hash of their book and their name.
+    The last use of every book is kept for the garbage collection, see collect_garbage.
+    Thread safe. Every process opens its own connection, see get_pack_store.
+    The default rollback journal is used and not WAL, whose shared memory index does not work on network filesystems,
+    where the cache directory may live for the work queue, see work_queue.py.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The path of the SQLite file. It is created if it does not exist.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            # A store created in WAL mode by an earlier version stays in it until it is switched back
+            self._connection.execute("PRAGMA journal_mode=DELETE")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS artifacts (book TEXT, name TEXT, data BLOB, size INTEGER, mtime REAL, PRIMARY KEY (book, name))")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS books (book TEXT PRIMARY KEY, last_used REAL)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, book TEXT, data BLOB)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS sources (fingerprint TEXT PRIMARY KEY, book TEXT, outline TEXT)")
+
+    def _execute(self, statement: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._connection.execute(statement, parameters).fetchall()
+
+    def touch(self, book_hash: str) -> None:
+        """
+        Record that a book is used now.
+        """
+        self._execute("INSERT INTO books VALUES (?, ?) ON CONFLICT (book) DO UPDATE SET last_used = excluded.last_used", (book_hash, time.time()))
+
+    def last_used(self, book_hash: str) -> Optional[float]:
+        rows = self._execute("SELECT last_used FROM books WHERE book = ?", (book_hash,))
+        return rows[0][0] if rows else None
+
+    def get(self, book_hash: str, name: str) -> Optional[tuple[bytes, float]]:
+        """
+        An artifact of a book and its modification time, or None if it is not stored.
+        """
+        rows = self._execute("SELECT data, mtime FROM artifacts WHERE book = ? AND name = ?", (book_hash, name))
+        if not rows:
+            return None
+        return zlib.decompress(rows[0][0]), rows[0][1]
+
+    def put(self, book_hash: str, name: str, data: bytes, mtime: Optional[float] = None) -> None:
+        """
+        Store an artifact of a book, replacing an older one with the same name.
+        mtime is the modification time of the file it was packed from, restored with it, see BookCache.restore.
+        """
+        packed = zlib.compress(data, 6)
+        self._execute("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)", (book_hash, name, packed, len(packed), mtime or time.time()))
+
+    def names(self, book_hash: str, prefix: str = "") -> list[str]:
+        """
+        The names of the artifacts of a book starting with prefix.
+        """
+        rows = self._execute("SELECT name FROM artifacts WHERE book = ? AND substr(name, 1, ?) = ? ORDER BY name", (book_hash, len(prefix), prefix))
+        return [name for name, in rows]
+
+    def get_page(self, key: str) -> Optional[str]:
+        """
+        The cached text of a PDF page, see pdf_reader.page_key.
+        """
+        rows = self._execute("SELECT data FROM pages WHERE key = ?", (key,))
+        return zlib.decompress(rows[0][0]).decode("utf-8") if rows else None
+
+    def cached_pages(self, keys: list[str]) -> set[str]:
+        """
+        The keys of the pages that are cached, without reading their text.
+        """
+        found = set()
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self._execute(f"SELECT key FROM pages WHERE key IN ({', '.join('?' * len(batch))})", tuple(batch))
+            found.update(key for key, in rows)
+        return found
+
+    def put_page(self, key: str, text: str) -> None:
+        """
+        Cache the text of a PDF page. It belongs to no book until assign_pages, the garbage collection keeps it until then.
+        """
+        self._execute("INSERT OR REPLACE INTO pages VALUES (?, '', ?)", (key, zlib.compress(text.encode("utf-8"), 6)))
+
+    def assign_pages(self, keys: list[str], book_hash: str) -> None:
+        """
+        Make the cached pages part of a book, so they are evicted with it.
+        A page shared with an earlier version of the book moves to the newer one.
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                self._connection.executemany("UPDATE pages SET book = ? WHERE key = ?", [(book_hash, key) for key in keys])
+
+    def get_source(self, fingerprint: str) -> Optional[tuple[str, Optional[list]]]:
+        """
+        The book and the outline extracted from a PDF file with this fingerprint, see pdf_reader.file_fingerprint.
+        """
+        rows = self._execute("SELECT book, outline FROM sources WHERE fingerprint = ?", (fingerprint,))
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def put_source(self, fingerprint: str, book_hash: str, outline: Optional[list]) -> None:
+        self._execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (fingerprint, book_hash, json.dumps(outline, ensure_ascii=False)))
+
+    def books(self) -> dict[str, tuple[int, Optional[float]]]:
+        """
+        The size of the stored artifacts and pages and the last use of every book in the store.
+        Pages that belong to no book yet are listed under "".
+        """
+        books = {book: (0, last_used) for book, last_used in self._execute("SELECT book, last_used FROM books")}
+        for table in ("artifacts", "pages"):
+            for book, size in self._execute(f"SELECT book, SUM(LENGTH(data)) FROM {table} GROUP BY book"):
+                previous_size, last_used = books.get(book, (0, None))
+                books[book] = (previous_size + size, last_used)
+        for book, in self._execute("SELECT DISTINCT book FROM sources"):
+            books.setdefault(book, (0, None))
+        return books
+
+    def delete_book(self, book_hash: str) -> None:
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                for table in ("artifacts", "books", "pages", "sources"):
+                    self._connection.execute(f"DELETE FROM {table} WHERE book = ?", (book_hash,))
+
+    def vacuum(self) -> None:
+        """
+        Give the space of deleted artifacts back to the filesystem.
+        """
+        self._execute("VACUUM")
+
+    def size(self) -> int:
+        """
+        The bytes of the SQLite file, with its journal or write-ahead log if there is one.
+        """
+        size = 0
+        for path in (self.path, f"{self.path}-journal", f"{self.path}-wal"):
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_stores_lock = threading.Lock()
+_stores = {}
+
+
+def get_pack_store(root: str) -> PackStore:
+    """
+    The pack store of a cache directory, shared by all threads of the process.
+    """
+    key = (os.getpid(), os.path.abspath(root))
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = PackStore(os.path.join(root, PACK_NAME))
+        return _stores[key]
+
+
+def parse_size(size: str) -> int:
+    """
+    A size like "500M", "2G" or "1.5GB" in bytes.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"Not a size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def directory_size(path: str) -> int:
+    size = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def collect_garbage(budget: int, root: Optional[str] = None, min_idle_seconds: float = MIN_IDLE_SECONDS) -> dict:
+    """
+    Evict the least recently used books from the cache directory until the books and the pack store fit into budget bytes.
+    A book is evicted as a whole: its directory, its artifacts in the pack store and its entries in the work queue.
+    Books used in the last min_idle_seconds are kept, and so are in-progress books, with their manifests and journals:
+    books whose journal was written or a chunk of which was leased in the work queue in the last min_idle_seconds,
+    by any process on any host. A book that failed for good is evicted like any other once it is idle,
+    so min_idle_seconds has to be longer than the lease_seconds of the queue.
+    The response cache of the language model, see llm_cache.py, has its own limit and is not counted.
+
+    Args:
+        budget (int): The maximum size of the books and the pack store in bytes.
+        root (Optional[str]): The directory containing the caches of all books. CACHE_DIRECTORY by default.
+        min_idle_seconds (float): Books used more recently are kept.
+
+    Returns:
+        dict: The bytes before and after, and the number of evicted and kept books.
+    """
+    from book_cache import BOOK_INDEX_NAME, CACHE_DIRECTORY, _book_index_lock, write_atomic
+    from journal import JOURNAL_NAME
+    from work_queue import WorkQueue
+
+    root = root or CACHE_DIRECTORY
+    store = get_pack_store(root)
+    packed = store.books()
+    now = time.time()
+
+    # The book is a directory of the path of a chunk
+    queue_directory = os.path.join(root, "queue")
+    leased = set()
+    if os.path.isdir(queue_directory):
+        for path in WorkQueue(queue_directory).leased_paths(max_age=min_idle_seconds):
+            leased.update(os.path.normpath(path).split(os.sep))
+
+    books = []
+    for name in os.listdir(root) if os.path.isdir(root) else []:
+        directory = os.path.join(root, name)
+        if not os.path.isdir(directory) or not re.fullmatch(r"[0-9a-f]{32}", name):
+            continue
+
+        packed_size, last_used = packed.pop(name, (0, None))
+        journal_path = os.path.join(directory, JOURNAL_NAME)
+        in_progress = name in leased or (os.path.exists(journal_path) and now - os.path.getmtime(journal_path) < min_idle_seconds)
+        books.append({"book": name, "bytes": directory_size(directory) + packed_size, "last_used": last_used or os.path.getmtime(directory), "in_progress": in_progress})
+
+    # Artifacts of books whose directory is gone can not be used anymore.
+    # Pages that belong to no book yet and books used just now, e.g. whose pages are being extracted, are kept.
+    orphans = [book_hash for book_hash, (_, last_used) in packed.items() if book_hash and (last_used is None or now - last_used >= min_idle_seconds)]
+    for book_hash in orphans:
+        store.delete_book(book_hash)
+
+    total = sum(book["bytes"] for book in books) + store.size()
+    result = {"bytes_before": total, "evicted": 0, "kept_in_progress": sum(book["in_progress"] for book in books)}
+
+    evicted = set()
+    for book in sorted(books, key=lambda book: book["last_used"]):
+        if total <= budget:
+            break
+        if book["in_progress"] or now - book["last_used"] < min_idle_seconds:
+            continue
+
+        shutil.rmtree(os.path.join(root, book["book"]), ignore_errors=True)
+        store.delete_book(book["book"])
+        evicted.add(book["book"])
+        total -= book["bytes"]
+
+    if evicted or orphans:
+        with _book_index_lock:
+            index_path = os.path.join(root, BOOK_INDEX_NAME)
+            if os.path.exists(index_path):
+                with open(index_path, 'r', encoding="utf-8") as file:
+                    index = json.load(file)
+                write_atomic(index_path, json.dumps({identity: book_hash for identity, book_hash in index.items() if book_hash not in evicted}, ensure_ascii=False, indent=1))
+        store.vacuum()
+
+    # Their done tasks would point to files that do not exist anymore
+    if evicted and os.path.isdir(queue_directory):
+        WorkQueue(queue_directory).remove_books(evicted)
+
+    result["evicted"] = len(evicted)
+    result["bytes_after"] = sum(book["bytes"] for book in books if book["book"] not in evicted) + store.size()
+    if result["bytes_after"] > budget:
+        log(f"The cache is still {result['bytes_after']} bytes, over the budget of {budget} bytes, only in-progress or recently used books are left.")
+
+    record("gc", bytes_in=result["bytes_before"], bytes_out=result["bytes_after"], evicted=result["evicted"])
+    return result
+
+
+if __name__ == "__main__":
+    # Example usage
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = get_pack_store(directory)
+        store.put("a" * 32, "toc.txt", "Inhalt\n1 Anfang 5\n".encode())
+        store.touch("a" * 32)
+        print(store.get("a" * 32, "toc.txt"), store.books())
+        print(parse_size("500M"), parse_size("1.5GB"))
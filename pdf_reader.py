@@ -1,30 +1,415 @@
+import os
+import hashlib
+from typing import Iterator, Optional
 
-def extract_text(path: str) -> str:
+from book_cache import CACHE_DIRECTORY
+from book_store import BOOK_NAME, BookStore
+from metrics import record
+from pack_store import get_pack_store
+
+PAGES_PER_SHARD_PER_WORKER = 4
+
+# Part of every key of the page cache. Raise it when the extracted text changes for the same PDF.
+EXTRACTION_VERSION = 1
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+# Parts of a page that do not change its text, so they are not hashed: embedded font programs and the page tree
+UNHASHED_KEYS = {"/FontFile", "/FontFile2", "/FontFile3", "/Parent"}
+
+
+def iter_pages(path: str) -> Iterator[str]:
     """
-    Main function to read a PDF file and extract text from it.
-    
+    Read a PDF file and yield the text of its pages one at a time.
+    Only the current page is held in memory, so the caller decides what to keep.
+
     Args:
         path (str): The path to the PDF file.
-    
-    Returns:
-        str: The extracted text from the PDF file.
+
+    Yields:
+        str: The extracted text of the next page.
     """
     import PyPDF2
 
     # Open the PDF file
     with open(path, 'rb') as file:
         reader = PyPDF2.PdfReader(file)
-        text = ""
-        
+
         # Iterate through each page and extract text
         for page in reader.pages:
-            text += page.extract_text()
-    
+            yield page.extract_text()
+
+
+def count_pages(path: str) -> int:
+    """
+    Count the pages of a PDF file without extracting any text.
+
+    Args:
+        path (str): The path to the PDF file.
+
+    Returns:
+        int: The number of pages.
+    """
+    import PyPDF2
+
+    with open(path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+
+def extract_page_range(path: str, start: int, stop: int) -> list[str]:
+    """
+    Extract the text of the pages start to stop (exclusive) of a PDF file.
+    Opens the file itself, so it can run in a worker process.
+
+    Args:
+        path (str): The path to the PDF file.
+        start (int): The first page (0-based).
+        stop (int): The page after the last page.
+
+    Returns:
+        list[str]: The extracted text of every page in the range.
+    """
+    import PyPDF2
+
+    with open(path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        return [reader.pages[i].extract_text() for i in range(start, stop)]
+
+
+def extract_pages(path: str, page_numbers: list[int]) -> list[str]:
+    """
+    Like extract_page_range, but for any pages, e.g. the ones missing from the page cache.
+    """
+    import PyPDF2
+
+    with open(path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        return [reader.pages[i].extract_text() for i in page_numbers]
+
+
+def iter_pages_parallel(path: str, workers: int) -> Iterator[str]:
+    """
+    Like iter_pages, but the pages are extracted by a pool of processes.
+    The pages are split into shards of consecutive pages, every worker opens the file itself.
+    The pages are yielded in page order, so the result is identical to iter_pages.
+
+    Args:
+        path (str): The path to the PDF file.
+        workers (int): The number of worker processes.
+
+    Yields:
+        str: The extracted text of the next page.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    number_of_pages = count_pages(path)
+
+    # More shards than workers, so a slow shard does not leave the other workers idle
+    number_of_shards = min(number_of_pages, workers * PAGES_PER_SHARD_PER_WORKER)
+    if number_of_shards == 0:
+        return
+
+    bounds = [number_of_pages * i // number_of_shards for i in range(number_of_shards + 1)]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(extract_page_range, path, start, stop)
+            for start, stop in zip(bounds, bounds[1:])
+        ]
+
+        # Collect in submission order to keep the page order
+        for future in futures:
+            yield from future.result()
+
+
+def extract_text_with_page_offsets(path: str, workers: int = 1) -> tuple[str, list[int]]:
+    """
+    Read a PDF file and build the text of the whole book in one join.
+    Additionally returns where every page starts in the text.
+
+    Args:
+        path (str): The path to the PDF file.
+        workers (int): The number of processes extracting pages. 1 extracts in this process.
+
+    Returns:
+        tuple[str, list[int]]: The extracted text and the page offsets.
+            page_offsets[i] is the character at which page i (0-based) starts.
+            The last entry is the length of the text, so page i spans
+            text[page_offsets[i]:page_offsets[i + 1]].
+    """
+    pages = []
+    page_offsets = [0]
+
+    page_iterator = iter_pages_parallel(path, workers) if workers > 1 else iter_pages(path)
+
+    for page_text in page_iterator:
+        pages.append(page_text)
+        page_offsets.append(page_offsets[-1] + len(page_text))
+
+    return "".join(pages), page_offsets
+
+
+def page_to_character(page_offsets: list[int], page: Optional[int]) -> Optional[int]:
+    """
+    Map a page number as found in the table of contents to a character position.
+
+    Args:
+        page_offsets (list[int]): The page offsets from extract_text_with_page_offsets.
+        page (Optional[int]): The page number, counted from 1 like in a table of contents.
+
+    Returns:
+        Optional[int]: The character at which the page starts, or None if the page is unknown.
+    """
+    if page is None or len(page_offsets) < 2:
+        return None
+
+    try:
+        page = int(page)
+    except (TypeError, ValueError):
+        return None
+
+    # Clamp to the pages the PDF actually has
+    index = min(max(page - 1, 0), len(page_offsets) - 2)
+    return page_offsets[index]
+
+
+def extract_outline(path: str) -> Optional[list[dict]]:
+    """
+    Read the outline (the bookmarks) of a PDF file as a table of contents,
+    in the format of transform.transform_table_of_contents_into_json.
+    The pages are the pages the bookmarks point to, counted from 1.
+
+    Args:
+        path (str): The path to the PDF file.
+
+    Returns:
+        Optional[list[dict]]: The nested table of contents, or None if the PDF has no usable outline.
+    """
+    import PyPDF2
+
+    with open(path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+
+        try:
+            outline = reader.outline
+        except Exception:
+            # A broken outline is no reason to fail, the table of contents can still be extracted from the text
+            return None
+
+        def convert(items: list) -> list[dict]:
+            # A nested list holds the children of the item before it
+            entries = []
+            for item in items:
+                if isinstance(item, list):
+                    if entries:
+                        entries[-1]["sub"] = convert(item)
+                    continue
+
+                try:
+                    page = reader.get_destination_page_number(item) + 1
+                except Exception:
+                    page = None
+
+                name = " ".join(str(item.title or "").split())
+                if name:
+                    entries.append({"name": name, "page": page if page and page > 0 else None})
+            return entries
+
+        toc = convert(outline or [])
+
+    if not any(entry["page"] is not None for entry in toc):
+        return None
+    return toc
+
+
+def file_fingerprint(path: str) -> str:
+    """
+    The sha256 of a PDF file and of the version of the extraction. Identical copies of a file have the same fingerprint.
+    """
+    import PyPDF2
+
+    digest = hashlib.sha256(f"{EXTRACTION_VERSION}\0{PyPDF2.__version__}\0".encode())
+    with open(path, 'rb') as file:
+        while block := file.read(FINGERPRINT_BLOCK_SIZE):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _digest_object(value, digest, memo: dict) -> None:
+    """
+    Hash a PDF object with everything it references. Indirect objects are hashed once and then taken from memo,
+    so a font used on every page is only hashed once. Image data and UNHASHED_KEYS are left out.
+    """
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+    if isinstance(value, IndirectObject):
+        reference = (value.idnum, value.generation)
+        if reference not in memo:
+            # A reference cycle is hashed as empty
+            memo[reference] = b""
+            object_digest = hashlib.sha256()
+            _digest_object(value.get_object(), object_digest, memo)
+            memo[reference] = object_digest.digest()
+        digest.update(memo[reference])
+    elif isinstance(value, DictionaryObject):
+        digest.update(b"<<")
+        for key in sorted(value):
+            if key not in UNHASHED_KEYS:
+                digest.update(key.encode())
+                _digest_object(value.raw_get(key), digest, memo)
+        digest.update(b">>")
+        if isinstance(value, StreamObject) and value.get("/Subtype") != "/Image":
+            digest.update(value.get_data())
+    elif isinstance(value, ArrayObject):
+        digest.update(b"[")
+        for item in value:
+            _digest_object(item, digest, memo)
+        digest.update(b"]")
+    else:
+        digest.update(repr(value).encode())
+        digest.update(b" ")
+
+
+def page_keys(path: str) -> list[str]:
+    """
+    The key of every page of a PDF file in the page cache: a hash of its raw content streams and its resources,
+    the fonts and forms its text is drawn with. A page that is unchanged in a new version of the PDF has the same key.
+    Only the streams are decoded, nothing is extracted.
+    """
+    import PyPDF2
+
+    with open(path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        memo = {}
+        keys = []
+        for page in reader.pages:
+            digest = hashlib.sha256(f"{EXTRACTION_VERSION}\0{PyPDF2.__version__}\0".encode())
+            for key in ("/Contents", "/Resources", "/Rotate"):
+                digest.update(key.encode())
+                if key in page:
+                    _digest_object(page.raw_get(key), digest, memo)
+            keys.append(digest.hexdigest())
+        return keys
+
+
+def iter_pages_cached(path: str, keys: list[str], workers: int = 1, root: str = CACHE_DIRECTORY) -> Iterator[str]:
+    """
+    Like iter_pages, but the text of every page is taken from the page cache in the pack store of root if it is there.
+    Only the other pages are extracted, by a pool of processes if workers > 1, and added to the cache.
+
+    Args:
+        path (str): The path to the PDF file.
+        keys (list[str]): The keys of its pages, see page_keys.
+        workers (int): The number of processes extracting pages.
+        root (str): The directory containing the caches of all books.
+
+    Yields:
+        str: The extracted text of the next page.
+    """
+    store = get_pack_store(root)
+    cached = store.cached_pages(keys)
+    missing = [index for index, key in enumerate(keys) if key not in cached]
+    record("pages", cache_hits=len(keys) - len(missing), cache_misses=len(missing), path=path)
+
+    def extracted() -> Iterator[str]:
+        # The text of the missing pages, in page order
+        if workers > 1 and len(missing) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            number_of_shards = min(len(missing), workers * PAGES_PER_SHARD_PER_WORKER)
+            bounds = [len(missing) * i // number_of_shards for i in range(number_of_shards + 1)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(extract_pages, path, missing[start:stop]) for start, stop in zip(bounds, bounds[1:])]
+                for future in futures:
+                    yield from future.result()
+        elif missing:
+            import PyPDF2
+
+            with open(path, 'rb') as file:
+                reader = PyPDF2.PdfReader(file)
+                for index in missing:
+                    yield reader.pages[index].extract_text()
+
+    new_pages = extracted()
+    for index, key in enumerate(keys):
+        text = store.get_page(key) if key in cached else None
+        if text is None:
+            # A cached page can be evicted since it was looked up
+            text = next(new_pages) if key not in cached else extract_pages(path, [index])[0]
+            store.put_page(key, text)
+        yield text
+
+
+def extract_book(path: str, workers: int = 1, root: str = CACHE_DIRECTORY) -> tuple[BookStore, list[int], Optional[list[dict]]]:
+    """
+    Everything the pipeline needs from a PDF file: the text, the page offsets and the outline.
+    The pages are streamed into a BookStore in the cache directory of the book, so the text is never held in memory as a whole.
+    An unchanged PDF file, by its fingerprint, is not read by PyPDF2 at all: its BookStore and outline are taken from the cache.
+    Of a changed file only the changed pages are extracted, the others come from the page cache, see iter_pages_cached.
+    A top level function, so it can run in a worker process.
+
+    Args:
+        path (str): The path to the PDF file.
+        workers (int): The number of processes extracting pages.
+        root (str): The directory containing the caches of all books.
+
+    Returns:
+        tuple[BookStore, list[int], Optional[list[dict]]]: The book, its page offsets (see extract_text_with_page_offsets) and its outline (see extract_outline).
+    """
+    store = get_pack_store(root)
+    fingerprint = file_fingerprint(path)
+
+    source = store.get_source(fingerprint)
+    if source is not None:
+        book_hash, outline = source
+        try:
+            book = BookStore(os.path.join(root, book_hash, BOOK_NAME))
+        except FileNotFoundError:
+            # Evicted by the garbage collection
+            pass
+        else:
+            record("pages", cache_hits=len(book.page_offsets) - 1, path=path)
+            return book, book.page_offsets, outline
+
+    keys = page_keys(path)
+    book = BookStore.write(iter_pages_cached(path, keys, workers, root), root)
+    outline = extract_outline(path)
+
+    store.assign_pages(keys, book.book_hash)
+    store.put_source(fingerprint, book.book_hash, outline)
+    return book, book.page_offsets, outline
+
+
+def extract_text(path: str, workers: int = 1) -> str:
+    """
+    Main function to read a PDF file and extract text from it.
+
+    Args:
+        path (str): The path to the PDF file.
+        workers (int): The number of processes extracting pages.
+
+    Returns:
+        str: The extracted text from the PDF file.
+    """
+    text, _ = extract_text_with_page_offsets(path, workers=workers)
     return text
 
 
 if __name__ == "__main__":
     # Example usage
     pdf_path = "test/Lodovico_Satana.pdf"  # Replace with your PDF file path
-    extracted_text = extract_text(pdf_path)
-    print(extracted_text[:10000])
\ No newline at end of file
+    extracted_text, offsets = extract_text_with_page_offsets(pdf_path)
+    print(f"{len(offsets) - 1} pages, {len(extracted_text)} characters")
+    print(f"Outline: {extract_outline(pdf_path)}")
+    print(extracted_text[:10000])
+
+    # The second extraction is served from the cache without PyPDF2
+    import time
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as root:
+        for run in ("first", "cached"):
+            start = time.perf_counter()
+            book, _, _ = extract_book(pdf_path, root=root)
+            print(f"{run} extract_book: {time.perf_counter() - start:.3f}s")
+            assert book[:] == extracted_text
+            book.close()
@@ -0,0 +1,139 @@
+import re
+from typing import Optional
+
+from book_store import Book
+from precleaner import CHARACTERS_PER_TOKEN
+
+# Chunks are planned to cost between these many tokens, so the parallel stages get similar units of work
+MIN_CHUNK_TOKENS = 1000
+MAX_CHUNK_TOKENS = 4000
+
+# How far from the ideal position of a cut a paragraph, line or sentence break is searched
+BREAK_SEARCH_CHARACTERS = 2000
+
+# Tried in this order, a cut is made after the break
+BREAKS = [re.compile(r"\n[ \t]*\n\s*"), re.compile(r"\n\s*"), re.compile(r"[.!?…]\s+")]
+
+
+def section_tokens(start: int, end: int) -> int:
+    """
+    The estimated tokens of a span of the book, like precleaner.estimate_tokens but without reading it.
+    """
+    return (end - start) // CHARACTERS_PER_TOKEN
+
+
+def find_break(book: Book, position: int, start: int, end: int, search: int = BREAK_SEARCH_CHARACTERS) -> int:
+    """
+    The cut closest to position between start and end that falls after a paragraph break,
+    or else after a line break or a sentence, within search characters. Otherwise position itself.
+    Only the characters around position are read, so it works on a BookStore of any size.
+    """
+    window_start = max(start + 1, position - search)
+    window_end = min(end - 1, position + search)
+    if window_end <= window_start:
+        return position
+
+    window = book[window_start:window_end]
+    for pattern in BREAKS:
+        cuts = [window_start + match.end() for match in pattern.finditer(window)]
+        cuts = [cut for cut in cuts if start < cut < end]
+        if cuts:
+            return min(cuts, key=lambda cut: abs(cut - position))
+    return position
+
+
+def merged_name(members: list[dict]) -> dict:
+    """
+    The section a chunk of several sections is named after: the first one of the highest level,
+    preferring real sections over the front matter.
+    """
+    candidates = [member for member in members if not member.get("front_matter")] or members
+    return min(candidates, key=lambda member: member.get("level", 0))
+
+
+def plan_chunks(book: Book, sections: list[dict], min_tokens: int = MIN_CHUNK_TOKENS, max_tokens: int = MAX_CHUNK_TOKENS,
+                max_characters_single_chunk: Optional[int] = None) -> list[dict]:
+    """
+    Plan the chunks of a book from its sections, so every chunk costs about the same to preprocess and speak.
+    A section of more than max_tokens is split into equal parts at paragraph boundaries, see find_break.
+    Consecutive sections of less than min_tokens are merged with their neighbours, up to max_tokens.
+    Tokens are estimated from the number of characters, see precleaner.estimate_tokens.
+
+    Args:
+        book (Book): The book.
+        sections (list[dict]): The sections in the order of the book, with name, level, page and their first character.
+            The front matter is marked with front_matter. A section runs to the start of the next one.
+        min_tokens (int): Smaller sections are merged.
+        max_tokens (int): Larger sections are split, merged chunks stay below it.
+        max_characters_single_chunk (Optional[int]): A book of at most this many characters is a single chunk.
+
+    Returns:
+        list[dict]: The chunks, with name, level, page, character_start, character_end and the names of their sections.
+    """
+    bounds = [section["character"] for section in sections] + [len(book)]
+    if max_characters_single_chunk is not None and len(book) <= max_characters_single_chunk:
+        max_tokens = max(max_tokens, section_tokens(0, len(book)))
+
+    # Split the sections that are too large
+    units = []
+    for section, start, end in zip(sections, bounds, bounds[1:]):
+        parts = max(1, -(-section_tokens(start, end) // max_tokens))
+        cuts = [start]
+        for part in range(1, parts):
+            # Every cut after the one before, a break found near two ideal positions is only used once
+            cut = find_break(book, start + (end - start) * part // parts, cuts[-1], end)
+            if cuts[-1] < cut < end:
+                cuts.append(cut)
+        cuts.append(end)
+
+        parts = len(cuts) - 1
+        for part, (part_start, part_end) in enumerate(zip(cuts, cuts[1:]), start=1):
+            name = section["name"] if parts == 1 else f"{section['name']} ({part}/{parts})"
+            units.append({"character_start": part_start, "character_end": part_end, "members": [{**section, "name": name}]})
+
+    # Merge the ones that are too small
+    chunks = []
+    for unit in units:
+        if chunks:
+            previous = chunks[-1]
+            previous_tokens = section_tokens(previous["character_start"], previous["character_end"])
+            unit_tokens = section_tokens(unit["character_start"], unit["character_end"])
+            if (previous_tokens < min_tokens or unit_tokens < min_tokens) and previous_tokens + unit_tokens <= max_tokens:
+                previous["character_end"] = unit["character_end"]
+                previous["members"] += unit["members"]
+                continue
+        chunks.append(unit)
+
+    planned = []
+    for chunk in chunks:
+        named_after = merged_name(chunk["members"])
+        planned.append({
+            "name": named_after["name"],
+            "level": named_after.get("level", 0),
+            "page": named_after.get("page"),
+            "character_start": chunk["character_start"],
+            "character_end": chunk["character_end"],
+            "sections": [member["name"] for member in chunk["members"]],
+        })
+    return planned
+
+
+if __name__ == "__main__":
+    # Example usage: a tiny front matter, a tiny intro and a chapter that is far too long
+    paragraph = "Ein Satz über nichts. " * 40 + "\n\n"
+    text = "Titel\n\n" + "Teil 1\n\n" + "Kapitel 1\n\n" + paragraph * 200 + "Kapitel 2\n\n" + paragraph * 10
+    sections = [
+        {"name": "Front matter", "level": 0, "page": None, "character": 0, "front_matter": True},
+        {"name": "Teil 1", "level": 0, "page": 1, "character": text.index("Teil 1")},
+        {"name": "Kapitel 1", "level": 1, "page": 1, "character": text.index("Kapitel 1")},
+        {"name": "Kapitel 2", "level": 1, "page": 9, "character": text.index("Kapitel 2")},
+    ]
+
+    chunks = plan_chunks(text, sections)
+    for chunk in chunks:
+        tokens = section_tokens(chunk["character_start"], chunk["character_end"])
+        print(f"{chunk['name']:<20} {tokens:>6} tokens  {chunk['sections']}")
+        assert chunk["character_start"] == 0 or text[chunk["character_start"] - 2:chunk["character_start"]] == "\n\n"
+    assert "".join(text[chunk["character_start"]:chunk["character_end"]] for chunk in chunks) == text
+    assert all(chunk["character_start"] < chunk["character_end"] for chunk in chunks)
+    assert chunks[0]["name"] == "Teil 1" and chunks[0]["page"] == 1
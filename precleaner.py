@@ -0,0 +1,126 @@
+import re
+from collections import Counter
+from typing import Iterable
+
+LINES_PER_PAGE_EDGE = 2
+MAX_REPEATED_LINE_LENGTH = 80
+MIN_REPEATED_PAGE_FRACTION = 0.3
+CHARACTERS_PER_TOKEN = 4
+
+# Written between the pages of a chunk, see transform.split_book_into_txt_files
+PAGE_BREAK = "\f"
+
+PAGE_NUMBER_LINE = re.compile(r"^\s*(?:[-–—]\s*)?(?:(?:seite|page|s\.)\s*)?\d{1,4}(?:\s*(?:/|von|of)\s*\d{1,4})?(?:\s*[-–—])?\s*$", re.IGNORECASE)
+HYPHENATED_LINE_BREAK = re.compile(r"(\w)[-‐]\n\s*([a-zäöüß])")
+MID_SENTENCE_LINE_BREAK = re.compile(r"([a-zäöüß,;])[ \t]*\n[ \t]*(?=[\wäöüÄÖÜ])")
+
+
+def normalize_line(line: str) -> str:
+    """
+    Normalize a line for comparing headers and footers across pages: numbers and whitespace do not matter.
+    """
+    return re.sub(r"\s+", " ", re.sub(r"\d+", "#", line)).strip().lower()
+
+
+def find_repeated_lines(pages: Iterable[str], lines_per_edge: int = LINES_PER_PAGE_EDGE, min_fraction: float = MIN_REPEATED_PAGE_FRACTION) -> set[str]:
+    """
+    Find the running headers and footers of a book.
+    A short line is considered a header or footer if it is among the first or last lines of many pages.
+
+    Args:
+        pages (Iterable[str]): The text of every page. Consumed once, so it can be a generator.
+        lines_per_edge (int): How many lines at the top and the bottom of a page are considered.
+        min_fraction (float): The fraction of pages a line has to appear on.
+
+    Returns:
+        set[str]: The normalized header and footer lines, see normalize_line.
+    """
+    counts = Counter()
+    number_of_pages = 0
+    for page in pages:
+        number_of_pages += 1
+        lines = [line for line in page.splitlines() if line.strip()]
+        edges = lines[:lines_per_edge] + lines[-lines_per_edge:]
+        counts.update({normalize_line(line) for line in edges if len(line) <= MAX_REPEATED_LINE_LENGTH})
+
+    minimum = max(2, min_fraction * number_of_pages)
+    return {line for line, count in counts.items() if count >= minimum and line.replace("#", "").strip()}
+
+
+def preclean(text: str, repeated_lines: Iterable[str] = ()) -> str:
+    """
+    Remove what can be removed without a language model:
+    running headers and footers, page numbers, hyphenated line breaks and stray whitespace.
+    Only the edges of a page are cleaned, so the text in between stays even if it looks like a header:
+    a header or footer among the first or last LINES_PER_PAGE_EDGE lines of a page,
+    and a page number as the first or last line of a page apart from those. The pages are separated by PAGE_BREAK.
+    The page a chunk starts in the middle of has no first lines, the one it ends in has no last lines.
+    A text without page breaks is a single page.
+
+    Args:
+        text (str): The text of a chunk.
+        repeated_lines (Iterable[str]): The normalized header and footer lines from find_repeated_lines.
+
+    Returns:
+        str: The cleaned text.
+    """
+    repeated_lines = set(repeated_lines)
+
+    pages = text.split(PAGE_BREAK)
+    lines = []
+    for number, page in enumerate(pages):
+        page_lines = page.splitlines()
+        content = [index for index, line in enumerate(page_lines) if line.strip()]
+        has_top = number > 0 or len(pages) == 1
+        has_bottom = number < len(pages) - 1 or len(pages) == 1
+
+        edge_lines = set()
+        if has_top:
+            edge_lines.update(content[:LINES_PER_PAGE_EDGE])
+        if has_bottom:
+            edge_lines.update(content[-LINES_PER_PAGE_EDGE:])
+        removed = {index for index in edge_lines if repeated_lines and normalize_line(page_lines[index]) in repeated_lines}
+
+        remaining = [index for index in content if index not in removed]
+        if remaining and has_top and PAGE_NUMBER_LINE.match(page_lines[remaining[0]]):
+            removed.add(remaining[0])
+        if remaining and has_bottom and PAGE_NUMBER_LINE.match(page_lines[remaining[-1]]):
+            removed.add(remaining[-1])
+
+        lines.extend(line.strip() for index, line in enumerate(page_lines) if index not in removed)
+    text = "\n".join(lines)
+
+    text = HYPHENATED_LINE_BREAK.sub(r"\1\2", text)
+    text = MID_SENTENCE_LINE_BREAK.sub(r"\1 ", text)
+    text = re.sub(r"[ \t]{2,}", " ", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+
+    return text.strip()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough estimate of the number of tokens of a text for the language model.
+    """
+    return len(text) // CHARACTERS_PER_TOKEN
+
+
+if __name__ == "__main__":
+    # Example usage
+    sentences = [
+        "Es war ein lan-\nger Tag, und die Sonne schien.",
+        "Am Abend ging er nach Hause,\nwo niemand auf ihn wartete.",
+        "Die Straßen waren leer.\nNur ein Hund bellte in der Fer-\nne.",
+        "Er schloss die Tür   hinter sich\nund setzte sich ans Fenster.",
+    ]
+    pages = [f"Lodovico Satana\n{sentence}\n- {number} -\n" for number, sentence in enumerate(sentences, start=1)]
+
+    repeated = find_repeated_lines(pages)
+    # A chunk that starts and ends at page boundaries, see transform.split_book_into_txt_files
+    text = PAGE_BREAK + PAGE_BREAK.join(pages) + PAGE_BREAK
+    cleaned = preclean(text, repeated)
+    print(repeated)
+    print(cleaned)
+    # A number inside a page is kept, the one at the bottom of the page is removed
+    assert "42" in preclean(f"Er zählte bis\n42\nund hörte auf.\n17{PAGE_BREAK}Am Morgen") and "17" not in preclean(f"Er zählte.\n17{PAGE_BREAK}Am Morgen")
+    print(f"Saved {len(text) - len(cleaned)} characters, ~{estimate_tokens(text) - estimate_tokens(cleaned)} tokens")
@@ -1,52 +1,103 @@
 import os
-from dotenv import load_dotenv  
+import hashlib
+from typing import Iterable, Optional
 
-load_dotenv()
+from backends import Parameter, get_llm
+from book_cache import write_atomic
+from journal import Journal
+from metrics import log, record, stage
+from precleaner import estimate_tokens, preclean
 
+WINDOW_OVERLAP_CHARACTERS = 600
+MAX_WINDOWS_IN_FLIGHT = 4
+
+def preprocessed_path(path: str) -> str:
+    """
+    The path of the preprocessed file of a chunk: the path of the chunk with _preprocessed added to it.
+    """
+    base_name, extension = os.path.splitext(path)
+    return f"{base_name}_preprocessed{extension}"
 
-from gptLang import Funktion, Parameter
 
-def preprocess_file(path: str, cache: bool=True) -> str:
+def preprocess_file(path: str, cache: bool=True, window_size: int = 0, window_overlap: int = WINDOW_OVERLAP_CHARACTERS, max_windows_in_flight: int = MAX_WINDOWS_IN_FLIGHT, repeated_lines: Iterable[str] = (), skip_llm: bool = False, journal: Optional[Journal] = None) -> str:
     """
     Takes a txt file which is a chunk of a book and preprocesses it.
-    If its cached it will be read from the cache.
+    The text is first cleaned locally with precleaner.preclean, then by the language model.
+    The answers of the language model are cached by content, see llm_cache.py, so an unchanged chunk costs nothing
+    and an edited chunk is cleaned again. The preprocessed file is only rewritten if its content changes.
     Stores the preprocessed text in a new file.
     Name of the file is the path of the original file with _preprocessed added to it.
     Args:
         path (str): The path to the txt file.
+        cache (bool): Use the response cache of the language model.
+        window_size (int): If positive and the text is longer, it is cleaned in overlapping windows of this many characters. See preprocess_windowed.
+        window_overlap (int): The number of characters consecutive windows share.
+        max_windows_in_flight (int): The maximum number of windows cleaned at the same time.
+        repeated_lines (Iterable[str]): The running headers and footers of the book, see precleaner.find_repeated_lines.
+        skip_llm (bool): Only clean locally, for text that is already clean apart from that.
+        journal (Optional[Journal]): The journal of the book. A chunk it has as cleaned with the same text is skipped.
     """
-    base_name, extension = os.path.splitext(path)
-    preprocessed_file = f"{base_name}_preprocessed{extension}"
-    
-    if os.path.exists(preprocessed_file) and cache:
-        print(f"Preprocessed file already exists: {preprocessed_file}")
-        return preprocessed_file
+    preprocessed_file = preprocessed_path(path)
 
     with open(path, 'r', encoding="utf-8") as file:
         text = file.read()
 
-    preprocessed_text = preprocess(text)
+    text_hash = hashlib.sha256(text.encode()).hexdigest()
+    if journal is not None and journal.get("cleaned", path) == text_hash and os.path.exists(preprocessed_file):
+        log(f"Chunk already cleaned according to the journal: {path}")
+        record("preprocess", cache_hits=1, path=path)
+        return preprocessed_file
+
+    with stage("preprocess", path=path) as event:
+        precleaned_text = preclean(text, repeated_lines)
+        saved_tokens = estimate_tokens(text) - estimate_tokens(precleaned_text)
+        log(f"Precleaning saved {len(text) - len(precleaned_text)} characters (~{saved_tokens} tokens) in {path}")
+
+        event["bytes_in"] = len(text.encode())
+        event["precleaning_saved_tokens"] = saved_tokens
+        text = precleaned_text
+
+        if skip_llm:
+            preprocessed_text = text
+        elif 0 < window_size < len(text):
+            preprocessed_text = preprocess_windowed(text, window_size, window_overlap, max_windows_in_flight, cache=cache)
+        else:
+            preprocessed_text = preprocess(text, cache=cache)
 
-    with open(preprocessed_file, 'w', encoding="utf-8") as file:
-        file.write(preprocessed_text)
+        event["bytes_out"] = len(preprocessed_text.encode())
+        if not skip_llm:
+            event["tokens"] = estimate_tokens(text) + estimate_tokens(preprocessed_text)
 
-    print(f"Preprocessed text written to: {preprocessed_file}")
+    if os.path.exists(preprocessed_file):
+        with open(preprocessed_file, 'r', encoding="utf-8") as file:
+            if file.read() == preprocessed_text:
+                log(f"Preprocessed file is up to date: {preprocessed_file}")
+                if journal is not None:
+                    journal.record("cleaned", path, text_hash)
+                return preprocessed_file
+
+    write_atomic(preprocessed_file, preprocessed_text)
+    if journal is not None:
+        journal.record("cleaned", path, text_hash)
+
+    log(f"Preprocessed text written to: {preprocessed_file}")
     return preprocessed_file
     
 
-def preprocess(text: str) -> str: 
+def preprocess(text: str, cache: bool = True) -> str: 
     """
     Preprocess the text by removing unwanted characters and formatting.
     This function is a placeholder and should be implemented based on specific requirements.
     
     Args:
         text (str): The text to preprocess.
+        cache (bool): Use the response cache of the language model.
     
     Returns:
         str: The preprocessed text.
     """
 
-    foo = Funktion(
+    foo = get_llm(cached=cache).function(
         inputType=Parameter(type=str, name="text"),
         returnType=Parameter(type=str, name="revised_text"),
         gpt_params={
@@ -73,6 +124,122 @@ So please make sure that the text is clean and readable.
     return output
 
 
+def split_into_windows(text: str, window_size: int, overlap: int) -> list[str]:
+    """
+    Split a text into windows of about window_size characters.
+    Each window ends at a paragraph or sentence boundary if there is one in its last half,
+    and starts at a sentence boundary about overlap characters before the end of the previous window.
+
+    Args:
+        text (str): The text to split.
+        window_size (int): The maximum length of a window.
+        overlap (int): The number of characters consecutive windows should share.
+
+    Returns:
+        list[str]: The windows in order.
+    """
+    import re
+
+    boundary = re.compile(r"\n\s*\n|(?<=[.!?…])\s+")
+    overlap = min(overlap, window_size // 2)
+
+    windows = []
+    start = 0
+    while True:
+        end = start + window_size
+        if end >= len(text):
+            windows.append(text[start:])
+            return windows
+
+        # Prefer the last boundary in the second half of the window
+        boundaries = [match.end() for match in boundary.finditer(text, start + window_size // 2, end)]
+        if boundaries:
+            end = boundaries[-1]
+        windows.append(text[start:end])
+
+        # Start the next window at the first boundary after end - overlap
+        match = boundary.search(text, end - overlap, end)
+        start = match.end() if match and match.end() < end else end - overlap
+
+
+def stitch_windows(windows: list[str]) -> str:
+    """
+    Join cleaned windows whose beginnings repeat the ends of the windows before them.
+    The first sentence of a window that also appears near the end of the previous window marks the seam:
+    the previous window is kept up to that sentence, the window from that sentence on.
+    If no sentence matches, the longest common block is used as the seam, and without one the windows are simply joined.
+
+    Args:
+        windows (list[str]): The cleaned windows in order.
+
+    Returns:
+        str: The stitched text.
+    """
+    import re
+    from difflib import SequenceMatcher
+
+    sentence = re.compile(r"[^\s.!?…][^.!?…\n]*[.!?…]*")
+
+    def normalize(text: str) -> str:
+        return re.sub(r"\W+", "", text).lower()
+
+    stitched = windows[0] if windows else ""
+    for window in windows[1:]:
+        tail_start = max(0, len(stitched) - 2 * len(window) // 3)
+        tail = stitched[tail_start:]
+
+        tail_sentences = {}
+        for match in sentence.finditer(tail):
+            key = normalize(match.group())
+            if len(key) >= 10:
+                tail_sentences.setdefault(key, tail_start + match.start())
+
+        seam = None
+        for match in sentence.finditer(window[:len(window) // 2]):
+            key = normalize(match.group())
+            if key in tail_sentences:
+                seam = (tail_sentences[key], match.start())
+                break
+
+        if seam is None:
+            block = SequenceMatcher(None, tail, window[:len(tail)], autojunk=False).find_longest_match(0, len(tail), 0, min(len(tail), len(window)))
+            if block.size >= 20:
+                seam = (tail_start + block.a, block.b)
+
+        if seam is None:
+            stitched = stitched.rstrip() + "\n\n" + window.lstrip()
+        else:
+            stitched = stitched[:seam[0]] + window[seam[1]:]
+
+    return stitched
+
+
+def preprocess_windowed(text: str, window_size: int, overlap: int = WINDOW_OVERLAP_CHARACTERS, max_windows_in_flight: int = MAX_WINDOWS_IN_FLIGHT, cache: bool = True) -> str:
+    """
+    Preprocess a long text in overlapping windows which are cleaned concurrently.
+    The cleaned windows are stitched together by removing the duplicated overlap.
+
+    Args:
+        text (str): The text to preprocess.
+        window_size (int): The maximum length of a window.
+        overlap (int): The number of characters consecutive windows share.
+        max_windows_in_flight (int): The maximum number of windows cleaned at the same time.
+        cache (bool): Use the response cache of the language model.
+
+    Returns:
+        str: The preprocessed text.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    windows = split_into_windows(text, window_size, overlap)
+    log(f"Preprocessing {len(windows)} windows.")
+
+    with ThreadPoolExecutor(max_workers=max(1, max_windows_in_flight)) as executor:
+        cleaned_windows = list(executor.map(lambda window: preprocess(window, cache=cache), windows))
+
+    return stitch_windows(cleaned_windows)
+
+
 if __name__ == "__main__":
     # Example usage
     preprocess_file("test/preprocessor_test.txt", cache=False)
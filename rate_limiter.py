@@ -0,0 +1,250 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+from metrics import log, record
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+
+# A bucket holds the requests and tokens of this many seconds, so short bursts are allowed
+BURST_SECONDS = 10
+
+# On a 429 the rate is halved, down to this fraction of the limit. Every success regains a bit of it.
+MIN_RATE_FRACTION = 0.05
+RECOVERY_PER_SUCCESS = 0.02
+
+MAX_RETRIES = 8
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+
+class TokenBucket:
+    """
+    A token bucket: it refills at rate_per_minute and holds at most BURST_SECONDS worth of it.
+    Not thread safe on its own, RateLimiter locks it.
+    """
+
+    def __init__(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self.level = self.capacity
+        self.time = time.monotonic()
+
+    @property
+    def capacity(self) -> float:
+        return max(1.0, self.rate_per_minute / 60 * BURST_SECONDS)
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.time) * self.rate_per_minute / 60)
+        self.time = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        The seconds until amount is available. An amount larger than the bucket only waits for a full bucket.
+        """
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.rate_per_minute)
+
+
+class RateLimiter:
+    """
+    The rate limit of one model: a bucket for the requests per minute and one for the tokens per minute.
+    It is shared by all stages and books, see get_rate_limiter.
+    The rate adapts: every throttled request (429) halves it and blocks all callers until its Retry-After,
+    every successful request slowly raises it back to the limit.
+    """
+
+    def __init__(self, requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE):
+        """
+        Args:
+            requests_per_minute (float): The maximum number of requests per minute.
+            tokens_per_minute (float): The maximum number of tokens per minute.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.rate_fraction = 1.0
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+
+    def _set_rate_fraction(self, fraction: float) -> None:
+        self.rate_fraction = min(1.0, max(MIN_RATE_FRACTION, fraction))
+        self._requests.rate_per_minute = self.requests_per_minute * self.rate_fraction
+        self._tokens.rate_per_minute = self.tokens_per_minute * self.rate_fraction
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        Wait until a request with this many tokens is allowed, and take it from the buckets.
+
+        Returns:
+            float: The seconds waited.
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+
+                wait = max(self.blocked_until - now, self._requests.wait_time(1), self._tokens.wait_time(tokens))
+                if wait <= 0:
+                    self._requests.level -= 1
+                    self._tokens.level -= min(tokens, self._tokens.capacity)
+                    return now - start
+
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self.rate_fraction < 1.0:
+                self._set_rate_fraction(self.rate_fraction + RECOVERY_PER_SUCCESS)
+
+    def on_rate_limited(self, delay: float) -> None:
+        """
+        Slow down after a throttled request: halve the rate and let nobody through for delay seconds.
+        """
+        with self._lock:
+            self.throttled += 1
+            self._set_rate_fraction(self.rate_fraction / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    If an error is a throttled request (HTTP 429), the seconds to wait from its Retry-After header (0 if it has none).
+    None for any other error. Works for the errors of the openai client and of urllib.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None) or getattr(error, "code", None)
+    if status != 429:
+        return None
+
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds is not None:
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+
+    seconds = headers.get("retry-after")
+    if seconds is None:
+        return 0.0
+    try:
+        return float(seconds)
+    except ValueError:
+        # An HTTP date
+        try:
+            return max(0.0, parsedate_to_datetime(seconds).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+
+def backoff_delay(attempt: int, retry_after_seconds: float = 0.0) -> float:
+    """
+    How long to wait before the next attempt: exponential backoff with full jitter,
+    but at least as long as the server asked for.
+    """
+    return max(retry_after_seconds, random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt)))
+
+
+def call_with_rate_limit(function: Callable[[], Any], limiter: RateLimiter, tokens: int = 0, max_retries: int = MAX_RETRIES, name: str = "") -> Any:
+    """
+    Call a function that sends one request, within the rate limit.
+    A throttled request slows down the limiter for everyone and is retried with backoff, other errors are raised.
+
+    Args:
+        function (Callable[[], Any]): Sends the request.
+        limiter (RateLimiter): The rate limiter of the model.
+        tokens (int): The estimated tokens of the request.
+        max_retries (int): How often a throttled request is retried before its error is raised.
+        name (str): The name of the model, for the metrics.
+
+    Returns:
+        Any: What function returns.
+    """
+    for attempt in range(max_retries + 1):
+        waited = limiter.acquire(tokens)
+        if waited > 0:
+            record("rate_limit", waited, model=name)
+
+        try:
+            result = function()
+        except Exception as error:
+            seconds = retry_after(error)
+            if seconds is None or attempt == max_retries:
+                raise
+
+            delay = backoff_delay(attempt, seconds)
+            log(f"Rate limited by {name or 'the API'}, retrying in {delay:.1f}s")
+            record("rate_limit", retries=1, model=name, delay=round(delay, 3))
+            limiter.on_rate_limited(delay)
+            continue
+
+        limiter.on_success()
+        return result
+
+
+_lock = threading.Lock()
+_limits = {}
+_limiters = {}
+
+
+def set_rate_limit(model: str, requests_per_minute: float, tokens_per_minute: float) -> None:
+    """
+    Set the rate limit of a model, e.g. from the limits of the API account.
+    """
+    with _lock:
+        _limits[model] = (requests_per_minute, tokens_per_minute)
+        _limiters.pop(model, None)
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """
+    The rate limiter of a model, shared by all stages and books.
+    """
+    with _lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(*_limits.get(model, (DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE)))
+        return _limiters[model]
+
+
+if __name__ == "__main__":
+    # Speak against a local server that throttles above 5 requests per second,
+    # with a limit that is set too high on purpose. Every request has to succeed.
+    import os
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    from fake_speech_server import fake_audio, start_fake_speech_server
+
+    server, base_url = start_fake_speech_server(requests_per_second=5)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+    from backends import OpenAITTSBackend, RateLimitedTTSBackend
+
+    backend = RateLimitedTTSBackend(OpenAITTSBackend())
+    set_rate_limit(backend.backend.model, requests_per_minute=1200, tokens_per_minute=1000000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        texts = [f"Satz {i}. " * 20 for i in range(40)]
+        paths = [os.path.join(directory, f"{i}.mp3") for i in range(len(texts))]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(backend.synthesize, texts, paths))
+        seconds = time.perf_counter() - start
+
+        for text, path in zip(texts, paths):
+            with open(path, 'rb') as file:
+                assert file.read() == fake_audio(text), path
+
+    limiter = get_rate_limiter(backend.backend.model)
+    print(f"{len(texts)} requests in {seconds:.1f}s, {server.throttled} throttled by the server, "
+          f"rate adapted to {limiter.rate_fraction:.0%} of the limit")
+    server.shutdown()
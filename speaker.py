@@ -1,42 +1,209 @@
-import os 
-from dotenv import load_dotenv
+import os
+import re
+import hashlib
+import tempfile
+import threading
+from typing import Optional
 
-load_dotenv() 
+import mp3
+from backends import get_tts
+from journal import Journal
+from metrics import log, record, stage
 
-from openai import OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# The speech API accepts at most 4096 characters per request
+MAX_PIECE_CHARACTERS = 4000
+MAX_PIECES_IN_FLIGHT = 4
 
+def split_text_into_pieces(text: str, max_characters: int = MAX_PIECE_CHARACTERS) -> list[str]:
+    """
+    Split a text into pieces of at most max_characters characters.
+    Paragraphs are kept together where possible, otherwise the text is split between sentences.
+    Only a single sentence longer than max_characters is split between words.
+    Args:
+        text (str): The text to split.
+        max_characters (int): The maximum length of a piece.
+    Returns:
+        list[str]: The pieces in order.
+    """
+    # Paragraphs, or sentences of paragraphs that are too long, with the separator in front of them
+    units = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_characters:
+            units.append(("\n\n", paragraph))
+            continue
+
+        separator = "\n\n"
+        for sentence in re.split(r"(?<=[.!?…])\s+", paragraph):
+            while len(sentence) > max_characters:
+                cut = sentence.rfind(" ", 0, max_characters)
+                cut = cut if cut > 0 else max_characters
+                units.append((separator, sentence[:cut]))
+                sentence = sentence[cut:].lstrip()
+                separator = " "
+            units.append((separator, sentence))
+            separator = " "
+
+    # Pack them greedily into pieces
+    pieces = []
+    for separator, unit in units:
+        if not unit:
+            continue
+        if pieces and len(pieces[-1]) + len(separator) + len(unit) <= max_characters:
+            pieces[-1] += separator + unit
+        else:
+            pieces.append(unit)
+
+    return pieces
+
+
+def synthesize(text: str, path: str) -> None:
+    """
+    Speak a text with the text to speech backend and write the audio to path.
+    The audio is streamed into a temporary file of its own which is renamed when it is complete.
+    Args:
+        text (str): The text to speak, at most 4096 characters.
+        path (str): The path of the mp3 file.
+    """
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    os.close(file_descriptor)
 
-def speak_file(path: str, cache: bool =True) -> None:
+    try:
+        get_tts().synthesize(text, temporary_path)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def spoken_path(path: str) -> str:
+    """
+    The path of the mp3 file of a preprocessed chunk: the path of the chunk but as mp3.
+    """
+    return f"{os.path.splitext(path)[0]}.mp3"
+
+
+# Identical books share their chunk files, so the same chunk may be spoken twice at the same time
+_chunk_locks_lock = threading.Lock()
+_chunk_locks = {}
+
+
+def _chunk_lock(spoken_file: str) -> threading.Lock:
+    with _chunk_locks_lock:
+        return _chunk_locks.setdefault(os.path.abspath(spoken_file), threading.Lock())
+
+
+def speak_file(path: str, cache: bool =True, max_piece_characters: int = MAX_PIECE_CHARACTERS, max_pieces_in_flight: int = MAX_PIECES_IN_FLIGHT, journal: Optional[Journal] = None) -> str:
     """
     Takes a txt file which is a preprocessed chunk of a book and speaks it.
-    If its cached it will be skipped.
+    If its cached it will be skipped. The cache is only used if the mp3 file is newer than the txt file.
+    Long texts are split into pieces at paragraph and sentence boundaries, which are spoken in parallel
+    and joined frame by frame. Every piece is cached on its own until the chunk is complete,
+    so a failed run only repeats the missing pieces.
     Stores the spoken text in a new file.
     Name of the file is the path of the original file but as mp3.
     Args:
         path (str): The path to the prepocessed chunk txt file.
+        max_piece_characters (int): The maximum length of the text of one request.
+        max_pieces_in_flight (int): The maximum number of pieces spoken at the same time.
+        journal (Optional[Journal]): The journal of the book. Records every written piece and spoken chunk.
+            With a journal, a piece file is only reused if the journal has it.
+    Returns:
+        str: The path to the mp3 file.
+    """
+    base_name = os.path.splitext(path)[0]
+    spoken_file = spoken_path(path)
+
+    # The pieces of a chunk are only joined and removed by one caller, the others find the finished chunk
+    with _chunk_lock(spoken_file):
+        if cache and os.path.exists(spoken_file) and os.path.getmtime(spoken_file) >= os.path.getmtime(path):
+            log(f"Spoken file already exists: {spoken_file}")
+            record("speak", cache_hits=1, path=path)
+            return spoken_file
+
+        with open(path, 'r', encoding="utf-8") as file:
+            text = file.read()
+
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        if cache and journal is not None and journal.get("spoken", path) == text_hash and os.path.exists(spoken_file):
+            log(f"Chunk already spoken according to the journal: {spoken_file}")
+            record("speak", cache_hits=1, path=path)
+            return spoken_file
+
+        with stage("speak", cache_misses=1, path=path) as event:
+            event["bytes_in"] = len(text.encode())
+            _speak_text(text, base_name, spoken_file, cache, max_piece_characters, max_pieces_in_flight, journal)
+            event["bytes_out"] = os.path.getsize(spoken_file)
+
+        if journal is not None:
+            journal.record("spoken", path, text_hash)
+
+        log(f"Spoken text written to: {spoken_file}")
+        return spoken_file
+
+
+def _speak_text(text: str, base_name: str, spoken_file: str, cache: bool, max_piece_characters: int, max_pieces_in_flight: int, journal: Optional[Journal] = None) -> None:
+    """
+    Speak a text into spoken_file, in parallel pieces if it is long. See speak_file.
     """
-    base_name, extension = os.path.splitext(path)
-    spoken_file = f"{base_name}.mp3"
-    
-    if os.path.exists(spoken_file) and cache:
-        print(f"Spoken file already exists: {spoken_file}")
+    from concurrent.futures import ThreadPoolExecutor
+
+    pieces = split_text_into_pieces(text, max_piece_characters)
+
+    if len(pieces) <= 1:
+        synthesize(text, spoken_file)
         return
 
-    with open(path, 'r', encoding="utf-8") as file:
-        text = file.read()
+    # The piece files are named by the hash of their text, so an edited piece is not reused
+    piece_files = [
+        f"{base_name}.part{index:03d}-{hashlib.md5(piece.encode()).hexdigest()[:8]}.mp3"
+        for index, piece in enumerate(pieces)
+    ]
+
+    def speak_piece(index: int) -> None:
+        if os.path.exists(piece_files[index]) and cache and (journal is None or journal.done("pieces", piece_files[index])):
+            return
+        synthesize(pieces[index], piece_files[index])
+        if journal is not None:
+            journal.record("pieces", piece_files[index])
+        log(f"Piece {index + 1}/{len(pieces)} written to: {piece_files[index]}")
+
+    with ThreadPoolExecutor(max_workers=max(1, max_pieces_in_flight)) as executor:
+        list(executor.map(speak_piece, range(len(pieces))))
+
+    mp3.concatenate(piece_files, spoken_file)
+
+    for piece_file in piece_files:
+        os.remove(piece_file)
+
+
+def speak_files(paths: list[str], max_in_flight: int = 4, cache: bool = True) -> list[str]:
+    """
+    Speaks multiple preprocessed chunks concurrently.
+    At most max_in_flight requests to the speech API are running at the same time.
+    Chunks that are already spoken are skipped like in speak_file.
+    Args:
+        paths (list[str]): The paths to the preprocessed chunk txt files.
+        max_in_flight (int): The maximum number of concurrent requests.
+    Returns:
+        list[str]: The paths to the mp3 files, in the order of paths.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    spoken_files = [None] * len(paths)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = {executor.submit(speak_file, path, cache): index for index, path in enumerate(paths)}
 
-    with client.audio.speech.with_streaming_response.create(
-        model="gpt-4o-mini-tts",
-        voice="ash",
-        input=text, 
-        instructions="You are reading an audiobook. Read it in standard german. Please read it in a natural and very calming way. Mumble a bit.",
-    ) as response:
-        response.stream_to_file(spoken_file)
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            spoken_files[index] = future.result()
+            log(f"[{done}/{len(paths)}] Spoken: {paths[index]}")
 
-    print(f"Spoken text written to: {spoken_file}")
+    return spoken_files
 
 
 if __name__ == "__main__":
     # Example usage
-    speak_file("test/audio_test.txt", cache=False)
\ No newline at end of file
+    speak_file("test/audio_test.txt", cache=False)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# The modules live in the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import write_pdf
+
+
+def book_pages(title: str, pages: int = 6, lines: int = 40) -> list[list[str]]:
+    """
+    The pages of a small book with a page number at the bottom of every page.
+    """
+    return [
+        [f"{title}"] + [f"Line {line} of page {page}. Es war einmal ein Satz, der immer weiterging." for line in range(lines)] + [str(page + 1)]
+        for page in range(pages)
+    ]
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    def make(name: str, pages: list[list[str]]) -> str:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_pdf(str(path), pages)
+        return str(path)
+    return make
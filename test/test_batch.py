@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+import mp3
+from audiobook import AUDIOBOOK_NAME, read_chapters
+from conftest import ROOT, book_pages
+from pack_store import PACK_NAME, PackStore
+
+
+def run_main(arguments: list[str], directory: str) -> subprocess.CompletedProcess:
+    environment = {**os.environ, "VIBEPDF_BACKEND": "fake", "PYTHONWARNINGS": "ignore"}
+    return subprocess.run([sys.executable, os.path.join(ROOT, "__main__.py"), *arguments, "--backend", "fake", "--quiet"],
+                          cwd=directory, env=environment, capture_output=True, text=True, timeout=600)
+
+
+def test_identical_books_in_one_batch(tmp_path, make_pdf):
+    # Two copies of the same book share their cache directory, a third book is different.
+    # Without the language model the chunks keep their text, several pages each, so they are spoken in pieces and joined.
+    make_pdf("library/first.pdf", book_pages("Ein Buch", pages=12))
+    make_pdf("library/copy.pdf", book_pages("Ein Buch", pages=12))
+    make_pdf("library/other/second.pdf", book_pages("Ein anderes Buch", pages=4))
+
+    for _ in range(2):
+        run = run_main(["library", "--workers", "2", "--books_in_flight", "3", "--skip_llm"], str(tmp_path))
+        assert run.returncode == 0, run.stderr
+        assert "3 books (0 failed)" in run.stdout, run.stdout + run.stderr
+
+    cache = tmp_path / "cache"
+    books = [name for name in os.listdir(cache) if len(name) == 32]
+    assert len(books) == 2
+
+    store = PackStore(str(cache / PACK_NAME))
+    for book in books:
+        assert not [name for name in os.listdir(cache / book) if name.endswith(".tmp")]
+
+        # The preprocessed chunks are in the pack store once the book is done
+        chunks = store.names(book, "chunks/")
+        assert chunks
+        texts = [store.get(book, name)[0].decode("utf-8") for name in chunks]
+        assert all("Es war einmal ein Satz" in text for text in texts)
+
+        # One silent frame per 20 characters, see backends.FakeTTSBackend
+        audiobook = str(cache / book / AUDIOBOOK_NAME)
+        frames = sum(max(1, len(text) // 20) for text in texts)
+        assert frames > len(texts)
+        assert mp3.duration(audiobook) > 0.9 * frames * 1152 / 44100
+
+        chapters = read_chapters(audiobook)
+        assert len(chapters) == len(chunks)
+        assert chapters[0][1] == 0 and all(end == start for (_, _, end), (_, start, _) in zip(chapters, chapters[1:]))
+    store.close()
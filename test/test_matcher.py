@@ -0,0 +1,65 @@
+import random
+import string
+
+import pytest
+
+from matcher import find_best_match, find_substring_with_tolerance_naive
+
+
+def random_text(rng: random.Random, words: int) -> str:
+    vocabulary = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))) for _ in range(300)]
+    return " ".join(rng.choices(vocabulary, k=words))
+
+
+def change(rng: random.Random, needle: str, every: int) -> str:
+    # Substitute, insert or delete a character about every few characters
+    characters = list(needle)
+    for _ in range(max(1, len(characters) // every)):
+        position = rng.randrange(len(characters))
+        operation = rng.random()
+        if operation < 0.4:
+            characters[position] = rng.choice(string.ascii_lowercase)
+        elif operation < 0.7:
+            characters.insert(position, rng.choice(string.ascii_lowercase))
+        elif len(characters) > 2:
+            del characters[position]
+    return "".join(characters)
+
+
+def test_planted_needle_is_found_exactly():
+    rng = random.Random(0)
+    text = random_text(rng, 2000)
+    for _ in range(20):
+        start = rng.randrange(len(text) - 100)
+        needle = text[start:start + rng.randint(20, 100)]
+        found, offset, score = find_best_match(text, needle, tolerance=90)
+        assert found and score == 100
+        assert text[offset:offset + len(needle)] == needle
+
+
+@pytest.mark.parametrize("tolerance", [70, 80])
+def test_changed_needles_are_found_like_the_naive_scan(tolerance):
+    rng = random.Random(tolerance)
+    for _ in range(25):
+        text = random_text(rng, 40)
+        size = rng.randint(4, 50)
+        start = rng.randrange(len(text) - size)
+        needle = change(rng, text[start:start + size], every=10)
+
+        fast = find_best_match(text, needle, tolerance=tolerance)
+        naive = find_substring_with_tolerance_naive(text, needle, tolerance=tolerance)
+
+        # The best match is found whenever the first match is, and it scores at least as high
+        assert fast[0] or not naive[0], (text, needle, fast, naive)
+        assert fast[2] >= naive[2], (text, needle, fast, naive)
+
+
+@pytest.mark.parametrize("text, needle", [
+    ("ab fkikd mn", "fkqkd "),
+    ("xy jjjok zz", "jmjok"),
+    ("abc pra tv def", "pa t"),
+])
+def test_short_needle_with_a_change(text, needle):
+    # A single change leaves no 4-gram in common with the text
+    assert find_best_match(text, needle, tolerance=80)[0]
+    assert find_substring_with_tolerance_naive(text, needle, tolerance=80)[0]
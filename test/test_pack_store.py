@@ -0,0 +1,57 @@
+import os
+import time
+
+from journal import JOURNAL_NAME
+from llm_cache import ResponseCache
+from pack_store import collect_garbage, get_pack_store
+from work_queue import WorkQueue
+
+
+def add_book(root, book_hash: str) -> None:
+    os.makedirs(os.path.join(root, book_hash))
+    for name in ("book.txt", JOURNAL_NAME):
+        with open(os.path.join(root, book_hash, name), 'w', encoding="utf-8") as file:
+            file.write("Es war einmal ein Satz. " * 50)
+    get_pack_store(root).put(book_hash, "toc.txt", b"Inhalt")
+    get_pack_store(root).touch(book_hash)
+
+
+def test_collect_garbage_keeps_books_in_progress(tmp_path):
+    root = str(tmp_path / "cache")
+    failed, cleaning, speaking, orphan, recent_orphan = (letter * 32 for letter in "abcde")
+    for book_hash in (failed, cleaning, speaking):
+        add_book(root, book_hash)
+    store = get_pack_store(root)
+    store.put(orphan, "toc.txt", b"Inhalt")
+    store.touch(orphan)
+    store.put_page("page", "Der Text einer Seite, die noch zu keinem Buch gehört.")
+    time.sleep(0.6)
+
+    # Another process writes the journal of one book and works on a chunk of another one in the queue
+    os.utime(os.path.join(root, cleaning, JOURNAL_NAME))
+    queue = WorkQueue(os.path.join(root, "queue"))
+    queue.submit("speak", os.path.join(root, speaking, "chunks", "000_preprocessed.txt"))
+    assert queue.claim("worker") is not None
+    store.put(recent_orphan, "toc.txt", b"Inhalt")
+    store.touch(recent_orphan)
+
+    result = collect_garbage(0, root=root, min_idle_seconds=0.5)
+
+    # The book that failed for good has no audiobook either, but nobody works on it anymore
+    assert result["evicted"] == 1 and result["kept_in_progress"] == 2
+    assert not os.path.exists(os.path.join(root, failed))
+    assert os.path.exists(os.path.join(root, cleaning)) and os.path.exists(os.path.join(root, speaking))
+    assert set(store.books()) == {cleaning, speaking, recent_orphan, ""}
+    assert store.get_page("page") is not None
+
+
+def test_collect_garbage_leaves_the_response_cache_of_its_root(tmp_path):
+    root = str(tmp_path / "cache")
+    add_book(root, "a" * 32)
+    cache = ResponseCache(root=root)
+    key = ResponseCache.key("model", "context", "prompt", str)
+    cache.put(key, "answer")
+    assert cache.directory.startswith(os.path.abspath(root) + os.sep)
+
+    assert collect_garbage(0, root=root, min_idle_seconds=0)["evicted"] == 1
+    assert ResponseCache(root=root).get(key) == (True, "answer")
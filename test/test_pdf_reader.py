@@ -0,0 +1,30 @@
+import pytest
+
+from conftest import book_pages
+from pdf_reader import extract_book, extract_text_with_page_offsets, iter_pages, iter_pages_parallel
+
+
+@pytest.fixture
+def book_pdf(make_pdf):
+    # More pages than shards, with pages of different lengths
+    pages = book_pages("Ein Buch", pages=23, lines=10)
+    for number, page in enumerate(pages):
+        pages[number] = page[:3 + number % 7]
+    return make_pdf("book.pdf", pages)
+
+
+@pytest.mark.parametrize("workers", [2, 3, 8])
+def test_parallel_extraction_is_identical_to_serial(book_pdf, workers):
+    serial = list(iter_pages(book_pdf))
+    assert len(serial) == 23
+    assert list(iter_pages_parallel(book_pdf, workers)) == serial
+    assert extract_text_with_page_offsets(book_pdf, workers=workers) == extract_text_with_page_offsets(book_pdf)
+
+
+def test_extract_book_with_workers(book_pdf, tmp_path):
+    serial, serial_offsets, _ = extract_book(book_pdf, workers=1, root=str(tmp_path / "serial"))
+    parallel, parallel_offsets, _ = extract_book(book_pdf, workers=3, root=str(tmp_path / "parallel"))
+
+    assert parallel_offsets == serial_offsets
+    assert parallel.book_hash == serial.book_hash
+    assert parallel[0:len(parallel)] == serial[0:len(serial)] == "".join(iter_pages(book_pdf))
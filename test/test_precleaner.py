@@ -0,0 +1,34 @@
+from precleaner import PAGE_BREAK, find_repeated_lines, preclean
+
+
+def test_body_text_that_looks_like_a_header_stays():
+    words = ["Haus", "Stadt", "Nacht", "Licht", "Wasser", "Wald"]
+    pages = [f"Kapitel Eins\nDas {words[page]} am Morgen.\nEin {words[page - 1]} im Regen.\nKapitel Eins\nDer {words[page]} war leer.\nDie {words[page - 1]} schlief.\n{page}\n"
+             for page in range(1, 6)]
+    repeated = find_repeated_lines(pages)
+    assert "kapitel eins" in repeated
+
+    cleaned = preclean(PAGE_BREAK + PAGE_BREAK.join(pages) + PAGE_BREAK, repeated)
+
+    # The header is removed from the top of every page, the same line in the middle of a page stays
+    assert cleaned.count("Kapitel Eins") == 5
+    for page in range(1, 6):
+        assert f"Das {words[page]} am Morgen." in cleaned and f"Die {words[page - 1]} schlief." in cleaned
+    assert not [line for line in cleaned.splitlines() if line.strip().isdigit()]
+
+
+def test_lines_that_all_normalize_alike_are_kept():
+    # Every line is "line # of page #", so they are all among the repeated lines
+    pages = ["\n".join([f"Line {line} of page {page}." for line in range(10)] + [str(page + 1)]) for page in range(6)]
+    repeated = find_repeated_lines(pages)
+
+    cleaned = preclean(PAGE_BREAK + PAGE_BREAK.join(pages) + PAGE_BREAK, repeated)
+
+    for page in range(6):
+        for line in range(2, 8):
+            assert f"Line {line} of page {page}." in cleaned
+
+
+def test_number_inside_a_page_stays():
+    assert "42" in preclean(f"Er zählte bis\n42\nund hörte auf.\n17{PAGE_BREAK}Am Morgen")
+    assert "17" not in preclean(f"Er zählte.\n17{PAGE_BREAK}Am Morgen")
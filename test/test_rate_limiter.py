@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import rate_limiter
+from backends import FakeLLMBackend, OpenAITTSBackend, Parameter, RateLimitedLLMBackend, RateLimitedTTSBackend, TTSBackend
+from fake_speech_server import fake_audio, start_fake_speech_server
+from rate_limiter import RateLimiter, call_with_rate_limit, get_rate_limiter, retry_after, set_rate_limit
+
+
+class Throttled(Exception):
+    """
+    A 429 like the ones of the openai client.
+    """
+
+    def __init__(self, headers=None):
+        super().__init__("Too many requests")
+        self.status_code = 429
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "BASE_DELAY", 0.001)
+
+
+def throttled_then(result, failures: int):
+    calls = []
+
+    def function():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise Throttled({"retry-after-ms": "1"})
+        return result
+
+    return function, calls
+
+
+def test_retry_after():
+    assert retry_after(Throttled({"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(Throttled({"retry-after": "2"})) == 2.0
+    assert retry_after(Throttled()) == 0.0
+    assert retry_after(ValueError("no response")) is None
+
+
+def test_throttled_request_is_retried_and_slows_down():
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=10 ** 6)
+    function, calls = throttled_then("answer", failures=2)
+
+    assert call_with_rate_limit(function, limiter, tokens=10) == "answer"
+    assert len(calls) == 3
+    assert limiter.throttled == 2
+    assert limiter.rate_fraction < 1.0
+
+
+def test_throttled_request_gives_up_after_max_retries():
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=10 ** 6)
+    function, calls = throttled_then("answer", failures=10)
+
+    with pytest.raises(Throttled):
+        call_with_rate_limit(function, limiter, max_retries=3)
+    assert len(calls) == 4
+
+
+def test_other_errors_are_not_retried():
+    limiter = RateLimiter()
+    calls = []
+
+    def function():
+        calls.append(None)
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        call_with_rate_limit(function, limiter)
+    assert len(calls) == 1
+
+
+class ThrottledLLMBackend(FakeLLMBackend):
+    """
+    Throttled on its first calls, then answers like the fake backend.
+    """
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+        self.calls = 0
+
+    def function(self, *args, **kwargs):
+        answer = super().function(*args, **kwargs)
+
+        def call(**call_arguments):
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise Throttled({"retry-after": "0"})
+            return answer(**call_arguments)
+
+        return call
+
+
+def test_llm_retries_throttled_calls():
+    set_rate_limit("test-llm-429", requests_per_minute=6000, tokens_per_minute=10 ** 6)
+    backend = ThrottledLLMBackend(failures=2)
+    function = RateLimitedLLMBackend(backend).function(returnType=Parameter(str, "text"), context="Clean the text.",
+                                                       inputPromptFormatString="{text}", model="test-llm-429", inputType=Parameter(str, "text"))
+
+    assert function(text="Ein Satz.") == "Ein Satz."
+    assert backend.calls == 3
+    assert get_rate_limiter("test-llm-429").throttled == 2
+
+
+def test_llm_charges_every_request_of_a_call():
+    set_rate_limit("test-llm-requests", requests_per_minute=60, tokens_per_minute=10 ** 6)
+    limiter = get_rate_limiter("test-llm-requests")
+    rejected = []
+
+    def validator(answer):
+        # The first two answers are rejected, so the model is asked three times
+        if len(rejected) < 2:
+            rejected.append(answer)
+            return "Try again."
+        return None
+
+    function = RateLimitedLLMBackend(FakeLLMBackend()).function(returnType=Parameter(str, "text"), context="", inputPromptFormatString="Ein Satz.",
+                                                                model="test-llm-requests", returnValidator=validator)
+    level = limiter._requests.level
+    function()
+    assert level - limiter._requests.level == pytest.approx(3, abs=0.1)
+
+
+def test_tts_retries_throttled_requests(tmp_path):
+    class ThrottledTTSBackend(TTSBackend):
+        model = "test-tts-429"
+        calls = 0
+
+        def synthesize(self, text, path):
+            self.calls += 1
+            if self.calls == 1:
+                raise Throttled()
+            with open(path, 'w', encoding="utf-8") as file:
+                file.write(text)
+
+    backend = ThrottledTTSBackend()
+    RateLimitedTTSBackend(backend).synthesize("Hallo", str(tmp_path / "hallo.mp3"))
+    assert backend.calls == 2
+    assert (tmp_path / "hallo.mp3").read_text(encoding="utf-8") == "Hallo"
+
+
+def test_tts_against_a_throttling_speech_server(tmp_path, monkeypatch):
+    # Like the example of rate_limiter.py: the limit is set too high on purpose, every request has to succeed anyway
+    pytest.importorskip("openai")
+    server, base_url = start_fake_speech_server(requests_per_second=10)
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "fake")
+    backend = RateLimitedTTSBackend(OpenAITTSBackend(model="test-tts-server"))
+    set_rate_limit("test-tts-server", requests_per_minute=2400, tokens_per_minute=10 ** 6)
+    texts = [f"Satz {index}. " * 20 for index in range(30)]
+    paths = [str(tmp_path / f"{index}.mp3") for index in range(len(texts))]
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(backend.synthesize, texts, paths))
+    finally:
+        server.shutdown()
+
+    for text, path in zip(texts, paths):
+        with open(path, 'rb') as file:
+            assert file.read() == fake_audio(text)
+    # Every 429 of the server was seen and retried by the limiter of the model
+    assert server.throttled > 0
+    assert get_rate_limiter("test-tts-server").throttled == server.throttled
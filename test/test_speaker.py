@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+
+import pytest
+
+import backends
+import mp3
+from fake_speech_server import fake_audio, start_fake_speech_server
+from speaker import speak_file, speak_files, split_text_into_pieces
+
+
+class CountingTTSBackend(backends.FakeTTSBackend):
+    """
+    The fake speech API, counting how many requests run at the same time.
+    """
+
+    def __init__(self):
+        super().__init__(latency=0.05)
+        self.texts = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def synthesize(self, text, path):
+        with self._lock:
+            self.texts.append(text)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            super().synthesize(text, path)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+@pytest.fixture
+def tts(monkeypatch):
+    backend = CountingTTSBackend()
+    monkeypatch.setattr(backends, "_tts", backend)
+    return backend
+
+
+def write_chunks(directory, texts: list[str]) -> list[str]:
+    paths = []
+    for index, text in enumerate(texts):
+        paths.append(str(directory / f"{index:03d}_preprocessed.txt"))
+        with open(paths[-1], 'w', encoding="utf-8") as file:
+            file.write(text)
+    return paths
+
+
+def test_speak_files_in_parallel_and_in_order(tmp_path, tts):
+    paths = write_chunks(tmp_path, [f"Kapitel {index}. " * (index + 1) * 10 for index in range(8)])
+
+    spoken_files = speak_files(paths, max_in_flight=3, cache=False)
+
+    assert spoken_files == [path[:-len(".txt")] + ".mp3" for path in paths]
+    assert 1 < tts.peak <= 3
+    # One silent frame per 20 characters, see FakeTTSBackend
+    for path, spoken_file in zip(paths, spoken_files):
+        with open(path, encoding="utf-8") as file:
+            assert os.path.getsize(spoken_file) == max(1, len(file.read()) // 20) * len(mp3.SILENT_FRAME)
+
+
+def test_long_chunk_is_spoken_in_parallel_pieces(tmp_path, tts):
+    text = "\n\n".join(f"Absatz {index}. Es war einmal ein Satz, der immer weiterging." * 3 for index in range(20))
+    [path] = write_chunks(tmp_path, [text])
+
+    start = time.perf_counter()
+    spoken_file = speak_file(path, cache=False, max_piece_characters=400, max_pieces_in_flight=4)
+    seconds = time.perf_counter() - start
+
+    pieces = split_text_into_pieces(text, 400)
+    assert tts.texts and sorted(tts.texts) == sorted(pieces)
+    assert 1 < tts.peak <= 4
+    assert seconds < len(pieces) * tts.latency
+    # The frames of the pieces are joined, and the piece files removed
+    assert os.path.getsize(spoken_file) == sum(max(1, len(piece) // 20) for piece in pieces) * len(mp3.SILENT_FRAME)
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(path), os.path.basename(spoken_file)])
+
+
+def test_speak_files_against_the_speech_server(tmp_path, monkeypatch):
+    pytest.importorskip("openai")
+    server, base_url = start_fake_speech_server(latency=0.2)
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    monkeypatch.setenv("OPENAI_API_KEY", "fake")
+    monkeypatch.setattr(backends, "_tts", backends.OpenAITTSBackend(model="test-tts-speaker"))
+    texts = [f"Kapitel {index}. " * (index + 1) * 10 for index in range(8)]
+    paths = write_chunks(tmp_path, texts)
+
+    try:
+        spoken_files = speak_files(paths, max_in_flight=4, cache=False)
+    finally:
+        server.shutdown()
+
+    assert spoken_files == [path[:-len(".txt")] + ".mp3" for path in paths]
+    for text, spoken_file in zip(texts, spoken_files):
+        with open(spoken_file, 'rb') as file:
+            assert file.read() == fake_audio(text)
+    assert 1 < server.peak <= 4
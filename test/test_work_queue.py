@@ -0,0 +1,64 @@
+import os
+
+from work_queue import WorkQueue
+
+
+def test_done_task_without_output_is_done_again(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"))
+    output = tmp_path / "chunk.mp3"
+
+    task_id = queue.submit("speak", str(tmp_path / "chunk.txt"))
+    task = queue.claim("worker")
+    output.write_bytes(b"audio")
+    queue.complete(task, "worker", str(output))
+    assert queue.status(task_id) == "done"
+    assert queue.submit("speak", str(tmp_path / "chunk.txt")) == task_id
+    assert queue.claim("worker") is None
+
+    # E.g. the book was evicted by the garbage collection
+    os.remove(output)
+    assert queue.status(task_id) == "pending"
+    queue.submit("speak", str(tmp_path / "chunk.txt"))
+    assert queue.claim("worker")["id"] == task_id
+
+
+def test_remove_books(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"))
+    evicted = os.path.join("cache", "a" * 32, "chunks", "000.txt")
+    kept = os.path.join("cache", "b" * 32, "chunks", "000.txt")
+    for path in (evicted, kept):
+        queue.submit("preprocess", path)
+    queue.complete(queue.claim("worker"), "worker", "000_preprocessed.txt")
+
+    assert queue.remove_books({"a" * 32}) == 1
+    assert queue.claim("worker")["path"] == kept
+
+
+def test_task_finished_by_two_workers(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"), lease_seconds=0)
+    output = tmp_path / "chunk.mp3"
+    queue.submit("speak", str(tmp_path / "chunk.txt"))
+
+    # The lease of the first worker expires at once, so the second one reclaims the task
+    first = queue.claim("first")
+    second = queue.claim("second")
+    assert first["id"] == second["id"]
+    output.write_bytes(b"audio")
+    queue.complete(first, "first", str(output))
+    queue.complete(second, "second", str(output))
+    assert queue.status(first["id"]) == "done"
+
+
+def test_other_arguments_are_another_task(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue"))
+    output = tmp_path / "chunk_preprocessed.txt"
+    output.write_text("Ein Satz.", encoding="utf-8")
+
+    skipped = queue.submit("preprocess", str(tmp_path / "chunk.txt"), {"skip_llm": True})
+    queue.complete(queue.claim("worker"), "worker", str(output))
+    assert queue.submit("preprocess", str(tmp_path / "chunk.txt"), {"skip_llm": True}) == skipped
+    assert queue.claim("worker") is None
+
+    cleaned = queue.submit("preprocess", str(tmp_path / "chunk.txt"), {"skip_llm": False})
+    assert cleaned != skipped and queue.status(cleaned) == "pending"
+    assert queue.claim("worker")["arguments"] == {"skip_llm": False}
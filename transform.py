@@ -1,66 +1,195 @@
+import os
+import re
+import mmap
+import bisect
+import hashlib
 from typing import Optional
 
-from dotenv import load_dotenv
-
-load_dotenv()
-
-from gptLang import Funktion, Parameter
-from fuzzywuzzy import fuzz
+from backends import Parameter, get_llm
+from book_cache import BookCache, link_or_copy, write_atomic
+from book_store import Book, character_to_byte_offsets
+from journal import Journal
+from locator import locate_headings
+from matcher import find_best_match
+from metrics import debug, log, record, stage
+from pdf_reader import page_to_character
+from planner import MAX_CHUNK_TOKENS, MIN_CHUNK_TOKENS, plan_chunks
+from precleaner import PAGE_BREAK, estimate_tokens
+from preprocessor import preprocessed_path
+from speaker import spoken_path
 
 ASSUME_TOC_IN_FIRST_CHARACTERS = 10000
 ASSUME_LARGEST_SUBSUBCHAPTER_LENGTH = 10000
+MAX_CHUNK_NAME_LENGTH = 60
+FRONT_MATTER_NAME = "Front matter"
+UNTITLED_NAME = "Text"
+NON_WHITESPACE = re.compile(rb"\S")
 
 
 
 def find_substring_with_tolerance(main_string, sub_string, tolerance=70):
-        for i in range(len(main_string) - len(sub_string) + 1):
-            substring = main_string[i:i + len(sub_string)]
-            similarity = fuzz.partial_ratio(substring, sub_string)
-            if similarity >= tolerance:
-                return True, i, similarity
-        return False, -1, 0
+    """
+    Find sub_string in main_string, allowing for small differences.
+    Returns whether it was found, the offset of the best match and its similarity.
+    """
+    return find_best_match(main_string, sub_string, tolerance=tolerance)
 
 
-def transform(book: str, max_length_book_as_single_file=10000) -> list: 
+def transform(book: Book, max_length_book_as_single_file=10000, page_offsets: Optional[list[int]] = None, outline: Optional[list] = None, journal: Optional[Journal] = None, identity: Optional[str] = None) -> list: 
     """ 
     Transform the book into a table of contents. 
+    A book without a table of contents is split into chunks of similar size, or kept as a single chunk
+    if it is at most max_length_book_as_single_file characters long.
+    page_offsets are the page starts from pdf_reader.extract_text_with_page_offsets, if known.
+    outline is the table of contents from pdf_reader.extract_outline, if the PDF has one.
+    Then the table of contents is not extracted with the LLM.
+    journal records every located entry of the table of contents, see enrich_table_of_contents_with_characters.
+    identity identifies the book across versions, e.g. the name of the PDF file. If an earlier version of the book
+    was processed, its table of contents and the results of all unchanged chunks are reused.
     """
-    toc = extract_table_of_contents_txt(book)
+    cache = BookCache(book)
+
+    list_of_files = cache.get_chunks()
+    if list_of_files is not None:
+        log("Chunks found in cache.")
+        record("transform", cache_hits=1)
+        if identity is not None:
+            cache.remember_as(identity)
+        return list_of_files
+
+    previous = cache.previous_version(identity) if identity is not None else None
+    if previous is not None:
+        log(f"Found an earlier version of the book: {previous.directory}")
+        reuse_table_of_contents(book, previous, cache)
+
+    list_of_files = _transform(book, cache, max_length_book_as_single_file, page_offsets, outline, journal)
+
+    if list_of_files is not None:
+        cache.put_chunks(list_of_files)
+        if previous is not None:
+            reuse_unchanged_chunks(previous, cache, journal)
+        if identity is not None:
+            cache.remember_as(identity)
+
+    return list_of_files
+
+
+def _transform(book: Book, cache: BookCache, max_length_book_as_single_file: int, page_offsets: Optional[list[int]], outline: Optional[list], journal: Optional[Journal]) -> list:
+    """
+    Split a book that is not in the cache into chunks, see transform.
+    """
+
+    if outline:
+        log("Using the outline of the PDF as table of contents.")
+        record("toc_extract", skipped="outline")
+        cache.put_toc_json(outline)
+
+        toc_enriched = enrich_table_of_contents_with_characters(book, outline, page_offsets=page_offsets, cache=cache, pages_are_exact=True, journal=journal)
+        return split_book_into_txt_files(book, toc_enriched, cache=cache, page_offsets=page_offsets)
+
+    toc = extract_table_of_contents_txt(book, cache=cache)
     
     if toc is None:
-        if max_length_book_as_single_file < len(book):
-            Exception("Table of contents not found and the book is too long to be processed as a single file.")
-
-        print("Table of contents not found. Writing the book into a single file.")
-        return [write_into_txt_file(book)]
+        # Split into planned chunks, unless the book is short enough to be a single file
+        log("Table of contents not found. Splitting the book into chunks of similar size.")
+        return split_book_into_txt_files(book, [], cache=cache, max_characters_single_chunk=max_length_book_as_single_file, page_offsets=page_offsets)
     
-    toc_json = transform_table_of_contents_into_json(book, toc)
+    toc_json = transform_table_of_contents_into_json(book, toc, cache=cache)
 
-    toc_enriched = enrich_table_of_contents_with_characters(book, toc_json)
+    toc_enriched = enrich_table_of_contents_with_characters(book, toc_json, page_offsets=page_offsets, cache=cache, journal=journal)
 
-    list_of_files = split_book_into_txt_files(book, toc_enriched)
-    
-    return list_of_files
+    return split_book_into_txt_files(book, toc_enriched, cache=cache, page_offsets=page_offsets)
+
+
+def reuse_table_of_contents(book: Book, previous: BookCache, cache: BookCache) -> bool:
+    """
+    Copy the table of contents of an earlier version of the book, if the part of the book
+    it was extracted from, the first ASSUME_TOC_IN_FIRST_CHARACTERS characters, is unchanged.
+    Returns whether it was copied.
+    """
+    if cache.get_toc_json() is not None:
+        return False
+
+    toc_json = previous.get_toc_json()
+    if toc_json is None or previous.read_book_start(ASSUME_TOC_IN_FIRST_CHARACTERS) != book[:ASSUME_TOC_IN_FIRST_CHARACTERS]:
+        return False
+
+    toc = previous.get_toc_txt()
+    if toc is not None:
+        cache.put_toc_txt(toc)
+    cache.put_toc_json(toc_json)
+
+    log("The front matter is unchanged, reusing the table of contents of the earlier version.")
+    return True
+
+
+def reuse_unchanged_chunks(previous: BookCache, cache: BookCache, journal: Optional[Journal] = None) -> int:
+    """
+    Reuse the preprocessed text and the audio of every chunk whose text is identical to a chunk of an earlier version of the book.
+    The chunks are compared by the content hashes of both manifests. The files are hard linked where possible.
+    The reused chunks are recorded as cleaned and spoken in the journal, so the pipeline skips them.
+    Returns the number of reused chunks.
+    """
+    previous_manifest = previous.get_manifest()
+    manifest = cache.get_manifest()
+    if not previous_manifest or not manifest:
+        return 0
+
+    # The preprocessed chunks of a finished book are in the pack store
+    previous.restore()
+
+    previous_chunks = {chunk["sha256"]: chunk for chunk in previous_manifest}
 
+    reused = 0
+    for chunk in manifest:
+        previous_chunk = previous_chunks.get(chunk["sha256"])
+        if previous_chunk is None or not os.path.exists(preprocessed_path(previous_chunk["path"])):
+            continue
 
-def extract_table_of_contents_txt(book: str) -> Optional[str]:
+        preprocessed_file = preprocessed_path(chunk["path"])
+        link_or_copy(preprocessed_path(previous_chunk["path"]), preprocessed_file)
+        if journal is not None:
+            journal.record("cleaned", chunk["path"], chunk["sha256"])
+
+        previous_spoken_file = spoken_path(preprocessed_path(previous_chunk["path"]))
+        if os.path.exists(previous_spoken_file):
+            link_or_copy(previous_spoken_file, spoken_path(preprocessed_file))
+            if journal is not None:
+                with open(preprocessed_file, 'rb') as file:
+                    journal.record("spoken", preprocessed_file, hashlib.sha256(file.read()).hexdigest())
+
+        reused += 1
+
+    log(f"Reused {reused} of {len(manifest)} chunks of the earlier version.")
+    record("reuse", chunks=reused, total=len(manifest))
+    return reused
+
+
+def extract_table_of_contents_txt(book: Book, cache: Optional[BookCache] = None) -> Optional[str]:
     """
     Extract the table of contents from a book as a string. Raw text.
     If the table of contents is not found, return None.
     """
-    if read_extracted_table_of_contents_cache(book) is not None:
-        print("Table of contents found in cache.")
-        return read_extracted_table_of_contents_cache(book)
+    cache = cache or BookCache(book)
+
+    cached_toc = cache.get_toc_txt()
+    if cached_toc is not None:
+        log("Table of contents found in cache.")
+        record("toc_extract", cache_hits=1)
+        return cached_toc
     else: 
-        print("Table of contents not found in cache. Extracting it from the book.")
+        log("Table of contents not found in cache. Extracting it from the book.")
     
-    toc = Funktion(
-        returnType=Parameter(type=str, name="table_of_contents"),
-        gpt_params={
-            "max_interactions": 10,
-            "max_function_iterations": 10
-        },
-        context=f"""
+    prompt = book[:ASSUME_TOC_IN_FIRST_CHARACTERS]
+
+    with stage("toc_extract", cache_misses=1) as event:
+        toc = get_llm().function(
+            returnType=Parameter(type=str, name="table_of_contents"),
+            gpt_params={
+                "max_interactions": 10,
+                "max_function_iterations": 10
+            },
+            context=f"""
 The user will give you a part of a pdf of a book. It will be the first {ASSUME_TOC_IN_FIRST_CHARACTERS} characters of the book.
 Your task is to extract the table of contents from the book.
 The table of contents is a list of chapters and subchapters with their page numbers.
@@ -68,21 +197,25 @@ Return the table of contentents in a human readable format.
 If there is no table of contents, return an empty string.
 If the table of contents contain page numbers, keep them. If it does not contain page numbers, no problem.
 """,    
-        inputPromptFormatString=f"{book[:ASSUME_TOC_IN_FIRST_CHARACTERS]}",
-        model="gpt-4.1-2025-04-14",
-        can_throw=False,
-    )()
+            inputPromptFormatString=f"{prompt}",
+            model="gpt-4.1-2025-04-14",
+            can_throw=False,
+        )()
+
+        event["bytes_in"] = len(prompt.encode())
+        event["bytes_out"] = len(toc.encode())
+        event["tokens"] = estimate_tokens(prompt) + estimate_tokens(toc)
 
     if toc == "":
-        print("Table of contents not found.")
+        log("Table of contents not found.")
         return None 
 
-    print("Table of contents found.")
-    write_extracted_table_of_contents_cache(book, toc)
+    log("Table of contents found.")
+    cache.put_toc_txt(toc)
     return toc
 
 
-def transform_table_of_contents_into_json(book: str, toc: str) -> list:
+def transform_table_of_contents_into_json(book: Book, toc: str, cache: Optional[BookCache] = None) -> list:
     """
     Transform the table of contents into a JSON object."
     
@@ -107,13 +240,17 @@ def transform_table_of_contents_into_json(book: str, toc: str) -> list:
         {name: "Chapter 3 name", page: 15},
     ]
     """
-    if read_cache_table_of_contents(book) is not None:
-        print("Table of contents JSON found in cache.")
-        return read_cache_table_of_contents(book)
+    cache = cache or BookCache(book)
+
+    cached_toc_json = cache.get_toc_json()
+    if cached_toc_json is not None:
+        log("Table of contents JSON found in cache.")
+        record("toc_json", cache_hits=1)
+        return cached_toc_json
     else: 
-        print("Table of contents JSON not found in cache. Transforming it into JSON.")
+        log("Table of contents JSON not found in cache. Transforming it into JSON.")
 
-    toc_json = Funktion(
+    to_json = get_llm().function(
         returnType=Parameter(type=list[dict], name="table_of_contents"),
         gpt_params={
             "max_interactions": 10,
@@ -149,15 +286,28 @@ First level is the chapter. Second level is the subchapter. Third level is the s
         inputPromptFormatString=f"{toc}",
         model="gpt-4.1-2025-04-14",
         can_throw=False,
-    )()
+    )
+
+    with stage("toc_json", cache_misses=1) as event:
+        toc_json = to_json()
 
-    write_cache_table_of_contents(book, toc_json)
+        event["bytes_in"] = len(toc.encode())
+        event["bytes_out"] = len(str(toc_json).encode())
+        event["tokens"] = estimate_tokens(toc) + estimate_tokens(str(toc_json))
+
+    cache.put_toc_json(toc_json)
     return toc_json
 
 
-def enrich_table_of_contents_with_characters(book: str, toc: dict) -> list[dict]:
+def enrich_table_of_contents_with_characters(book: Book, toc: dict, page_offsets: Optional[list[int]] = None, cache: Optional[BookCache] = None, pages_are_exact: bool = False, journal: Optional[Journal] = None) -> list[dict]:
     """
     Enrich the table of contents with character number information.
+    If page_offsets are given, every entry with a page number also gets the
+    character at which that page starts as "page_character".
+    If pages_are_exact, e.g. for the outline of the PDF, an entry that can not be located
+    by its name is searched on its page only, instead of with the LLM.
+    If a journal is given, every located entry is recorded in it, and entries it already has are not located again,
+    so a failed run continues with the entry it failed on.
 
     Output format: 
     [
@@ -198,11 +348,15 @@ def enrich_table_of_contents_with_characters(book: str, toc: dict) -> list[dict]
         },
     ]
     """
-    if read_cache_enriched_table_of_contents(book) is not None:
-        print("Enriched table of contents found in cache.")
-        return read_cache_enriched_table_of_contents(book)
+    cache = cache or BookCache(book)
+
+    cached_toc_enriched = cache.get_toc_enriched()
+    if cached_toc_enriched is not None:
+        log("Enriched table of contents found in cache.")
+        record("enrich", cache_hits=1)
+        return cached_toc_enriched
     else:
-        print("Enriched table of contents not found in cache. Enriching it.")
+        log("Enriched table of contents not found in cache. Enriching it.")
     
     #flatten the toc
     toc_flat = []
@@ -216,39 +370,85 @@ def enrich_table_of_contents_with_characters(book: str, toc: dict) -> list[dict]
                 "page": page,
                 "level": level,
             })
+            if page_offsets is not None:
+                toc_flat[-1]["page_character"] = page_to_character(page_offsets, page)
             if len(sub) > 0: flatten_toc(sub, level + 1)
 
     flatten_toc(toc)
     
+    names = [entry["name"] for entry in toc_flat]
+    page_hints = [entry.get("page_character") for entry in toc_flat]
+    with stage("locate", entries=len(toc_flat)) as event:
+        located = locate_headings(book, names, page_hints)
+
+        event["placed"] = sum(position is not None for position in located)
+        event["fraction_placed"] = event["placed"] / len(toc_flat) if toc_flat else 1.0
+
+    log(f"Placed {event['placed']} of {len(toc_flat)} chapters without the LLM ({event['fraction_placed']:.0%}).")
+
     enriched_toc = []
     cutoff = 0
 
-    for i in range( len(toc_flat)-1): 
+    for i in range(len(toc_flat)): 
 
         name = toc_flat[i]["name"]
         page = toc_flat[i].get("page", None)
         level = toc_flat[i]["level"]
+        journal_key = f"{i}:{name}"
+
+        journaled = journal.get("located", journal_key) if journal is not None else None
+        if journaled is not None and journaled >= cutoff:
+            cutoff = journaled
+            toc_flat[i]["character"] = cutoff
+            enriched_toc.append(toc_flat[i])
+            debug(f"Chapter {name} found in the journal at character {cutoff}")
+            continue
+
+        if located[i] is not None and located[i] >= cutoff:
+            cutoff = located[i]
+            toc_flat[i]["character"] = cutoff
+            enriched_toc.append(toc_flat[i])
+            if journal is not None:
+                journal.record("located", journal_key, cutoff)
+            debug(f"Chapter {name} placed locally at character {cutoff}")
+            continue
+
+        page_character = toc_flat[i].get("page_character")
+        if pages_are_exact and page_character is not None and page_character >= cutoff:
+            page_text = book[page_character:page_offsets[min(int(page), len(page_offsets) - 1)]]
+            found, char, _ = find_substring_with_tolerance(page_text, name, tolerance=80)
+            cutoff = page_character + (char if found else 0)
+            toc_flat[i]["character"] = cutoff
+            enriched_toc.append(toc_flat[i])
+            if journal is not None:
+                journal.record("located", journal_key, cutoff)
+            debug(f"Chapter {name} placed on its page at character {cutoff}")
+            continue
 
         next_book_part = book[cutoff:cutoff+ASSUME_LARGEST_SUBSUBCHAPTER_LENGTH]
 
-        print("Next book part: ")
-        print("====================================================================================================================================================================================================================================")
-        print(next_book_part)
-        print("====================================================================================================================================================================================================================================")
+        debug("Next book part: ")
+        debug("=" * 100)
+        debug(next_book_part)
+        debug("=" * 100)
 
-        print("Looking for the start of the chapter:")
-        print(name)
+        log(f"Looking for the start of the chapter: {name}")
         
+        matches = {}
+        attempts = []
+
         def validator_function(starting_string) -> Optional[str]:
             """
             Validate the function by checking if the toc is in the book.
             """
-            if find_substring_with_tolerance(next_book_part, starting_string, tolerance=80)[0]: 
+            attempts.append(starting_string)
+            matches[starting_string] = find_substring_with_tolerance(next_book_part, starting_string, tolerance=80)
+            if matches[starting_string][0]: 
                 return 
             else: 
                 return "That string is not in the part of the book. Please try again."
 
-        foo = Funktion(
+        foo = get_llm().function(
             returnType=Parameter(type=str, name="starting_string"),
             gpt_params={
                 "max_interactions": 10,
@@ -270,203 +470,117 @@ The string could be the headline + the first two sentences or so.
             returnValidator=validator_function,
         )
 
-        starting_string = foo()
+        with stage("enrich", cache_misses=1, chapter=name) as event:
+            starting_string = foo()
 
-        char = find_substring_with_tolerance(next_book_part, starting_string, tolerance=80)[0]
-        if char == -1:
-            print(f"String not found in book: {starting_string}")
-            Exception("String not found in book.")
-        
-        #Char is wrong here, might be a bug in the return of find_substring_with_tolerance
+            event["bytes_in"] = len(next_book_part.encode())
+            event["bytes_out"] = len(starting_string.encode())
+            event["tokens"] = len(attempts) * estimate_tokens(next_book_part) + sum(estimate_tokens(attempt) for attempt in attempts)
+            event["retries"] = max(0, len(attempts) - 1)
+
+        if starting_string not in matches:
+            matches[starting_string] = find_substring_with_tolerance(next_book_part, starting_string, tolerance=80)
+        found, char, _ = matches[starting_string]
+        if not found:
+            log(f"String not found in book: {starting_string}")
+            raise Exception("String not found in book.")
 
         cutoff += char 
 
         toc_flat[i]["character"] = cutoff
+        enriched_toc.append(toc_flat[i])
+        if journal is not None:
+            journal.record("located", journal_key, cutoff)
 
-        print("Chapter starts with")
-        print(starting_string)
-
-        print("Chapter starts at character")
-        print(cutoff)
+        debug("Chapter starts with")
+        debug(starting_string)
 
-        print("Chapter start: ")
-        print(book[cutoff:cutoff+500])
+        log(f"Chapter starts at character {cutoff}")
 
-        if i == 3: return 
+        debug("Chapter start: ")
+        debug(book[cutoff:cutoff+500])
 
-    write_cache_enriched_table_of_contents(book, enriched_toc)
+    cache.put_toc_enriched(enriched_toc)
     return enriched_toc
 
 
-def split_book_into_txt_files(book: str, enrichted_toc: dict) -> list:
+def chunk_file_name(index: int, name: str) -> str:
     """
-    Split the book into multiple text files.
-    Each text file contains the smalles unit of the book and has its name from the toc.
-    Every chapter can have a intro and a outro.
-    Returns a list of the paths to the text files.
-
+    The file name of a chunk: its position in the book and its name, without characters that are unsafe in paths.
     """
-    pass
-
-def write_into_txt_file(book: str) -> str:
-    """
-    Write the book into a txt file.
-    The file is named with the hash of the book.
-    The file is located in the same directory as the book.
-    """
-    import os
-    import hashlib
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/book.txt"
-
-    # Create the cache directory if it does not exist
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-
-    # Write the book to the cache file
-    with open(cache_file, 'w') as file:
-        file.write(book)
-
-    return cache_file
-
+    safe_name = re.sub(r"[^\w-]+", "_", name).strip("_")[:MAX_CHUNK_NAME_LENGTH]
+    return f"{index:03d}_{safe_name or 'section'}.txt"
 
 
-
-
-
-
-
-
-
-def read_extracted_table_of_contents_cache(book: str) -> Optional[str]:
-    """
-    Read the extracted table of contents from a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
-    If the cache file does not exist, return None.
-    """
-    import os
-    import hashlib
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc.txt"
-
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return file.read()
-    
-    return None
-
-def write_extracted_table_of_contents_cache(book: str, toc: str) -> None:
-    """
-    Write the extracted table of contents to a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
+def split_book_into_txt_files(book: Book, enrichted_toc: dict, cache: Optional[BookCache] = None, min_tokens: int = MIN_CHUNK_TOKENS, max_tokens: int = MAX_CHUNK_TOKENS, max_characters_single_chunk: Optional[int] = None, page_offsets: Optional[list[int]] = None) -> list:
     """
-    import os
-    import hashlib
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc.txt"
-
-    # Create the cache directory if it does not exist
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-
-    # Write the extracted table of contents to the cache file
-    with open(cache_file, 'w') as file:
-        file.write(toc)
-
-def read_cache_enriched_table_of_contents(book: str) -> Optional[dict]:
-    """
-    Read the enriched table of contents from a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
-    If the cache file does not exist, return None.
-    """
-    import os
-    import hashlib
-    import json
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc_enriched.json"
-
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return json.load(file)
-    
-    return None
-
-def write_cache_enriched_table_of_contents(book: str, toc: dict) -> None:
-    """
-    Write the enriched table of contents to a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
-    """
-    import os
-    import hashlib
-    import json
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc_enriched.json"
-
-    # Create the cache directory if it does not exist
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-
-    # Write the enriched table of contents to the cache file
-    with open(cache_file, 'w') as file:
-        json.dump(toc, file)
-
-
-        
-def read_cache_table_of_contents(book: str) -> Optional[dict]:
-    """
-    Read the table of contents from a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
-    If the cache file does not exist, return None.
-    """
-    import os
-    import hashlib
-    import json
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc.json"
-
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return json.load(file)
-    
-    return None
+    Split the book into multiple text files.
+    Each text file contains the smalles unit of the book and has its name from the toc.
+    Every chapter can have a intro and a outro.
+    Returns a list of the paths to the text files.
 
-def write_cache_table_of_contents(book: str, toc: dict) -> None:
+    A section spans from its character to the character of the next entry of the flat toc,
+    so a chapter with subchapters becomes its intro, up to its first subchapter.
+    The text before the first entry is the front matter, the last entry runs to the end of the book.
+    Without entries the whole book is one section.
+    The sections are then planned into chunks of min_tokens to max_tokens, see planner.plan_chunks:
+    small ones are merged, large ones split at paragraph boundaries.
+    The chunks are sliced from a memory map of book.txt and written in one pass over the book.
+    The book is never decoded, the character offsets are turned into byte offsets with book_store.character_to_byte_offsets.
+    If page_offsets are given, a precleaner.PAGE_BREAK is written at every page boundary within a chunk,
+    including its start and end, so precleaner.preclean knows the first and last lines of the pages.
+    The name, offsets and sha256 of every chunk are written to the manifest of the book cache.
     """
-    Write the table of contents to a cache file.
-    The cache file is named with the hash of the book.
-    The cache file is located in the same directory as the book.
-    """
-    import os
-    import hashlib
-    import json
-
-    # Get the hash of the book
-    book_hash = hashlib.md5(book.encode()).hexdigest()
-    cache_file = f"cache/{book_hash}/toc.json"
-
-    # Create the cache directory if it does not exist
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    cache = cache or BookCache(book)
+    book_path = cache.put_book(book)
+
+    sections = [{"name": FRONT_MATTER_NAME if enrichted_toc else UNTITLED_NAME, "level": 0, "page": None, "character": 0, "front_matter": True}]
+    for entry in enrichted_toc:
+        if entry.get("character") is not None and entry["character"] >= sections[-1]["character"]:
+            sections.append(entry)
+
+    chunks = plan_chunks(book, sections, min_tokens, max_tokens, max_characters_single_chunk)
+    bounds = [chunk["character_start"] for chunk in chunks] + [len(book)]
+    byte_bounds = character_to_byte_offsets(book, bounds)
+    page_bytes = sorted(set(character_to_byte_offsets(book, page_offsets))) if page_offsets else []
+
+    list_of_files = []
+    manifest = []
+    if len(book) == 0:
+        cache.put_manifest(manifest)
+        return list_of_files
+
+    with open(book_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        for index, section in enumerate(chunks):
+            start, end = bounds[index], bounds[index + 1]
+            if NON_WHITESPACE.search(view, byte_bounds[index], byte_bounds[index + 1]) is None:
+                continue
+
+            path = cache.path(os.path.join("chunks", chunk_file_name(len(list_of_files), section["name"])))
+            byte_start, byte_end = byte_bounds[index], byte_bounds[index + 1]
+            cuts = [byte_start] + page_bytes[bisect.bisect_left(page_bytes, byte_start):bisect.bisect_right(page_bytes, byte_end)] + [byte_end]
+            chunk = PAGE_BREAK.encode().join(mapped[cut:next_cut] for cut, next_cut in zip(cuts, cuts[1:]))
+            write_atomic(path, chunk)
+            sha256 = hashlib.sha256(chunk).hexdigest()
+
+            list_of_files.append(path)
+            manifest.append({
+                "name": section["name"],
+                "level": section.get("level", 0),
+                "page": section.get("page"),
+                "sections": section["sections"],
+                "path": path,
+                "character_start": start,
+                "character_end": end,
+                "byte_start": byte_bounds[index],
+                "byte_end": byte_bounds[index + 1],
+                "sha256": sha256,
+            })
 
-    # Write the table of contents to the cache file
-    with open(cache_file, 'w') as file:
-        json.dump(toc, file)
+    log(f"Split the book into {len(list_of_files)} files.")
+    record("plan", chunks=len(list_of_files), sections=len(sections))
+    cache.put_manifest(manifest)
+    return list_of_files
 
 
 
@@ -474,10 +588,10 @@ def write_cache_table_of_contents(book: str, toc: dict) -> None:
 if __name__ == "__main__":
     # Example usage
     book = "test/Lodovico_Satana.pdf"  # Replace with your PDF file path
-    from pdf_reader import extract_text
-    txt = extract_text(book)
+    from pdf_reader import extract_text_with_page_offsets
+    txt, offsets = extract_text_with_page_offsets(book)
 
-    list_of_files = transform(txt, max_length_book_as_single_file=10000)
+    list_of_files = transform(txt, max_length_book_as_single_file=10000, page_offsets=offsets)
     print(list_of_files)
 
 
@@ -0,0 +1,395 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+from book_cache import CACHE_DIRECTORY, write_atomic
+from metrics import log, record, stage
+from preprocessor import preprocess_file, preprocessed_path
+from speaker import speak_file, spoken_path
+
+QUEUE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "queue")
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 1.0
+
+# Speaking first, so finished chunks leave the queue before new ones are cleaned
+KIND_PRIORITY = {"speak": 0, "preprocess": 1}
+
+
+def new_worker_id() -> str:
+    """
+    A name for a worker that is unique across hosts and processes.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class WorkQueue:
+    """
+    A queue of chunk level tasks in a directory on a shared filesystem, e.g. in the cache directory.
+    Any number of processes on any number of hosts can work on it, see run_worker.
+
+    - tasks/<id>.json: a task, its kind ("preprocess" or "speak"), the path of its chunk and its arguments.
+      The id depends on all three, so a rerun with other arguments, e.g. without --skip_llm, does the chunk again.
+    - leases/<id>.lease: the worker working on a task. Created with O_EXCL, so only one worker gets it.
+      The lease expires lease_seconds after its modification time, the worker renews it while it works.
+      An expired lease, e.g. of a crashed worker, is reclaimed by the next worker.
+    - done/<id>.json: the result of a finished task, the path of its output. It only counts while the output exists,
+      e.g. the garbage collection may have evicted the book since, see pack_store.collect_garbage.
+    - failed/<id>.json: the failed attempts of a task. After MAX_ATTEMPTS it is not claimed anymore.
+
+    The paths in the tasks are relative, so all workers have to run in the same directory of the shared filesystem.
+    lease_seconds has to be longer than the longest task and the clock difference between the hosts.
+    All outputs of the tasks are written atomically, so a task that is done twice has the same result.
+    """
+
+    def __init__(self, directory: str = QUEUE_DIRECTORY, lease_seconds: float = LEASE_SECONDS):
+        """
+        Args:
+            directory (str): The directory of the queue.
+            lease_seconds (float): The time after which the lease of a worker that stopped renewing it expires.
+        """
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        for name in ("tasks", "leases", "done", "failed"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    @staticmethod
+    def task_id(kind: str, path: str, arguments: Optional[dict] = None) -> str:
+        options = json.dumps(arguments or {}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{kind}\0{path}\0{options}".encode()).hexdigest()[:32]
+
+    def _path(self, folder: str, task_id: str, extension: str = ".json") -> str:
+        return os.path.join(self.directory, folder, f"{task_id}{extension}")
+
+    def _read_json(self, path: str) -> Optional[dict]:
+        try:
+            with open(path, 'r', encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def submit(self, kind: str, path: str, arguments: Optional[dict] = None) -> str:
+        """
+        Add a task, unless it is already queued or done.
+        A task whose output is gone is done again.
+
+        Returns:
+            str: The id of the task.
+        """
+        task_id = self.task_id(kind, path, arguments)
+        task_path = self._path("tasks", task_id)
+        if not os.path.exists(task_path) and self.status(task_id) != "done":
+            write_atomic(task_path, json.dumps({"id": task_id, "kind": kind, "path": path, "arguments": arguments or {}}, ensure_ascii=False))
+        return task_id
+
+    def attempts(self, task_id: str) -> int:
+        failure = self._read_json(self._path("failed", task_id))
+        return failure["attempts"] if failure else 0
+
+    def status(self, task_id: str) -> str:
+        """
+        "done", "failed" (after MAX_ATTEMPTS), or "pending" (queued, running, or not yet submitted).
+        A done task whose output does not exist anymore is pending again, it is done again once it is submitted.
+        """
+        done = self._read_json(self._path("done", task_id))
+        if done is not None and (not isinstance(done["result"], str) or os.path.exists(done["result"])):
+            return "done"
+        if self.attempts(task_id) >= MAX_ATTEMPTS:
+            return "failed"
+        return "pending"
+
+    def result(self, task_id: str) -> Any:
+        done = self._read_json(self._path("done", task_id))
+        return done["result"] if done else None
+
+    def _try_lease(self, task_id: str, worker: str) -> bool:
+        lease_path = self._path("leases", task_id, ".lease")
+        try:
+            file_descriptor = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try:
+                expired = time.time() - os.path.getmtime(lease_path) > self.lease_seconds
+            except FileNotFoundError:
+                return False
+            if not expired:
+                return False
+
+            # Only one worker can rename the expired lease away, that one may take the task
+            stale_path = f"{lease_path}.{worker}.stale"
+            try:
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return False
+            os.remove(stale_path)
+            log(f"Reclaimed the expired lease of task {task_id}")
+            record("queue", reclaimed=1, task=task_id)
+            return self._try_lease(task_id, worker)
+
+        with os.fdopen(file_descriptor, 'w', encoding="utf-8") as file:
+            file.write(worker)
+        return True
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """
+        Lease the next task that is neither done, failed, nor leased by a living worker.
+
+        Returns:
+            Optional[dict]: The task, or None if there is nothing to do right now.
+        """
+        tasks = []
+        for name in os.listdir(os.path.join(self.directory, "tasks")):
+            if not name.endswith(".json"):
+                continue
+            task = self._read_json(os.path.join(self.directory, "tasks", name))
+            if task is not None:
+                tasks.append(task)
+
+        for task in sorted(tasks, key=lambda task: (KIND_PRIORITY.get(task["kind"], len(KIND_PRIORITY)), task["path"])):
+            if self.status(task["id"]) != "pending":
+                continue
+            if self._try_lease(task["id"], worker):
+                # It may have been finished between the listing and the lease
+                if self.status(task["id"]) != "pending":
+                    self._release(task["id"], worker)
+                    continue
+                return task
+
+        return None
+
+    def renew(self, task_id: str, worker: str) -> bool:
+        """
+        Extend the lease of a task. Returns False if the lease is not the worker's anymore.
+        """
+        lease_path = self._path("leases", task_id, ".lease")
+        try:
+            with open(lease_path, 'r', encoding="utf-8") as file:
+                if file.read() != worker:
+                    return False
+            os.utime(lease_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _release(self, task_id: str, worker: str) -> None:
+        lease_path = self._path("leases", task_id, ".lease")
+        try:
+            with open(lease_path, 'r', encoding="utf-8") as file:
+                if file.read() == worker:
+                    os.remove(lease_path)
+        except FileNotFoundError:
+            pass
+
+    def complete(self, task: dict, worker: str, result: Any) -> None:
+        write_atomic(self._path("done", task["id"]), json.dumps({"path": task["path"], "result": result, "worker": worker}, ensure_ascii=False))
+        # A reclaimed task may be finished by two workers, the first one removed it
+        try:
+            os.remove(self._path("tasks", task["id"]))
+        except FileNotFoundError:
+            pass
+        self._release(task["id"], worker)
+
+    def fail(self, task: dict, worker: str, error: BaseException) -> None:
+        """
+        Record a failed attempt and give the task back to the queue, unless it failed MAX_ATTEMPTS times.
+        """
+        attempts = self.attempts(task["id"]) + 1
+        write_atomic(self._path("failed", task["id"]), json.dumps({"path": task["path"], "attempts": attempts, "error": repr(error), "worker": worker}, ensure_ascii=False))
+        self._release(task["id"], worker)
+
+    def leased_paths(self, max_age: Optional[float] = None) -> list[str]:
+        """
+        The paths of the tasks that a worker is working on, e.g. for the garbage collection.
+
+        Args:
+            max_age (Optional[float]): Only leases renewed within this many seconds. lease_seconds by default.
+
+        Returns:
+            list[str]: The paths of the chunks of the tasks.
+        """
+        max_age = self.lease_seconds if max_age is None else max_age
+        paths = []
+        for name in os.listdir(os.path.join(self.directory, "leases")):
+            if not name.endswith(".lease"):
+                continue
+            try:
+                if time.time() - os.path.getmtime(os.path.join(self.directory, "leases", name)) > max_age:
+                    continue
+            except FileNotFoundError:
+                continue
+            task = self._read_json(self._path("tasks", name[:-len(".lease")]))
+            if task is not None:
+                paths.append(task["path"])
+        return paths
+
+    def remove_books(self, book_hashes: set[str]) -> int:
+        """
+        Remove the tasks, results and failures of the chunks of these books, e.g. after the garbage collection evicted them.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        removed = 0
+        for folder in ("tasks", "done", "failed"):
+            for name in os.listdir(os.path.join(self.directory, folder)):
+                entry = self._read_json(os.path.join(self.directory, folder, name))
+                # The book is a directory of the path of the chunk
+                if entry is None or "path" not in entry or not book_hashes & set(os.path.normpath(entry["path"]).split(os.sep)):
+                    continue
+                task_id = os.path.splitext(name)[0]
+                for path in (self._path(folder, task_id), self._path("leases", task_id, ".lease")):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+        return removed
+
+
+def handle_preprocess(queue: WorkQueue, task: dict) -> str:
+    """
+    Preprocess a chunk, then queue speaking it.
+    The speak task gets the same arguments, so the chunk is spoken again when it is preprocessed with other ones.
+    """
+    arguments = task["arguments"]
+    preprocessed_file = preprocess_file(
+        task["path"],
+        window_size=arguments.get("window_size", 0),
+        max_windows_in_flight=arguments.get("window_workers", 4),
+        repeated_lines=arguments.get("repeated_lines", []),
+        skip_llm=arguments.get("skip_llm", False),
+    )
+    queue.submit("speak", preprocessed_file, arguments)
+    return preprocessed_file
+
+
+def handle_speak(queue: WorkQueue, task: dict) -> str:
+    return speak_file(task["path"])
+
+
+HANDLERS = {
+    "preprocess": handle_preprocess,
+    "speak": handle_speak,
+}
+
+
+def run_worker(queue: WorkQueue, worker: Optional[str] = None, idle_seconds: Optional[float] = None,
+               until: Optional[Callable[[], bool]] = None, poll_seconds: float = POLL_SECONDS) -> int:
+    """
+    Work on the tasks of a queue: claim a task, renew its lease while working on it, record the result.
+
+    Args:
+        queue (WorkQueue): The queue.
+        worker (Optional[str]): The name of the worker. A unique name by default.
+        idle_seconds (Optional[float]): Stop after this long without a task. None waits for tasks forever.
+        until (Optional[Callable[[], bool]]): Stop as soon as this returns True.
+        poll_seconds (float): How long to wait before looking for tasks again.
+
+    Returns:
+        int: The number of tasks done.
+    """
+    worker = worker or new_worker_id()
+    done = 0
+    idle_since = time.monotonic()
+
+    while until is None or not until():
+        task = queue.claim(worker)
+        if task is None:
+            if idle_seconds is not None and time.monotonic() - idle_since > idle_seconds:
+                break
+            time.sleep(poll_seconds)
+            continue
+
+        stop_renewing = threading.Event()
+
+        def renew():
+            while not stop_renewing.wait(queue.lease_seconds / 3):
+                if not queue.renew(task["id"], worker):
+                    log(f"Lost the lease of task {task['id']}")
+                    return
+
+        renewer = threading.Thread(target=renew, daemon=True)
+        renewer.start()
+        try:
+            with stage("queue", kind=task["kind"], path=task["path"], worker=worker):
+                result = HANDLERS[task["kind"]](queue, task)
+        except Exception as error:
+            log(f"Task {task['kind']} {task['path']} failed: {error!r}")
+            queue.fail(task, worker, error)
+        else:
+            queue.complete(task, worker, result)
+            done += 1
+        finally:
+            stop_renewing.set()
+            renewer.join()
+
+        idle_since = time.monotonic()
+
+    return done
+
+
+def process_chunks(queue: WorkQueue, list_of_files: Iterable[str], arguments: dict, poll_seconds: float = POLL_SECONDS) -> list[str]:
+    """
+    Preprocess and speak chunks through the queue, working on it until all of them are spoken.
+    Other workers, see run_worker, can join at any time and take over part of the work.
+    The result is the same as with pipeline.run_pipeline on a single node.
+
+    Args:
+        queue (WorkQueue): The queue.
+        list_of_files (Iterable[str]): The chunk txt files.
+        arguments (dict): The arguments of preprocess_file: window_size, window_workers, repeated_lines and skip_llm.
+        poll_seconds (float): How long to wait before looking for tasks again.
+
+    Returns:
+        list[str]: The paths of the mp3 files, in the order of list_of_files.
+    """
+    list_of_files = list(list_of_files)
+    for path in list_of_files:
+        # A chunk preprocessed earlier whose audio is gone is only spoken again
+        if queue.status(queue.submit("preprocess", path, arguments)) == "done":
+            queue.submit("speak", preprocessed_path(path), arguments)
+
+    speak_ids = [WorkQueue.task_id("speak", preprocessed_path(path), arguments) for path in list_of_files]
+    preprocess_ids = [WorkQueue.task_id("preprocess", path, arguments) for path in list_of_files]
+
+    def finished() -> bool:
+        statuses = [queue.status(task_id) for task_id in preprocess_ids + speak_ids]
+        if "failed" in statuses:
+            raise Exception("Some chunks failed on every attempt, see the failed directory of the queue.")
+        return all(status == "done" for status in statuses)
+
+    run_worker(queue, until=finished, poll_seconds=poll_seconds)
+
+    return [spoken_path(preprocessed_path(path)) for path in list_of_files]
+
+
+if __name__ == "__main__":
+    # Two workers and a crashed one on the same queue, with the offline backends
+    import tempfile
+    import backends
+
+    backends.set_llm(backends.FakeLLMBackend(latency=0.05))
+    backends.set_tts(backends.FakeTTSBackend(latency=0.05))
+
+    with tempfile.TemporaryDirectory() as directory:
+        queue = WorkQueue(os.path.join(directory, "queue"), lease_seconds=1)
+        paths = []
+        for i in range(12):
+            paths.append(os.path.join(directory, f"chunk_{i:02d}.txt"))
+            write_atomic(paths[-1], f"Kapitel {i}. " * 100)
+
+        # A worker that claimed a task and died without renewing its lease
+        queue.submit("preprocess", paths[0], {"skip_llm": True})
+        assert queue.claim("crashed-worker")["path"] == paths[0]
+
+        helper = threading.Thread(target=run_worker, args=(queue,), kwargs={"idle_seconds": 2, "poll_seconds": 0.1})
+        helper.start()
+        spoken_files = process_chunks(queue, paths, {"skip_llm": True}, poll_seconds=0.1)
+        helper.join()
+
+        assert all(os.path.exists(path) for path in spoken_files)
+        print(f"{len(spoken_files)} chunks spoken, {len(os.listdir(os.path.join(queue.directory, 'done')))} tasks done")